@@ -5,109 +5,1288 @@
 
 #############
 
-import cv2
 import gc
-import numpy as np
-import rasterio
+import math
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from affine import Affine
+from lazy_imports import lazy_import
+from output_profiles import rasterio_options, resolve_profile, staged_output
+from instrumentation import accumulate, add_pixels, instrumented
+from resample_cache import resolve_cache
+from interpolation import rasterio_resampling, resampling_halo, resampling_name, resize_band
 
+np = lazy_import('numpy')  # The backends are imported when first used (see lazy_imports.py)
+rasterio = lazy_import('rasterio')
 
 
-def pansharpen(m, pan, psh, R = 1, G = 2, B = 3, NIR = 4, method = 'simple_brovey', W = 0.1):
+
+@instrumented
+def pansharpen(m, pan, psh, R = 1, G = 2, B = 3, NIR = 4, method = 'simple_brovey', W = 0.1, tile_size = None, 
+               workers = 1, executor = 'thread', output_profile = None, cache = None, scratch_dir = None, 
+               spat_adjust = None, resampling = 'cubic', approx_stats = False, nodata_value = None):
     """ 
     This function is used to pansharpen a given multispectral image using its corresponding panchromatic image via one of 
-    the following algorithms: 'simple_brovey, simple_mean, esri, brovey'.
+    the following algorithms: 'simple_brovey, simple_mean, esri, brovey' (pixel-wise) or 'gram_schmidt, pca, ihs' (based 
+    on scene-wide statistics, see STATISTICAL_METHODS).
   
     Inputs:
-    - m: File path of multispectral image to undergo pansharpening
-    - pan: File path of panchromatic image to be used for pansharpening
-    - psh: File path of pansharpened multispectral image to be written to file
+    - m: File path of multispectral image to undergo pansharpening. A VRT, a /vsimem/ path or an open rasterio dataset 
+      can be given as well (see _dataset_name())
+    - pan: File path of panchromatic image to be used for pansharpening (same as m)
+    - psh: File path of pansharpened multispectral image to be written to file (a /vsimem/ path keeps it in memory)
     - R: Band number of red band in the multispectral image
     - G: Band number of green band in the multispectral image
     - B: Band number of blue band in the multispectral image
     - NIR: Band number of near - infrared band in the multispectral image
-    - method: Method to be used for pansharpening
+    - method: Method to be used for pansharpening. The statistical methods use every band of the multispectral image 
+      and ignore R, G, B, NIR and W
     - W: Weight value to be used for brovey pansharpening methods
+    - tile_size: Size (in panchromatic pixels) of the windows to be streamed through memory. If None, the whole scene 
+      is loaded into memory at once
+    - workers: Number of windows processed in parallel. When greater than 1 and tile_size is None, windows of 
+      DEFAULT_TILE_SIZE pixels are used
+    - executor: Pool used to process the windows in parallel ('thread' or 'process')
+    - output_profile: Layout of the written image ('gtiff', 'cog' or a dictionary, see output_profiles.py). If None, 
+      the profile of the panchromatic image is kept
+    - cache: Cache of resampled multispectral images (True for the default one, or a ResampledCache, see 
+      resample_cache.py). Runs on the same scene pair then skip the upsampling of the multispectral image. Images that 
+      are not files on disk (e.g. /vsimem/ paths) are not cached
+    - scratch_dir: Directory where the whole-scene arrays (panchromatic, resampled multispectral and pansharpened 
+      images) are kept as memory-mapped temporary files instead of in memory, so that scenes larger than the physical 
+      memory can be processed without tiling. The files are deleted when the function returns, even if it fails
+    - spat_adjust: Alignment of the images in map coordinates: 'intersection' or 'union' of their footprints, on the 
+      panchromatic grid (see _aligned_grid()). If None, the images are assumed to share their upper-left corner and 
+      the smaller pixel extent is kept ('none' and 'nonewithoutwarning', the other values of gdal_pansharpen(), do the 
+      same). The aligned mode is always streamed by windows (tile_size), without cache or scratch_dir
+    - resampling: Interpolation of the multispectral image (nearest, bilinear, cubic [default], cubic_spline, lanczos, 
+      average, or the labels of the user interface, see interpolation.py). Faster algorithms trade sharpness for speed
+    - approx_stats: if True, the statistics of the statistical methods are computed from a subsampled read of the 
+      images (about a million pixels, from their overviews when they have some) instead of a first pass over every 
+      window
+    - nodata_value: Nodata value of the pansharpened image in the aligned mode (spat_adjust), written where the pixels 
+      are not covered by both images. If None, the nodata value of the multispectral image is used, or else that of the 
+      panchromatic image. With 'union', one of them is required, since a value picked here could collide with valid 
+      pansharpened pixels
   
     Outputs:
-    - img_psh: Pansharpened multispectral image
+    - img_psh: Pansharpened multispectral image (rows, columns, bands). The image is computed band-sequentially, so 
+      this is a transposed view of the array written to file. When tile_size, scratch_dir or spat_adjust is given, the 
+      file path of the written image is returned instead, since the whole image is never held in memory
   
     """
+    
+    if method not in PANSHARPEN_METHODS:
+        raise ValueError(f"method must be one of {', '.join(PANSHARPEN_METHODS)}")
+    resampling = resampling_name(resampling)
+    m, pan = _dataset_name(m), _dataset_name(pan)
+    if tile_size is None and (workers > 1 or _aligns(spat_adjust)):
+        tile_size = DEFAULT_TILE_SIZE
+    if tile_size is not None:
+        return _pansharpen_tiled(m, pan, psh, R, G, B, NIR, method, W, tile_size, workers, executor, output_profile, 
+                                 cache, resampling, approx_stats, spat_adjust, nodata_value)
+    if scratch_dir is None:
+        return _pansharpen_whole(m, pan, psh, R, G, B, NIR, method, W, output_profile, cache, resampling = resampling, 
+                                 approx_stats = approx_stats)
   
-    with rasterio.open(m) as f:
-        metadata_ms = f.profile
-        img_ms = np.transpose(f.read(tuple(np.arange(metadata_ms['count']) + 1)), [1, 2, 0])
+    with tempfile.TemporaryDirectory(prefix = 'pansharpen_', dir = scratch_dir) as scratch:
+        _pansharpen_whole(m, pan, psh, R, G, B, NIR, method, W, output_profile, cache, scratch, resampling, 
+                          approx_stats)
+  
+    return psh
+
+
+
+def _dataset_name(dataset):
+    """ 
+    This function returns the name a raster is opened by, so that the steps of a workflow can be chained without 
+    writing intermediate GeoTIFFs: a file path, a VRT (resampled or pansharpened on the fly when it is read) or a 
+    /vsimem/ path (an in-memory file, only visible to the process that wrote it) can be given as such, or as an open 
+    rasterio or GDAL dataset.
+  
+    """
+    if isinstance(dataset, (str, os.PathLike)):
+        return os.fspath(dataset)
+    name = dataset.GetDescription() if hasattr(dataset, 'GetDescription') else dataset.name
+    if not name:
+        raise ValueError('datasets without a name (e.g. GDAL MEM datasets) cannot be chained: use a VRT or a '
+                         '/vsimem/ path')
+  
+    return name
+
+
+
+def _pansharpen_whole(m, pan, psh, R, G, B, NIR, method, W, output_profile = None, cache = None, scratch = None, 
+                      resampling = 'cubic', approx_stats = False):
+    """ 
+    This function is the in-memory version of pansharpen(): the whole scene is processed at once.
+  
+    Inputs:
+    - m, pan, psh, R, G, B, NIR, method, W, output_profile, cache, resampling, approx_stats: See pansharpen()
+    - scratch: Directory of the memory-mapped arrays (in memory if None)
+  
+    Outputs:
+    - img_psh: See pansharpen()
+  
+    """
+    with accumulate('read'):
+        with rasterio.open(m) as f:
+            metadata_ms = f.profile
     
-    with rasterio.open(pan) as g:
-        metadata_pan = g.profile
-        img_pan = g.read(1)
+        with rasterio.open(pan) as g:
+            metadata_pan = g.profile
+            img_pan = g.read(1, out = _scratch_array(scratch, 'pan', g.shape, g.dtypes[0]))
     
 
   
     ms_to_pan_ratio = metadata_ms['transform'][0] / metadata_pan['transform'][0]
-    rescaled_ms = cv2.resize(img_ms, dsize = None, fx = ms_to_pan_ratio, fy = ms_to_pan_ratio, 
-                             interpolation = cv2.INTER_CUBIC).astype(metadata_ms['dtype'])
+    cache = resolve_cache(cache)
+    rescaled_ms, cache_key = None, None
+    if cache is not None:
+        cache_key = cache.key(m, *_output_extent(metadata_ms, metadata_pan, ms_to_pan_ratio), ms_to_pan_ratio, 
+                              resampling)
+    if cache_key is not None:
+        rescaled_ms = cache.get(cache_key)
+    fill_cache = cache_key is not None and rescaled_ms is None
+    
+    if rescaled_ms is None:
+        with accumulate('read'), rasterio.open(m) as f:
+            img_ms = f.read(tuple(np.arange(metadata_ms['count']) + 1))
+        with accumulate('resample', img_pan.size):
+            rescaled_ms = _resize_bands(img_ms, ms_to_pan_ratio, scratch, resampling)
+        del img_ms; gc.collect()
 
   
-    if img_pan.shape[0] < rescaled_ms.shape[0]:
+    if img_pan.shape[0] < rescaled_ms.shape[1]:
         ms_row_bigger = True
-        rescaled_ms = rescaled_ms[: img_pan.shape[0], :, :]
+        rescaled_ms = rescaled_ms[:, : img_pan.shape[0], :]
     else:
         ms_row_bigger = False
-        img_pan = img_pan[: rescaled_ms.shape[0], :]
+        img_pan = img_pan[: rescaled_ms.shape[1], :]
         
-    if img_pan.shape[1] < rescaled_ms.shape[1]:
+    if img_pan.shape[1] < rescaled_ms.shape[2]:
         ms_column_bigger = True
-        rescaled_ms = rescaled_ms[:, : img_pan.shape[1], :]
+        rescaled_ms = rescaled_ms[:, :, : img_pan.shape[1]]
     else:
         ms_column_bigger = False
-        img_pan = img_pan[:, : rescaled_ms.shape[1]]
+        img_pan = img_pan[:, : rescaled_ms.shape[2]]
+  
+    if fill_cache:
+        cache.put(cache_key, rescaled_ms)
   
-    del img_ms; gc.collect()
+    coefficients = None
+    if method in STATISTICAL_METHODS:
+        nodata = (metadata_ms['nodata'], metadata_pan['nodata'])
+        with accumulate('statistics', img_pan.size):
+            if approx_stats:
+                moments = _overview_moments(m, pan, img_pan.shape[0], img_pan.shape[1], ms_to_pan_ratio, nodata)
+            else:
+                moments = _moments(rescaled_ms, img_pan, nodata)
+        coefficients = _substitution(method, moments)
   
   
     if ms_row_bigger == True and ms_column_bigger == True:
-        img_psh = np.zeros((img_pan.shape[0], img_pan.shape[1], rescaled_ms.shape[2]), dtype = metadata_pan['dtype'])
+        psh_shape = (rescaled_ms.shape[0], img_pan.shape[0], img_pan.shape[1])
     elif ms_row_bigger == False and ms_column_bigger == True:
-        img_psh = np.zeros((rescaled_ms.shape[0], img_pan.shape[1], rescaled_ms.shape[2]), dtype = metadata_pan['dtype'])
-        metadata_pan['height'] = rescaled_ms.shape[0]
+        psh_shape = (rescaled_ms.shape[0], rescaled_ms.shape[1], img_pan.shape[1])
+        metadata_pan['height'] = rescaled_ms.shape[1]
     elif ms_row_bigger == True and ms_column_bigger == False:
-        img_psh = np.zeros((img_pan.shape[0], rescaled_ms.shape[1], rescaled_ms.shape[2]), dtype = metadata_pan['dtype'])
-        metadata_pan['width'] = rescaled_ms.shape[1]
+        psh_shape = (rescaled_ms.shape[0], img_pan.shape[0], rescaled_ms.shape[2])
+        metadata_pan['width'] = rescaled_ms.shape[2]
     else:
-        img_psh = np.zeros((rescaled_ms.shape), dtype = metadata_pan['dtype'])
-        metadata_pan['height'] = rescaled_ms.shape[0]
-        metadata_pan['width'] = rescaled_ms.shape[1]
+        psh_shape = rescaled_ms.shape
+        metadata_pan['height'] = rescaled_ms.shape[1]
+        metadata_pan['width'] = rescaled_ms.shape[2]
+    img_psh = _scratch_array(scratch, 'psh', psh_shape, metadata_pan['dtype'])
     
 
     
-    if method == 'simple_brovey':
-        all_in = rescaled_ms[:, :, R - 1] + rescaled_ms[:, :, G - 1] + rescaled_ms[:, :, B - 1] + rescaled_ms[:, :, NIR - 1]
-        for band in range(rescaled_ms.shape[2]):
-            img_psh[:, :, band] = np.multiply(rescaled_ms[:, :, band], (img_pan / all_in))
-        
+    with accumulate('pansharpen_kernel', img_psh.shape[1] * img_psh.shape[2]):
+        _sharpen(rescaled_ms, img_pan, img_psh, R, G, B, NIR, method, W, coefficients)
+    add_pixels(img_psh.shape[1] * img_psh.shape[2])
+  
+    del img_pan, rescaled_ms; gc.collect()
   
-    if method == 'simple_mean':
-        for band in range(rescaled_ms.shape[2]):
-            img_psh[:, :, band] = 0.5 * (rescaled_ms[:, :, band] + img_pan)
     
-        
-    if method == 'esri':
-        ADJ = img_pan - rescaled_ms.mean(axis = 2)
-        for band in range(rescaled_ms.shape[2]):
-            img_psh[:, :, band] = rescaled_ms[:, :, band] + ADJ
-        
+    metadata_pan['count'] = img_psh.shape[0]
+    output_profile = resolve_profile(output_profile)
+    if output_profile:
+        metadata_pan.update(rasterio_options(output_profile, metadata_pan['dtype']))
+    with accumulate('write'), staged_output(psh, output_profile) as path, \
+         rasterio.open(path, 'w', **metadata_pan) as dst:
+        dst.write(img_psh)
+  
+    return np.transpose(img_psh, [1, 2, 0])
+
+
+
+#############
+
+# Band-sequential layout. Rasterio reads and writes (bands, rows, columns) arrays, so the images are kept in that layout 
+# from end to end: every band is resampled straight into its plane of a preallocated C-contiguous array, and the 
+# kernels work on whole, contiguous band planes. No transposed copy of the scene is ever made.
+
+#############
+
+def _output_extent(metadata_ms, metadata_pan, ms_to_pan_ratio):
+    """ 
+    This function returns the size of the pansharpened image: the smaller of the panchromatic image and the resampled 
+    multispectral image.
+  
+    Inputs:
+    - metadata_ms, metadata_pan: Rasterio profiles of the multispectral and panchromatic images
+    - ms_to_pan_ratio: Multispectral to panchromatic cell size ratio
+  
+    Outputs:
+    - height, width: Size of the pansharpened image
+  
+    """
+    height = min(metadata_pan['height'], int(round(metadata_ms['height'] * ms_to_pan_ratio)))
+    width = min(metadata_pan['width'], int(round(metadata_ms['width'] * ms_to_pan_ratio)))
+  
+    return height, width
+
+
+def _scratch_array(scratch, name, shape, dtype):
+    """ 
+    This function allocates an array, in memory or, when a scratch directory is given, as a memory-mapped file in it 
+    (which the operating system pages in and out as needed, so the array may be larger than the physical memory).
+  
+    Inputs:
+    - scratch: Directory of the memory-mapped file (None for an in-memory array)
+    - name: Name of the file
+    - shape, dtype: Shape and data type of the array
+  
+    Outputs:
+    - C-contiguous array, initialised with zeros when memory-mapped
+  
+    """
+    if scratch is None:
+        return np.empty(shape, dtype = dtype)
+  
+    return np.memmap(os.path.join(scratch, name + '.dat'), mode = 'w+', shape = tuple(shape), dtype = dtype)
+
+
+def _resize_bands(img_ms, ms_to_pan_ratio, scratch = None, resampling = 'cubic'):
+    """ 
+    This function resamples every band of a multispectral image to the panchromatic resolution (see interpolation.py).
+  
+    Inputs:
+    - img_ms: Multispectral image (bands, rows, columns)
+    - ms_to_pan_ratio: Multispectral to panchromatic cell size ratio
+    - scratch: Directory of a memory-mapped output array (in memory if None)
+    - resampling: Interpolation algorithm
+  
+    Outputs:
+    - rescaled_ms: C-contiguous resampled image (bands, rows, columns), with the size cv2 gives to the resized bands
+  
+    """
+    height = int(round(img_ms.shape[1] * ms_to_pan_ratio))
+    width = int(round(img_ms.shape[2] * ms_to_pan_ratio))
+    rescaled_ms = _scratch_array(scratch, 'rescaled_ms', (img_ms.shape[0], height, width), img_ms.dtype)
+  
+    for band in range(img_ms.shape[0]):
+        resize_band(img_ms[band], ms_to_pan_ratio, resampling, rescaled_ms[band])
+  
+    return rescaled_ms
+
+
+
+#############
+
+# The four simple methods are pixel-wise operations, so they are applied in the same way to the whole scene or to a window 
+# of it. Each method is a kernel that broadcasts over the band axis and works in place on float32 buffers. The block is 
+# processed in strips of rows, so that the buffers are allocated once and reused for the whole block. The result is 
+# rounded and clamped to the range of the output data type (integer overflow would otherwise wrap around). The 
+# statistical methods share a single kernel, _substitute(), whose coefficients come from the whole scene (see below).
+
+#############
+
+PANSHARPEN_METHODS = ('simple_brovey', 'simple_mean', 'esri', 'brovey', 'gram_schmidt', 'pca', 'ihs')
+_KERNEL_ROWS = 256  # Rows of a block processed at a time by the kernels
+
+
+def _simple_brovey(ms, pan, shared, R, G, B, NIR, W):
+    """ ms * pan / (R + G + B + NIR) """
+    np.add(ms[R - 1], ms[G - 1], out = shared)
+    shared += ms[B - 1]
+    shared += ms[NIR - 1]
+    np.divide(pan, shared, out = shared, where = shared != 0)
+    ms *= shared
+
+
+def _simple_mean(ms, pan, shared, R, G, B, NIR, W):
+    """ 0.5 * (ms + pan) """
+    ms += pan
+    ms *= 0.5
+
+
+def _esri(ms, pan, shared, R, G, B, NIR, W):
+    """ ms + (pan - mean of the bands) """
+    np.sum(ms, axis = 0, out = shared)
+    shared *= 1 / ms.shape[0]
+    np.subtract(pan, shared, out = shared)
+    ms += shared
+
+
+def _brovey(ms, pan, shared, R, G, B, NIR, W):
+    """ ms * (pan - W * NIR) / (W * R + W * G + W * B) """
+    np.multiply(ms[NIR - 1], W, out = shared)
+    pan -= shared
+    np.add(ms[R - 1], ms[G - 1], out = shared)
+    shared += ms[B - 1]
+    shared *= W
+    np.divide(pan, shared, out = shared, where = shared != 0)
+    ms *= shared
+
+
+def _substitute(ms, pan, shared, weights, offset, gains, scale, shift):
+    """ ms + gains * (scale * pan + shift - (weights . ms + offset)) """
+    np.multiply(pan, scale, out = shared)
+    shared += shift - offset
+    for band in range(ms.shape[0]):
+        np.multiply(ms[band], weights[band], out = pan)
+        shared -= pan
+    for band in range(ms.shape[0]):
+        np.multiply(shared, gains[band], out = pan)
+        ms[band] += pan
+
+
+_KERNELS = {'simple_brovey': _simple_brovey, 'simple_mean': _simple_mean, 'esri': _esri, 'brovey': _brovey}
+
+
+def _store(values, out):
+    """ 
+    This function writes float values into an array, rounding and clamping them explicitly when the array has an integer 
+    data type. Undefined values (divisions by zero) are written as 0.
+  
+    Inputs:
+    - values: Float32 array (modified in place)
+    - out: Destination array
+  
+    """
+    if np.issubdtype(out.dtype, np.integer):
+        info = np.iinfo(out.dtype)
+        np.nan_to_num(values, copy = False, nan = 0)
+        np.rint(values, out = values)
+        np.clip(values, info.min, info.max, out = values)
     
-    if method == 'brovey':
-        DNF = (img_pan - W * rescaled_ms[:, :, NIR - 1]) / (W * rescaled_ms[:, :, R - 1] + W * rescaled_ms[:, :, G - 1] + W * rescaled_ms[:, :, B - 1])
-        for band in range(rescaled_ms.shape[2]):
-            img_psh[:, :, band] = rescaled_ms[:, :, band] * DNF
-        
+    out[...] = values
+
+
+def _sharpen(rescaled_ms, img_pan, img_psh, R, G, B, NIR, method, W, coefficients = None):
+    """ 
+    This function applies the pansharpening algorithm to a block of pixels and stores the result in img_psh.
   
-    del img_pan, rescaled_ms; gc.collect()
+    Inputs:
+    - rescaled_ms: Multispectral block resampled to the panchromatic resolution (bands, rows, columns)
+    - img_pan: Panchromatic block (rows, columns)
+    - img_psh: Array of the same shape as rescaled_ms where the pansharpened block is written
+    - R, G, B, NIR, method, W: See pansharpen()
+    - coefficients: Transform of the statistical methods, computed from the whole scene (see _substitution())
   
+    """
+    if method not in PANSHARPEN_METHODS:
+        raise ValueError(f"method must be one of {', '.join(PANSHARPEN_METHODS)}")
+    if method in STATISTICAL_METHODS and coefficients is None:
+        raise ValueError(f'the {method} method needs the statistics of the whole scene (see substitution_coefficients())')
+    kernel = _KERNELS.get(method)
+  
+    rows = min(_KERNEL_ROWS, rescaled_ms.shape[1])
+    ms = np.empty((rescaled_ms.shape[0], rows, rescaled_ms.shape[2]), dtype = np.float32)
+    pan = np.empty((rows, rescaled_ms.shape[2]), dtype = np.float32)
+    shared = np.empty_like(pan)
+  
+    for start in range(0, rescaled_ms.shape[1], rows):
+        stop = min(start + rows, rescaled_ms.shape[1])
+        ms_strip, pan_strip, shared_strip = ms[:, : stop - start], pan[: stop - start], shared[: stop - start]
+        ms_strip[...] = rescaled_ms[:, start:stop]
+        pan_strip[...] = img_pan[start:stop]
+        if kernel is None:
+            _substitute(ms_strip, pan_strip, shared_strip, *coefficients)
+        else:
+            kernel(ms_strip, pan_strip, shared_strip, R, G, B, NIR, W)
+        _store(ms_strip, img_psh[:, start:stop])
+
+
+
+#############
+
+# Streaming mode. The panchromatic grid is split into block-aligned windows and, for each window, only the multispectral 
+# pixels under it plus a halo wide enough for the interpolation kernel are read. Window origins are multiples of the 
+# resolution ratio so that every window starts at a whole multispectral pixel: cv2 then samples the multispectral window 
+# at the same positions and with the same weights as the whole scene, so the output matches the in-memory path. Integer 
+# images are identical at power-of-two ratios (2:1, 4:1) for every resampling algorithm, and float images within a 
+# rounding error (1e-6 relative, along the right and bottom edges). At other ratios cv2 (and GDAL's warper, used by 
+# cubic_spline at non-integer ratios) computes the sample positions in single precision from the position in the array, 
+# so a window weights the multispectral pixels slightly differently from the whole scene: with cubic, cubic_spline and 
+# lanczos, the resampled bands of 8 and 16-bit images differ by up to 2 digital numbers at a few pixels (measured at 3:1 
+# and 2.5:1; nearest, bilinear and average stay identical, and so does cubic_spline at integer ratios). The band math 
+# scales the difference with the pixel values (up to 5 digital numbers with brovey on 16-bit images, 1e-5 relative on 
+# float images). tests/test_tiling.py checks these tolerances.
+
+#############
+
+DEFAULT_TILE_SIZE = 1024  # Window size used when pansharpening in parallel without an explicit tile size
+
+
+def _ratio_period(ms_to_pan_ratio):
+    """ 
+    This function returns the smallest number of panchromatic pixels that spans a whole number of multispectral pixels.
+  
+    Inputs:
+    - ms_to_pan_ratio: Multispectral to panchromatic cell size ratio
+  
+    Outputs:
+    - period: Number of panchromatic pixels (1 when the ratio is not a simple fraction)
+    - ms_period: Number of multispectral pixels spanned by the period
+  
+    """
+    for ms_period in range(1, 65):
+        period = ms_to_pan_ratio * ms_period
+        if abs(period - round(period)) < 1e-9:
+            return int(round(period)), ms_period
+    
+    return 1, 1
+
+
+def _tile_length(tile_size, block, period, extent):
+    """ 
+    This function aligns the length of a window to the internal blocks of the raster and to the resolution ratio.
+  
+    Inputs:
+    - tile_size: Requested window length
+    - block: Length of the internal blocks of the panchromatic raster
+    - period: See _ratio_period()
+    - extent: Length of the output raster
+  
+    Outputs:
+    - length: Window length, a multiple of period (and of block when the blocks are not larger than the window)
+  
+    """
+    step = period
+    if block <= tile_size:
+        step = block * period // math.gcd(block, period)
+    length = max(tile_size // step, 1) * step
+    
+    return min(length, extent)
+
+
+def _tile_windows(height, width, tile_height, tile_width):
+    """ 
+    This function splits a raster into windows, row by row.
+  
+    Inputs:
+    - height, width: Size of the raster
+    - tile_height, tile_width: Size of the windows
+  
+    Outputs:
+    - Generator of rasterio windows
+  
+    """
+    for row_off in range(0, height, tile_height):
+        for col_off in range(0, width, tile_width):
+            yield rasterio.windows.Window(col_off, row_off, min(tile_width, width - col_off), 
+                                          min(tile_height, height - row_off))
+
+
+def _sample_windows(height, width, pixels, block_height = 1, block_width = 1, count = 8):
+    """ 
+    This function spreads small windows evenly over a raster, for statistics computed from a sample of it: up to 
+    count x count windows, one in the middle of every cell of a regular grid, with about pixels pixels in total. 
+    The windows do not overlap, so no pixel is counted twice.
+  
+    Inputs:
+    - height, width: Size of the raster
+    - pixels: Number of pixels to be sampled
+    - block_height, block_width: Internal blocks of the raster, on which the window origins are snapped
+    - count: Number of windows along each axis
+  
+    Outputs:
+    - List of rasterio windows, row by row
+  
+    """
+    size = max(1, int(math.sqrt(pixels)) // count)
+    rows = _sample_offsets(height, size, block_height, count)
+    cols = _sample_offsets(width, size, block_width, count)
+  
+    return [rasterio.windows.Window(col_off, row_off, min(size, width - col_off), min(size, height - row_off)) 
+            for row_off in rows for col_off in cols]
+
+
+def _sample_offsets(extent, size, block, count):
+    cells = max(1, min(count, extent // size))
+    offsets = []
+    for cell in range(cells):
+        offset = int((cell + 0.5) * extent / cells - size / 2)
+        offset = max(0, offset - offset % block)
+        if not offsets or offset >= offsets[-1] + size:
+            offsets.append(offset)
+    return offsets
+
+
+def _ms_span(pan_off, pan_size, ms_to_pan_ratio, ms_period, ms_size, resampling = 'cubic'):
+    """ 
+    This function finds the multispectral pixels (halo included) needed to resample a panchromatic span.
+  
+    Inputs:
+    - pan_off, pan_size: Offset and length of the panchromatic span
+    - ms_to_pan_ratio: Multispectral to panchromatic cell size ratio
+    - ms_period: See _ratio_period()
+    - ms_size: Length of the multispectral raster along the same axis
+    - resampling: Interpolation algorithm, whose kernel size sets the halo
+  
+    Outputs:
+    - ms_off, ms_end: Multispectral span to be read
+    - skip: Number of resampled pixels to discard at the start of the span
+  
+    """
+    halo = -(-resampling_halo(resampling) // ms_period) * ms_period
+    ms_off = max(int(round(pan_off / ms_to_pan_ratio)) - halo, 0)
+    ms_end = min(int(math.ceil(round((pan_off + pan_size) / ms_to_pan_ratio, 9))) + halo, ms_size)
+    skip = pan_off - int(round(ms_off * ms_to_pan_ratio))
     
-    metadata_pan['count'] = img_psh.shape[2]
-    with rasterio.open(psh, 'w', **metadata_pan) as dst:
-        dst.write(np.transpose(img_psh, [2, 0, 1]))
+    return ms_off, ms_end, skip
+
+
+def _read_tile(f, g, window, ms_to_pan_ratio, ms_period, resampling = 'cubic'):
+    """ 
+    This function reads a panchromatic window and resamples the multispectral pixels under it to the panchromatic grid.
+  
+    Inputs:
+    - f: Open multispectral dataset
+    - g: Open panchromatic dataset
+    - window: Panchromatic window
+    - ms_to_pan_ratio: Multispectral to panchromatic cell size ratio
+    - ms_period: See _ratio_period()
+    - resampling: Interpolation algorithm
+  
+    Outputs:
+    - rescaled_ms: Resampled multispectral block (bands, rows, columns)
+    - img_pan: Panchromatic block (rows, columns)
+  
+    """
+    row_off, row_end, row_skip = _ms_span(window.row_off, window.height, ms_to_pan_ratio, ms_period, f.height, 
+                                          resampling)
+    col_off, col_end, col_skip = _ms_span(window.col_off, window.width, ms_to_pan_ratio, ms_period, f.width, 
+                                          resampling)
+    ms_window = rasterio.windows.Window(col_off, row_off, col_end - col_off, row_end - row_off)
+  
+    with accumulate('read'):
+        img_ms = f.read(tuple(np.arange(f.count) + 1), window = ms_window)
+        img_pan = g.read(1, window = window)
+    with accumulate('resample', window.width * window.height):
+        rescaled_ms = _resize_bands(img_ms, ms_to_pan_ratio, resampling = resampling)
+    rescaled_ms = rescaled_ms[:, row_skip : row_skip + window.height, col_skip : col_skip + window.width]
+  
+    return rescaled_ms, img_pan
+
+
+def _load_tile(m, pan, window, ms_to_pan_ratio, ms_period, ms_cache = None, fill_cache = False, resampling = 'cubic'):
+    """ 
+    This function opens the datasets and reads one window, from the cache of resampled multispectral images when it 
+    has one (see _sharpen_tile()).
+  
+    Outputs:
+    - rescaled_ms: Resampled multispectral block (bands, rows, columns)
+    - img_pan: Panchromatic block (rows, columns)
+  
+    """
+    rows, cols = window.toslices()
+    if ms_cache is not None and not fill_cache:
+        with accumulate('read'), rasterio.open(pan) as g:
+            rescaled_ms = np.load(ms_cache, mmap_mode = 'r')[:, rows, cols]
+            img_pan = g.read(1, window = window)
+    else:
+        with rasterio.open(m) as f, rasterio.open(pan) as g:
+            rescaled_ms, img_pan = _read_tile(f, g, window, ms_to_pan_ratio, ms_period, resampling)
+        if fill_cache:
+            np.load(ms_cache, mmap_mode = 'r+')[:, rows, cols] = rescaled_ms
+  
+    return rescaled_ms, img_pan
+
+
+def _sharpen_tile(m, pan, window, ms_to_pan_ratio, ms_period, dtype, R, G, B, NIR, method, W, keep_pan = False, 
+                  ms_cache = None, fill_cache = False, resampling = 'cubic', coefficients = None):
+    """ 
+    This function pansharpens one window. The datasets are opened by each call, so that windows can be processed 
+    concurrently by threads or processes without sharing file handles.
+  
+    Inputs:
+    - m, pan, R, G, B, NIR, method, W, resampling: See pansharpen()
+    - window: Panchromatic window
+    - ms_to_pan_ratio: Multispectral to panchromatic cell size ratio
+    - ms_period: See _ratio_period()
+    - dtype: Data type of the pansharpened image
+    - keep_pan: If True, the panchromatic block is returned as well
+    - ms_cache: File path of a cached resampled multispectral image (see resample_cache.py). The window is taken from 
+      it instead of being resampled
+    - fill_cache: If True, the window is resampled and written into ms_cache
+    - coefficients: See _sharpen()
+  
+    Outputs:
+    - window: Panchromatic window
+    - img_psh: Pansharpened block (bands, rows, columns)
+    - img_pan: Panchromatic block (rows, columns), only when keep_pan is True
+  
+    """
+    rescaled_ms, img_pan = _load_tile(m, pan, window, ms_to_pan_ratio, ms_period, ms_cache, fill_cache, resampling)
+  
+    img_psh = np.empty(rescaled_ms.shape, dtype = dtype)
+    with accumulate('pansharpen_kernel', window.width * window.height):
+        _sharpen(rescaled_ms, img_pan, img_psh, R, G, B, NIR, method, W, coefficients)
+  
+    if keep_pan:
+        return window, img_psh, img_pan
+    return window, img_psh
+
+
+def _ordered_map(function, tasks, workers, executor):
+    """ 
+    This function runs function(*task) for every task on a pool of workers and yields the results in the order of the 
+    tasks, so that a single consumer can write them deterministically. At most two tasks per worker are in flight, 
+    which keeps memory bounded by the window size.
+  
+    Inputs:
+    - function: Module-level function to be run (it must be picklable for the process pool)
+    - tasks: Iterable of argument tuples
+    - workers: Number of workers. With 1 worker, tasks are run in the calling thread
+    - executor: 'thread' or 'process'
+  
+    Outputs:
+    - Generator of results
+  
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield function(*task)
+        return
+  
+    if executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers = workers)
+    elif executor == 'process':
+        pool = ProcessPoolExecutor(max_workers = workers)
+    else:
+        raise ValueError("executor must be 'thread' or 'process'")
+  
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(pool.submit(function, *task))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        pool.shutdown(wait = True, cancel_futures = True)
+
+
+@instrumented
+def pansharpen_tiles(m, pan, R = 1, G = 2, B = 3, NIR = 4, method = 'simple_brovey', W = 0.1, 
+                     tile_size = DEFAULT_TILE_SIZE, workers = 1, executor = 'thread', align = 1, keep_pan = False, 
+                     cache = None, resampling = 'cubic', windows = None, approx_stats = False, coefficients = None, 
+                     spat_adjust = None, nodata_value = None):
+    """ 
+    This function plans the streaming version of pansharpen(). It returns the profile of the pansharpened image and a 
+    generator of pansharpened windows, computed by a pool of workers and yielded in order, so that the caller can write 
+    them (or process them further) one at a time.
+  
+    Inputs:
+    - m, pan, R, G, B, NIR, method, W, tile_size, workers, executor, resampling, approx_stats, spat_adjust, 
+      nodata_value: See pansharpen()
+    - align: Window origins and sizes are also made multiples of this number of pixels (e.g. the largest overview 
+      factor, so that every window maps onto whole overview pixels)
+    - keep_pan: If True, the panchromatic block of each window is yielded as well
+    - cache: See pansharpen(). On a cache miss, the windows are resampled and stored in a new cache entry, which is 
+      committed once all the windows have been yielded. It is not used with spat_adjust
+    - windows: Windows to be computed, on the grid of the pansharpened image (e.g. the windows of an earlier run whose 
+      inputs changed). If None, the whole grid is split into windows. A subset of the windows never fills the cache
+    - coefficients: Transform of the statistical methods (see substitution_coefficients()). If None, it is computed 
+      by a first pass over the whole grid, so that a subset of the windows matches the same windows of a full run
+  
+    Outputs:
+    - metadata_pan: Rasterio profile of the pansharpened image
+    - tiles: Generator of (window, img_psh) tuples, or (window, img_psh, img_pan) tuples when keep_pan is True
+  
+    """
+    if method not in PANSHARPEN_METHODS:
+        raise ValueError(f"method must be one of {', '.join(PANSHARPEN_METHODS)}")
+    resampling = resampling_name(resampling)
+    m, pan = _dataset_name(m), _dataset_name(pan)
+    if _aligns(spat_adjust):
+        plan = _aligned_plan(m, pan, spat_adjust, tile_size, align, nodata_value)
+        if spat_adjust == 'union' and plan[0]['nodata'] is None:
+            raise ValueError("spat_adjust='union' needs a nodata value for the pixels outside the images: give "
+                             "nodata_value, since neither image has one")
+        return _aligned_tiles(m, pan, plan, R, G, B, NIR, method, W, workers, executor, keep_pan, resampling, windows, 
+                              approx_stats, coefficients)
+  
+    with rasterio.open(m) as f, rasterio.open(pan) as g:
+        metadata_ms = f.profile
+        metadata_pan = g.profile
+        block_height, block_width = g.block_shapes[0]
+        ms_count = f.count
+  
+    ms_to_pan_ratio = metadata_ms['transform'][0] / metadata_pan['transform'][0]
+    period, ms_period = _ratio_period(ms_to_pan_ratio)
+    step = period * align // math.gcd(period, align)
+  
+    # Same extent as the in-memory path: the smaller of the panchromatic and the resampled multispectral images
+    metadata_pan['height'], metadata_pan['width'] = _output_extent(metadata_ms, metadata_pan, ms_to_pan_ratio)
+    metadata_pan['count'] = ms_count
+  
+    tile_height = _tile_length(tile_size, block_height, step, metadata_pan['height'])
+    tile_width = _tile_length(tile_size, block_width, step, metadata_pan['width'])
+  
+    cache = resolve_cache(cache)
+    ms_cache, fill_cache, cache_key = None, False, None
+    if cache is not None:
+        cache_key = cache.key(m, metadata_pan['height'], metadata_pan['width'], ms_to_pan_ratio, resampling)
+    if cache_key is not None:
+        if cache.get(cache_key) is not None:
+            ms_cache = cache.path(cache_key)
+        elif windows is None:
+            shape = (ms_count, metadata_pan['height'], metadata_pan['width'])
+            ms_cache, fill_cache = cache.create(cache_key, shape, metadata_ms['dtype']), True
+  
+    if method in STATISTICAL_METHODS and coefficients is None:
+        coefficients = substitution_coefficients(m, pan, method, tile_size, workers, executor, cache, resampling, 
+                                                 approx_stats)
+    if windows is None:
+        windows = _tile_windows(metadata_pan['height'], metadata_pan['width'], tile_height, tile_width)
+    tasks = ((m, pan, window, ms_to_pan_ratio, ms_period, metadata_pan['dtype'], R, G, B, NIR, method, W, keep_pan, 
+              ms_cache, fill_cache, resampling, coefficients)
+             for window in windows)
+    tiles = _ordered_map(_sharpen_tile, tasks, workers, executor)
+    if fill_cache:
+        tiles = _filling_cache(tiles, cache, cache_key, ms_cache)
+  
+    return metadata_pan, tiles
+
+
+def _filling_cache(tiles, cache, cache_key, partial):
+    """ 
+    This generator yields the pansharpened windows while they fill a new cache entry (the partial file returned by 
+    cache.create()), and commits the entry once every window has been computed (the entry is discarded if the windows 
+    are not all consumed).
+  
+    """
+    try:
+        yield from tiles
+    except BaseException:
+        cache.discard(partial)
+        raise
+    else:
+        cache.commit(cache_key, partial)
+    finally:
+        tiles.close()
+
+
+def _pansharpen_tiled(m, pan, psh, R, G, B, NIR, method, W, tile_size, workers = 1, executor = 'thread', 
+                      output_profile = None, cache = None, resampling = 'cubic', approx_stats = False, 
+                      spat_adjust = None, nodata_value = None):
+    """ 
+    This function is the streaming version of pansharpen(). Windows of the panchromatic image (and the multispectral 
+    pixels under them) are pansharpened by a pool of workers and written in order by the calling thread.
+  
+    Inputs:
+    - m, pan, psh, R, G, B, NIR, method, W, tile_size, workers, executor, output_profile, cache, resampling, 
+      approx_stats, spat_adjust, nodata_value: See pansharpen()
+  
+    Outputs:
+    - psh: File path of the pansharpened multispectral image
+  
+    """
+    metadata_pan, tiles = pansharpen_tiles(m, pan, R, G, B, NIR, method, W, tile_size, workers, executor, 
+                                           cache = cache, resampling = resampling, approx_stats = approx_stats, 
+                                           spat_adjust = spat_adjust, nodata_value = nodata_value)
+    output_profile = resolve_profile(output_profile)
+    if output_profile:
+        metadata_pan.update(rasterio_options(output_profile, metadata_pan['dtype']))
+  
+    with staged_output(psh, output_profile) as path, rasterio.open(path, 'w', **metadata_pan) as dst:
+        for window, img_psh in tiles:
+            with accumulate('write', window.width * window.height):
+                dst.write(img_psh, window = window)
+            add_pixels(window.width * window.height)
+  
+    return psh
+
+
+
+#############
+
+# Georeferenced alignment. The default path assumes that both images start at the same corner and only compares their 
+# pixel counts. With spat_adjust, the pansharpened grid is computed in map coordinates instead, like the spat_adjust 
+# option of gdal_pansharpen: it keeps the cell size, orientation and pixel edges of the panchromatic image, over the 
+# intersection or the union of the two footprints. The multispectral image is warped straight onto that grid (any 
+# origin, ratio or coordinate reference system) by GDAL's warper, one window at a time, so only the 
+# overlapping windows of each input are read. Pixels not covered by both images are written as nodata (see 
+# nodata_value).
+
+#############
+
+SPAT_ADJUST_MODES = ('intersection', 'union')
+
+
+def _aligned_grid(f, g, spat_adjust):
+    """ 
+    This function computes the grid of the pansharpened image in the pixel space of the panchromatic image.
+  
+    Inputs:
+    - f: Open multispectral dataset
+    - g: Open panchromatic dataset
+    - spat_adjust: 'intersection' or 'union'
+  
+    Outputs:
+    - col_off, row_off: Offset of the grid in panchromatic pixels (negative when the union extends beyond the 
+      panchromatic image)
+    - width, height: Size of the grid
+  
+    """
+    if spat_adjust not in SPAT_ADJUST_MODES:
+        raise ValueError(f"spat_adjust must be one of {', '.join(SPAT_ADJUST_MODES)}")
+    if f.crs is None or g.crs is None:
+        raise ValueError('georeferenced alignment needs both images to have a coordinate reference system')
+  
+    left, bottom, right, top = rasterio.warp.transform_bounds(f.crs, g.crs, *f.bounds)
+    corners = [~g.transform * (x, y) for x in (left, right) for y in (bottom, top)]
+    cols, rows = [corner[0] for corner in corners], [corner[1] for corner in corners]
+    # Footprint of the multispectral image in panchromatic pixels, snapped outwards (within a rounding tolerance)
+    ms_box = (math.floor(round(min(cols), 6)), math.floor(round(min(rows), 6)), 
+              math.ceil(round(max(cols), 6)), math.ceil(round(max(rows), 6)))
+  
+    if spat_adjust == 'intersection':
+        col_off, row_off = max(ms_box[0], 0), max(ms_box[1], 0)
+        col_end, row_end = min(ms_box[2], g.width), min(ms_box[3], g.height)
+    else:
+        col_off, row_off = min(ms_box[0], 0), min(ms_box[1], 0)
+        col_end, row_end = max(ms_box[2], g.width), max(ms_box[3], g.height)
+    if col_end <= col_off or row_end <= row_off:
+        raise ValueError('the multispectral and panchromatic images do not overlap')
+  
+    return col_off, row_off, col_end - col_off, row_end - row_off
+
+
+def _read_aligned_tile(m, pan, window, col_off, row_off, metadata, resampling = 'cubic'):
+    """ 
+    This function reads one window of the aligned grid (see _aligned_grid()): the multispectral image is warped onto 
+    it and the panchromatic image is read around it.
+  
+    Inputs:
+    - m, pan, resampling: See pansharpen()
+    - window: Window of the aligned grid
+    - col_off, row_off: Offset of the aligned grid in panchromatic pixels
+    - metadata: Rasterio profile of the pansharpened image
+  
+    Outputs:
+    - rescaled_ms: Warped multispectral block (bands, rows, columns)
+    - img_pan: Panchromatic block (rows, columns), 0 outside the panchromatic image
+    - valid: Mask of the pixels covered by both images
+  
+    """
+    pan_window = rasterio.windows.Window(window.col_off + col_off, window.row_off + row_off, window.width, 
+                                         window.height)
+    outside = not (pan_window.col_off >= 0 and pan_window.row_off >= 0 and 
+                   pan_window.col_off + pan_window.width <= metadata['pan_width'] and 
+                   pan_window.row_off + pan_window.height <= metadata['pan_height'])
+  
+    with rasterio.open(m) as f, rasterio.open(pan) as g:
+        # Without a nodata value, the footprint of the multispectral image is tracked by an alpha band
+        with rasterio.vrt.WarpedVRT(f, crs = metadata['crs'], transform = metadata['transform'], 
+                                    width = metadata['width'], height = metadata['height'], nodata = f.nodata, 
+                                    add_alpha = f.nodata is None, 
+                                    resampling = rasterio_resampling(resampling)) as vrt:
+            with accumulate('resample', window.width * window.height):
+                rescaled_ms = vrt.read(window = window)
+                if f.nodata is None:
+                    rescaled_ms, ms_mask = rescaled_ms[:-1], rescaled_ms[-1]
+                else:
+                    ms_mask = vrt.dataset_mask(window = window)
+        with accumulate('read'):
+            img_pan = g.read(1, window = pan_window, boundless = outside, masked = True)
+  
+    return rescaled_ms, img_pan.filled(0), (ms_mask != 0) & ~np.ma.getmaskarray(img_pan)
+
+
+def _sharpen_aligned_tile(m, pan, window, col_off, row_off, metadata, R, G, B, NIR, method, W, resampling = 'cubic', 
+                          coefficients = None, keep_pan = False):
+    """ 
+    This function pansharpens one window of the aligned grid (see _aligned_grid()).
+  
+    Inputs:
+    - m, pan, R, G, B, NIR, method, W, resampling: See pansharpen()
+    - window, col_off, row_off, metadata: See _read_aligned_tile()
+    - coefficients: See _sharpen()
+    - keep_pan: If True, the panchromatic block is returned as well
+  
+    Outputs:
+    - window: Window of the aligned grid
+    - img_psh: Pansharpened block (bands, rows, columns)
+    - img_pan: Panchromatic block (rows, columns), only when keep_pan is True
+  
+    """
+    rescaled_ms, img_pan, valid = _read_aligned_tile(m, pan, window, col_off, row_off, metadata, resampling)
+  
+    img_psh = np.empty(rescaled_ms.shape, dtype = metadata['dtype'])
+    with accumulate('pansharpen_kernel', window.width * window.height):
+        _sharpen(rescaled_ms, img_pan, img_psh, R, G, B, NIR, method, W, coefficients)
+    if not valid.all():
+        if metadata['nodata'] is None:
+            raise ValueError('some pixels are not covered by both images and neither image has a nodata value: give '
+                             'nodata_value')
+        img_psh[:, ~valid] = metadata['nodata']
+  
+    if keep_pan:
+        return window, img_psh, img_pan
+    return window, img_psh
+
+
+def _aligned_tile_moments(m, pan, window, col_off, row_off, metadata, resampling = 'cubic'):
+    """ 
+    This function computes the statistics of one window of the aligned grid, over the pixels covered by both images.
+  
+    """
+    rescaled_ms, img_pan, valid = _read_aligned_tile(m, pan, window, col_off, row_off, metadata, resampling)
+    with accumulate('statistics', window.width * window.height):
+        return _moments(rescaled_ms, img_pan, valid = valid)
+
+
+def _aligns(spat_adjust):
+    """ 
+    This function tells if a spat_adjust value asks for the georeferenced alignment. The values of gdal_pansharpen() 
+    that turn it off ('none' and 'nonewithoutwarning') are accepted as well as None.
+  
+    """
+    return spat_adjust not in (None, 'none', 'nonewithoutwarning')
+
+
+def _aligned_plan(m, pan, spat_adjust, tile_size = DEFAULT_TILE_SIZE, align = 1, nodata_value = None):
+    """ 
+    This function plans the windows of the aligned grid (see _aligned_grid()).
+  
+    Inputs:
+    - m, pan, spat_adjust, tile_size, nodata_value: See pansharpen()
+    - align: See pansharpen_tiles()
+  
+    Outputs:
+    - metadata_pan: Rasterio profile of the pansharpened image. Its nodata value is None when neither nodata_value nor 
+      the images give one
+    - metadata: The same profile, with the size of the panchromatic image, as given to the workers
+    - windows: List of the windows of the aligned grid
+    - col_off, row_off: Offset of the aligned grid in panchromatic pixels
+  
+    """
+    with rasterio.open(m) as f, rasterio.open(pan) as g:
+        col_off, row_off, width, height = _aligned_grid(f, g, spat_adjust)
+        metadata_pan = g.profile
+        block_height, block_width = g.block_shapes[0]
+        nodata = next((value for value in (nodata_value, f.nodata, g.nodata) if value is not None), None)
+        metadata_pan.update(count = f.count, width = width, height = height, 
+                            transform = g.transform * Affine.translation(col_off, row_off), nodata = nodata)
+        pan_width, pan_height = g.width, g.height
+  
+    # Windows stay aligned to the panchromatic blocks when the grid starts on a block boundary
+    aligned = col_off % block_width == 0 and row_off % block_height == 0
+    tile_height = _tile_length(tile_size, block_height if aligned else 1, align, height)
+    tile_width = _tile_length(tile_size, block_width if aligned else 1, align, width)
+    metadata = dict(metadata_pan, pan_width = pan_width, pan_height = pan_height)
+    windows = list(_tile_windows(height, width, tile_height, tile_width))
+  
+    return metadata_pan, metadata, windows, col_off, row_off
+
+
+def _aligned_coefficients(m, pan, method, plan, workers = 1, executor = 'thread', resampling = 'cubic', 
+                          approx_stats = False, progress = None):
+    """ 
+    This function runs the first pass of a statistical method on the aligned grid (see substitution_coefficients()). 
+    With approx_stats, the statistics are computed from small windows spread evenly over the grid (see 
+    _sample_windows()).
+  
+    Inputs:
+    - plan: See _aligned_plan()
+  
+    """
+    metadata_pan, metadata, windows, col_off, row_off = plan
+    samples = [windows]
+    if approx_stats:
+        samples.insert(0, _sample_windows(metadata['height'], metadata['width'], _STATS_PIXELS))
+  
+    # The sample may miss a small overlap of the two images, which is then found by reading every window
+    for sample in samples:
+        tasks = ((m, pan, window, col_off, row_off, metadata, resampling) for window in sample)
+        moments = _gathered_moments(_aligned_tile_moments, tasks, len(sample), workers, executor, progress)
+        if moments is not None and moments[0] >= 2:
+            break
+  
+    return _substitution(method, moments)
+
+
+def _aligned_tiles(m, pan, plan, R, G, B, NIR, method, W, workers = 1, executor = 'thread', keep_pan = False, 
+                   resampling = 'cubic', windows = None, approx_stats = False, coefficients = None):
+    """ 
+    This function is the georeferenced version of pansharpen_tiles() (see spat_adjust).
+  
+    Inputs:
+    - plan: See _aligned_plan()
+    - Others: See pansharpen_tiles()
+  
+    Outputs:
+    - metadata_pan, tiles: See pansharpen_tiles()
+  
+    """
+    metadata_pan, metadata, grid_windows, col_off, row_off = plan
+    if method in STATISTICAL_METHODS and coefficients is None:
+        coefficients = _aligned_coefficients(m, pan, method, plan, workers, executor, resampling, approx_stats)
+  
+    tasks = ((m, pan, window, col_off, row_off, metadata, R, G, B, NIR, method, W, resampling, coefficients, keep_pan) 
+             for window in (grid_windows if windows is None else windows))
+  
+    return metadata_pan, _ordered_map(_sharpen_aligned_tile, tasks, workers, executor)
+
+
+
+#############
+
+# Statistical methods. Gram-Schmidt, PCA and IHS are component substitution methods: an intensity I = weights . ms + 
+# offset is computed from the resampled multispectral bands, and every band receives gains * (P - I), where P is the 
+# panchromatic band matched to the mean and standard deviation of I. The weights, gains and histogram match depend on 
+# the statistics of the whole scene, so they run in two passes: the first pass accumulates the means and the 
+# covariance matrix of the multispectral and panchromatic bands window by window (the partial statistics of the 
+# windows are merged with the parallel algorithm of Chan et al., so that the windows can be processed by any number of 
+# workers in any order), and the second pass applies the transform to every window like the pixel-wise methods. Only 
+# a (bands + 1) x (bands + 1) matrix is held between the passes.
+#   - ihs: I is the mean of the bands and the gains are 1 (generalized IHS, for any number of bands)
+#   - pca: I is the first principal component of the bands and the gains are its eigenvector
+#   - gram_schmidt: I is the linear regression of the panchromatic band on the bands and the gains are the covariances 
+#     of the bands with I divided by its variance (the adaptive Gram-Schmidt of Aiazzi et al., which is equal to the 
+#     Gram-Schmidt orthogonalization with I as the first component)
+
+#############
+
+STATISTICAL_METHODS = ('gram_schmidt', 'pca', 'ihs')
+_STATS_PIXELS = 1024 * 1024  # Pixels read by the first pass when approx_stats is True
+
+
+def _merge_moments(a, b):
+    """ 
+    This function merges the statistics (count, means, co-moment matrix) of two sets of pixels. None is an empty set.
+  
+    """
+    if a is None or a[0] == 0:
+        return b
+    if b is None or b[0] == 0:
+        return a
+    (count_a, mean_a, comoment_a), (count_b, mean_b, comoment_b) = a, b
+    count = count_a + count_b
+    delta = mean_b - mean_a
+  
+    return (count, mean_a + delta * count_b / count, 
+            comoment_a + comoment_b + np.outer(delta, delta) * count_a * count_b / count)
+
+
+def _gathered_moments(function, tasks, total, workers = 1, executor = 'thread', progress = None):
+    """ 
+    This function merges the statistics of windows computed by function(*task) on a pool of workers (see 
+    _ordered_map()), and calls progress(done / total) after every window (see substitution_coefficients()).
+  
+    """
+    moments = None
+    results = _ordered_map(function, tasks, workers, executor)
+    try:
+        for done, item in enumerate(results, 1):
+            moments = _merge_moments(moments, item)
+            if progress is not None:
+                progress(done / total)
+    finally:
+        results.close()  # Stops the workers when the pass is cancelled
+  
+    return moments
+
+
+def _moments(rescaled_ms, img_pan, nodata = (None, None), valid = None):
+    """ 
+    This function computes the statistics of a block, in float64 strips of rows.
+  
+    Inputs:
+    - rescaled_ms: Multispectral block resampled to the panchromatic resolution (bands, rows, columns)
+    - img_pan: Panchromatic block (rows, columns)
+    - nodata: Nodata values of the multispectral and panchromatic images. Pixels where any band is nodata are skipped
+    - valid: Mask of the pixels to be used (rows, columns). If None, every pixel is used
+  
+    Outputs:
+    - count: Number of pixels
+    - mean: Means of the multispectral bands and of the panchromatic band (the last one)
+    - comoment: Sums of the products of the deviations from the means (bands + 1, bands + 1)
+  
+    """
+    bands = rescaled_ms.shape[0]
+    ms_nodata, pan_nodata = nodata
+    moments = None
+    for start in range(0, img_pan.shape[0], _KERNEL_ROWS):
+        stop = min(start + _KERNEL_ROWS, img_pan.shape[0])
+        pixels = np.empty((bands + 1, stop - start, img_pan.shape[1]))
+        pixels[:bands] = rescaled_ms[:, start:stop]
+        pixels[bands] = img_pan[start:stop]
+        pixels = pixels.reshape(bands + 1, -1)
+  
+        keep = np.ones(pixels.shape[1], dtype = bool) if valid is None else valid[start:stop].ravel()
+        if ms_nodata is not None:
+            keep &= np.all(pixels[:bands] != ms_nodata, axis = 0)
+        if pan_nodata is not None:
+            keep &= pixels[bands] != pan_nodata
+        pixels = pixels[:, keep]
+        if pixels.shape[1] == 0:
+            continue
+  
+        mean = pixels.mean(axis = 1)
+        pixels -= mean[:, np.newaxis]
+        moments = _merge_moments(moments, (pixels.shape[1], mean, pixels @ pixels.T))
+  
+    return moments
+
+
+def _substitution(method, moments):
+    """ 
+    This function derives the transform of a statistical method from the statistics of the scene.
+  
+    Inputs:
+    - method: One of STATISTICAL_METHODS
+    - moments: Statistics of the scene (see _moments())
+  
+    Outputs:
+    - weights, offset: Intensity, I = weights . ms + offset
+    - gains: Gain of every band
+    - scale, shift: Histogram match of the panchromatic band to the intensity, P = scale * pan + shift
+  
+    """
+    if method not in STATISTICAL_METHODS:
+        raise ValueError(f"method must be one of {', '.join(STATISTICAL_METHODS)}")
+    if moments is None or moments[0] < 2:
+        raise ValueError(f'the {method} method needs valid pixels in both images')
+    count, mean, comoment = moments
+    covariance = comoment / (count - 1)
+    cov_ms, cov_ms_pan, var_pan = covariance[:-1, :-1], covariance[:-1, -1], covariance[-1, -1]
+    mean_ms, mean_pan = mean[:-1], mean[-1]
+  
+    if method == 'ihs':
+        weights = np.full(len(mean_ms), 1 / len(mean_ms))
+        offset = 0.0
+    elif method == 'pca':
+        weights = np.linalg.eigh(cov_ms)[1][:, -1]
+        if weights @ cov_ms_pan < 0:  # The component is oriented like the panchromatic band
+            weights = -weights
+        offset = -weights @ mean_ms
+    else:
+        weights = np.linalg.lstsq(cov_ms, cov_ms_pan, rcond = None)[0]
+        offset = mean_pan - weights @ mean_ms
+  
+    var_intensity = weights @ cov_ms @ weights
+    if var_intensity <= 0 or var_pan <= 0:
+        raise ValueError(f'the {method} method needs images that are not constant')
+    if method == 'ihs':
+        gains = np.ones(len(mean_ms))
+    elif method == 'pca':
+        gains = weights
+    else:
+        gains = cov_ms @ weights / var_intensity
+    scale = math.sqrt(var_intensity / var_pan)
+    shift = weights @ mean_ms + offset - scale * mean_pan
+  
+    return weights.tolist(), float(offset), gains.tolist(), scale, float(shift)
+
+
+def _tile_moments(m, pan, window, ms_to_pan_ratio, ms_period, nodata, ms_cache = None, resampling = 'cubic'):
+    """ 
+    This function computes the statistics of one window (first pass of the statistical methods).
+  
+    """
+    rescaled_ms, img_pan = _load_tile(m, pan, window, ms_to_pan_ratio, ms_period, ms_cache, resampling = resampling)
+    with accumulate('statistics', window.width * window.height):
+        return _moments(rescaled_ms, img_pan, nodata)
+
+
+def _overview_moments(m, pan, height, width, ms_to_pan_ratio, nodata):
+    """ 
+    This function computes approximate statistics from a subsampled read of both images (about _STATS_PIXELS pixels), 
+    which GDAL serves from their overviews when they have some.
+  
+    Inputs:
+    - m, pan: File paths of the multispectral and panchromatic images
+    - height, width: Size of the pansharpened image
+    - ms_to_pan_ratio: Multispectral to panchromatic cell size ratio
+    - nodata: See _moments()
+  
+    """
+    factor = max(1, math.ceil(math.sqrt(height * width / _STATS_PIXELS)))
+    shape = (-(-height // factor), -(-width // factor))
+    nearest = rasterio.enums.Resampling.nearest
+    with accumulate('read'), rasterio.open(m) as f, rasterio.open(pan) as g:
+        ms_window = rasterio.windows.Window(0, 0, width / ms_to_pan_ratio, height / ms_to_pan_ratio)
+        img_ms = f.read(window = ms_window, out_shape = (f.count,) + shape, resampling = nearest)
+        img_pan = g.read(1, window = rasterio.windows.Window(0, 0, width, height), out_shape = shape, 
+                         resampling = nearest)
+  
+    return _moments(img_ms, img_pan, nodata)
+
+
+@instrumented
+def substitution_coefficients(m, pan, method, tile_size = DEFAULT_TILE_SIZE, workers = 1, executor = 'thread', 
+                              cache = None, resampling = 'cubic', approx_stats = False, progress = None, 
+                              spat_adjust = None):
+    """ 
+    This function runs the first pass of a statistical method: it gathers the statistics of the multispectral bands 
+    (resampled to the panchromatic grid) and of the panchromatic band, window by window, and derives the transform that 
+    the second pass applies to every window. The result can be kept (e.g. in the sidecar of a pipeline product) and 
+    given back to pansharpen_tiles(), so that windows recomputed later use the same transform.
+  
+    Inputs:
+    - m, pan, tile_size, workers, executor, cache, resampling, approx_stats, spat_adjust: See pansharpen()
+    - method: One of STATISTICAL_METHODS
+    - progress: Function called as progress(fraction) after every window, with fraction between 0 and 1. The pass 
+      can be cancelled by raising an exception from it
+  
+    Outputs:
+    - coefficients: Tuple of (weights, offset, gains, scale, shift), see _substitution()
+  
+    """
+    if method not in STATISTICAL_METHODS:
+        raise ValueError(f"method must be one of {', '.join(STATISTICAL_METHODS)}")
+    resampling = resampling_name(resampling)
+    m, pan = _dataset_name(m), _dataset_name(pan)
+    if _aligns(spat_adjust):
+        plan = _aligned_plan(m, pan, spat_adjust, tile_size)
+        return _aligned_coefficients(m, pan, method, plan, workers, executor, resampling, approx_stats, progress)
+  
+    with rasterio.open(m) as f, rasterio.open(pan) as g:
+        metadata_ms = f.profile
+        metadata_pan = g.profile
+        block_height, block_width = g.block_shapes[0]
+  
+    ms_to_pan_ratio = metadata_ms['transform'][0] / metadata_pan['transform'][0]
+    period, ms_period = _ratio_period(ms_to_pan_ratio)
+    height, width = _output_extent(metadata_ms, metadata_pan, ms_to_pan_ratio)
+    nodata = (metadata_ms['nodata'], metadata_pan['nodata'])
+    if approx_stats:
+        with accumulate('statistics'):
+            moments = _overview_moments(m, pan, height, width, ms_to_pan_ratio, nodata)
+        if progress is not None:
+            progress(1)
+        return _substitution(method, moments)
+  
+    # A committed cache entry saves the resampling of the first pass (the second pass fills a missing entry)
+    cache = resolve_cache(cache)
+    ms_cache, cache_key = None, None
+    if cache is not None:
+        cache_key = cache.key(m, height, width, ms_to_pan_ratio, resampling)
+    if cache_key is not None and cache.get(cache_key) is not None:
+        ms_cache = cache.path(cache_key)
+  
+    tile_height = _tile_length(tile_size, block_height, period, height)
+    tile_width = _tile_length(tile_size, block_width, period, width)
+    windows = list(_tile_windows(height, width, tile_height, tile_width))
+    tasks = ((m, pan, window, ms_to_pan_ratio, ms_period, nodata, ms_cache, resampling) for window in windows)
   
-    return img_psh
\ No newline at end of file
+    return _substitution(method, _gathered_moments(_tile_moments, tasks, len(windows), workers, executor, progress))
@@ -1,4 +1,41 @@
-﻿class ToolValidator:
+﻿import os
+
+# Descriptions of the inputs, kept between validations: arcpy.da.Describe() is slow on network shares and the
+# parameters are validated again on every change
+_DESCRIPTIONS = {}
+
+
+def _describe(path):
+    # Catalog path, extension and existence of a raster. Only files found are kept, with their modification time, so a
+    # raster created, replaced or deleted since the last validation is described again
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        modified = None  # Missing, or not a file (e.g. a geodatabase raster)
+    cached = _DESCRIPTIONS.get(path)
+    if modified is not None and cached is not None and cached[0] == modified:
+        return cached[1]
+    try:
+        description = arcpy.da.Describe(path)
+        location = description['catalogPath']
+        result = {'exists': arcpy.Exists(location), 'extension': description['extension']}
+    except (OSError, RuntimeError):
+        result = {'exists': False, 'extension': None}
+    if modified is not None and result['exists']:
+        _DESCRIPTIONS[path] = (modified, result)
+    else:
+        _DESCRIPTIONS.pop(path, None)
+    return result
+
+
+def _input_rasters(parameter):
+    # File paths of a multivalue parameter (paths with spaces are quoted)
+    if not parameter.valueAsText:
+        return []
+    return [value.strip("'") for value in parameter.valueAsText.split(';') if value]
+
+
+class ToolValidator:
   # Class to add custom behavior and properties to the tool and tool parameters.
 
     def __init__(self):
@@ -14,10 +51,17 @@
         ################
         
         # Enable pyramids resampling algorithm parameter if the pyramids box is checked
+        # Enable the output raster for a single input, and the output folder and parallel processes for several 
+        # inputs or an input folder
         
         # Parameters:
+        # -self.params[0]: File paths of the input rasters
+        # -self.params[1]: File path of the output raster
         # -self.params[4]: Pyramids checkbox
         # -self.params[5]: Algorithm for pyramids generation
+        # -self.params[7]: Input folder
+        # -self.params[8]: Output folder
+        # -self.params[9]: Number of parallel processes
         
         ################
         
@@ -26,6 +70,11 @@
         else:
             self.params[5].enabled = False
         
+        batch = len(_input_rasters(self.params[0])) > 1 or bool(self.params[7].valueAsText)
+        self.params[1].enabled = not batch
+        self.params[8].enabled = batch
+        self.params[9].enabled = batch
+        
         return
 
     def updateMessages(self):
@@ -35,36 +84,67 @@
         # Display error messages when the parameter values are different from what is expected
         
         # Parameters:
-        # -self.params[0]: File path of the input raster
+        # -self.params[0]: File paths of the input rasters
         # -self.params[1]: File path of the output raster
         # -self.params[2]: The new cell size
         # -self.params[5]: Algorithm for pyramids generation
+        # -self.params[7]: Input folder
+        # -self.params[8]: Output folder
+        # -self.params[9]: Number of parallel processes
         
         ################
     
-    
-        # Check that the input exists
-        location = arcpy.da.Describe(self.params[0])['catalogPath']
-        if not arcpy.Exists(location):
-            self.params[0].setErrorMessage('The input raster does not exist')
-            
-        # Check the raster extension
-        if arcpy.da.Describe(self.params[0])['extension'] != 'tif':
-            self.params[0].setErrorMessage('The input is not a GTiff file')
+        inputs = _input_rasters(self.params[0])
+        folder = self.params[7].valueAsText
+        
+        # Check that the inputs exist and are GTiff files (each input is described once, see _describe())
+        for path in inputs:
+            description = _describe(path)
+            if not description['exists']:
+                self.params[0].setErrorMessage('The input raster %s does not exist' % path)
+                break
+            if description['extension'] != 'tif':
+                self.params[0].setErrorMessage('The input %s is not a GTiff file' % path)
+                break
+        
+        # At least one input raster or an input folder is needed
+        if not inputs and not folder and (self.params[0].altered or self.params[7].altered):
+            self.params[0].setErrorMessage('Select input rasters or an input folder')
             
         # The output must be a tif and, thus, saved outside a geodatabase
-        if self.params[1].altered:
-            if self.params[1].valueAsText[-4:] != '.tif':
-                self.params[1].setErrorMessage('The output is not a GTiff file')  
-            if '.gdb' in self.params[1].valueAsText:
-                self.params[1].setErrorMessage('The output file cannot be saved in a GDB')     
+        if self.params[1].enabled:
+            if self.params[1].altered:
+                if self.params[1].valueAsText[-4:] != '.tif':
+                    self.params[1].setErrorMessage('The output is not a GTiff file')  
+                if '.gdb' in self.params[1].valueAsText:
+                    self.params[1].setErrorMessage('The output file cannot be saved in a GDB')
+            elif inputs:
+                self.params[1].setIDMessage('ERROR', 735)
+        
+        # Several inputs are written to an output folder (outside a geodatabase), under their own names
+        if self.params[8].enabled:
+            output_folder = self.params[8].valueAsText
+            if not output_folder:
+                self.params[8].setIDMessage('ERROR', 735)
+            elif '.gdb' in output_folder:
+                self.params[8].setErrorMessage('The output folder cannot be a GDB')
+            else:
+                input_folders = [os.path.dirname(path) for path in inputs] + ([folder] if folder else [])
+                if any(os.path.normcase(os.path.abspath(path)) == os.path.normcase(os.path.abspath(output_folder)) 
+                       for path in input_folders):
+                    self.params[8].setErrorMessage('The output folder must differ from the folders of the inputs')
            
         # Cell size must be a positive number
         if self.params[2].altered:
             if self.params[2].value <= 0:
                 self.params[2].setErrorMessage('Zero or negative cell size value is invalid')
         
+        # The number of parallel processes must be positive
+        if self.params[9].enabled and self.params[9].value is not None:
+            if self.params[9].value < 1:
+                self.params[9].setErrorMessage('The number of parallel processes must be at least 1')
+        
         # Optional parameter (Pyramids resampling algorithm) behaves as a required parameter when enabled 
         self.params[5].setIDMessage('WARNING', 530)      
         
-        return
\ No newline at end of file
+        return
@@ -0,0 +1,370 @@
+"""
+Batch Processing - Runs pansharpening and resizing jobs listed in a manifest, intended to be used with
+resolution_changing_code.py file in shared directory
+
+Script Contents:
+    - Read a manifest (CSV or JSON) of jobs, or list the resize jobs of a folder or list of rasters (the Resize tool of
+      the ArcGIS toolbox runs several inputs this way)
+    - Run the jobs concurrently under a worker and memory budget, skipping outputs that are already up to date
+    - Write a result log (one JSON line per job, with its timings)
+    - Command line entry point
+
+Every job is a dictionary with the following keys (only the paths are required):
+    - task: "pansharpen" [default] or "resize"
+    - pan, ms, output: File paths of the panchromatic and multispectral inputs and of the output (pansharpen). ms may
+      list several single-band files, separated by ";" in a CSV manifest or as a list in a JSON manifest
+    - input, output, res: File paths of the input and output and new cell size (resize)
+    - method: "gdal" [default], "simple_mean", "simple_brovey", "esri", "brovey", "gram_schmidt", "pca" or "ihs"
+      (pansharpen)
+    - r, g, b, nir, w: Band numbers of the red, green, blue and near-infrared bands and brovey weight (pansharpen)
+    - resampling: Resampling algorithm of the pansharpening or of the resizing
+    - stack, statistics: true/false
+    - approx_stats: true/false (pansharpen). The statistical methods (gram_schmidt, pca, ihs) take their statistics
+      from a subsampled read of the inputs instead of a first pass over the whole scene
+    - incremental: true/false (pansharpen). The output records checksums of its inputs, and when the inputs change
+      later only the windows under the changes are recomputed (see update_pipeline())
+    - pyramids: Resampling algorithm of the pyramids (no pyramids if empty)
+    - output_profile: "gtiff" or "cog" (see output_profiles.py)
+
+Example:
+    python batch_processing.py scenes.csv --workers 4 --memory 8192 --log scenes_log.jsonl
+"""
+
+#####################################################################################################################
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from lazy_imports import lazy_import
+
+rio = lazy_import("rasterio")
+
+#####################################################################################################################
+
+_TRUE = ("1", "true", "yes", "y")
+_BOOLEAN_KEYS = ("stack", "statistics", "incremental", "approx_stats")
+_BAND_KEYS = ("r", "g", "b", "nir")
+_TILE_SIZE = 1024  # Window size of the pansharpening jobs (see pansharpen_pipeline())
+_RASTER_EXTENSIONS = (".tif", ".tiff")
+
+
+def load_manifest(manifest):
+    """
+    This function reads the jobs of a manifest.
+
+    Inputs:
+    - manifest: File path of a CSV file (one job per row, with a header) or a JSON file (a list of jobs, or a
+        dictionary with a "jobs" list)
+
+    Outputs:
+    - jobs: List of job dictionaries, with an "id" (the row number, if not given) and relative paths resolved from
+        the manifest directory. The ids must be unique, since the report of run_batch() is keyed on them
+
+    """
+    with open(manifest, newline="") as f:
+        if manifest.lower().endswith(".json"):
+            rows = json.load(f)
+            rows = rows["jobs"] if isinstance(rows, dict) else rows
+        else:
+            rows = list(csv.DictReader(f))
+
+    base = os.path.dirname(os.path.abspath(manifest))
+    jobs, ids = [], {}
+    for number, row in enumerate(rows, 1):
+        job = {key.strip().lower(): value for key, value in row.items() if value not in (None, "")}
+        job.setdefault("id", str(number))
+        if str(job["id"]) in ids:
+            raise ValueError(f"jobs {ids[str(job['id'])]} and {number} of {manifest} have the same id {job['id']!r}")
+        ids[str(job["id"])] = number
+        job.setdefault("task", "pansharpen")
+        for key in ("pan", "input", "output"):
+            if key in job:
+                job[key] = os.path.join(base, os.path.expanduser(job[key]))
+        if "ms" in job:
+            names = job["ms"].split(";") if isinstance(job["ms"], str) else job["ms"]
+            names = [os.path.join(base, os.path.expanduser(name.strip())) for name in names]
+            job["ms"] = names[0] if len(names) == 1 else names
+        for key in _BOOLEAN_KEYS:
+            job[key] = str(job.get(key, "")).lower() in _TRUE
+        jobs.append(job)
+
+    return jobs
+
+
+def folder_rasters(folder):
+    """
+    This function lists the GeoTIFF files of a folder (not of its subfolders), sorted by name.
+
+    """
+    names = sorted(name for name in os.listdir(folder) if name.lower().endswith(_RASTER_EXTENSIONS))
+    return [os.path.join(folder, name) for name in names]
+
+
+def resize_jobs(inputs, output_folder, res, resampling="nearest", statistics=False, pyramids=None, output_profile=None):
+    """
+    This function lists the jobs that resize several rasters to the same cell size, to be run by run_batch().
+
+    Inputs:
+    - inputs: List of file paths of rasters, or of folders whose GeoTIFF files are all resized (see folder_rasters())
+    - output_folder: Folder of the resized rasters, which keep the file names of the inputs
+    - res, resampling, statistics, pyramids, output_profile: See the keys of a resize job (load_manifest())
+
+    Outputs:
+    - jobs: List of job dictionaries, one per raster
+
+    """
+    paths = []
+    for path in inputs:
+        paths.extend(folder_rasters(path) if os.path.isdir(path) else [path])
+
+    jobs, outputs = [], set()
+    for number, path in enumerate(paths, 1):
+        output = os.path.join(output_folder, os.path.basename(path))
+        if os.path.abspath(output) == os.path.abspath(path):
+            raise ValueError(f"{path} would be overwritten: the output folder must differ from the input folders")
+        if output in outputs:
+            raise ValueError(f"several inputs are named {os.path.basename(path)}: they would have the same output")
+        outputs.add(output)
+        job = {"id": str(number), "task": "resize", "input": path, "output": output, "res": res, "statistics": statistics}
+        for key, value in (("resampling", resampling), ("pyramids", pyramids), ("output_profile", output_profile)):
+            if value:
+                job[key] = value
+        jobs.append(job)
+
+    return jobs
+
+
+def _inputs(job):
+    if job["task"] == "resize":
+        return [job["input"]]
+    return [job["pan"]] + (job["ms"] if isinstance(job["ms"], list) else [job["ms"]])
+
+
+def up_to_date(job):
+    """
+    This function checks if the output of a job exists and is newer than all its inputs.
+
+    """
+    output = job["output"]
+    if job.get("stack") and job["task"] == "pansharpen":
+        output = _stacked_name(output)
+    if not os.path.exists(output):
+        return False
+
+    return os.path.getmtime(output) >= max(os.path.getmtime(path) for path in _inputs(job))
+
+
+def _stacked_name(output):
+    return f"{os.path.splitext(output)[0]}_stacked.tif"
+
+
+def job_memory(job, workers=1):
+    """
+    This function estimates the peak memory (in bytes) of a job: the windows in flight in its pipeline, each holding
+    the resampled multispectral bands, the panchromatic band and the float32 buffers of the kernels.
+
+    Inputs:
+    - job: Job dictionary
+    - workers: Number of threads of the job
+
+    """
+    if job["task"] == "resize":
+        with rio.open(job["input"]) as src:
+            count = src.count
+    elif isinstance(job["ms"], list):
+        count = len(job["ms"])
+    else:
+        with rio.open(job["ms"]) as src:
+            count = src.count
+    window = _TILE_SIZE * _TILE_SIZE * 4  # float32 pixels
+    in_flight = 2 * workers + 1
+
+    return in_flight * (2 * count + 3) * window
+
+
+def run_job(job, workers=1, cache_mb=None):
+    """
+    This function runs one job.
+
+    Inputs:
+    - job: Job dictionary
+    - workers: Number of threads of the job
+    - cache_mb: Size of the GDAL block cache of the job, in megabytes
+
+    Outputs:
+    - output: File path of the product
+
+    """
+    if cache_mb:
+        os.environ["GDAL_CACHEMAX"] = str(int(cache_mb))
+    import resolution_changing_code  # Imported here so that the GDAL cache size applies to the job's process
+
+    pyramids = job.get("pyramids")
+    if job["task"] == "resize":
+        # The statistics are computed from the resized pixels as they are written (see resize())
+        resolution_changing_code.resize(
+            job["output"],
+            job["input"],
+            float(job["res"]),
+            job.get("resampling", "nearest"),
+            output_profile=job.get("output_profile"),
+            statistics=job["statistics"],
+        )
+        output = job["output"]
+        if pyramids:
+            resolution_changing_code.create_pyramids(output, pyramids, workers=workers)
+        return output
+
+    if job["task"] != "pansharpen":
+        raise ValueError("task must be 'pansharpen' or 'resize'")
+    output = _stacked_name(job["output"]) if job["stack"] else job["output"]
+    if job["incremental"] and os.path.exists(output) and os.path.exists(output + ".tiles.json"):
+        resolution_changing_code.update_pipeline(output, pan_name=job["pan"], spectral_names=job["ms"], workers=workers)
+        return output
+    bands = {key.upper(): int(job[key]) for key in _BAND_KEYS if key in job}
+    if "w" in job:
+        bands["W"] = float(job["w"])
+    return resolution_changing_code.pansharpen_pipeline(
+        job["pan"],
+        job["ms"],
+        output,
+        method=job.get("method", "gdal"),
+        stack=job["stack"],
+        statistics=job["statistics"],
+        pyramids=pyramids,
+        resampling=job.get("resampling"),
+        workers=workers,
+        output_profile=job.get("output_profile"),
+        incremental=job["incremental"],
+        approx_stats=job["approx_stats"],
+        **bands,
+    )
+
+
+def _timed_job(job, workers, cache_mb):
+    start = time.time()
+    cpu = time.process_time()
+    try:
+        run_job(job, workers, cache_mb)
+        status, error = "done", None
+    except Exception as exc:  # The error is logged and the other jobs go on
+        status, error = "failed", f"{type(exc).__name__}: {exc}"
+
+    return {
+        "id": job["id"],
+        "status": status,
+        "error": error,
+        "start": start,
+        "seconds": round(time.time() - start, 3),
+        "cpu_seconds": round(time.process_time() - cpu, 3),
+    }
+
+
+def run_batch(jobs, workers=1, memory_mb=None, log=None, force=False):
+    """
+    This function runs a list of jobs concurrently, in a pool of processes.
+
+    Inputs:
+    - jobs: List of job dictionaries (see load_manifest())
+    - workers: Number of CPU cores to be used in total
+    - memory_mb: Memory budget, in megabytes. Fewer jobs (or threads per job) are run at a time when their estimated
+        memory (see job_memory() and _job_slots()) would exceed it. If None, the budget is not limited
+    - log: File path of the result log (one JSON line per job, appended as jobs finish). If None, nothing is written
+    - force: if True, jobs are run even when their output is up to date
+
+    Outputs:
+    - results: List of job results (id, status, error, start, seconds, cpu_seconds), in the order of the jobs
+
+    """
+    results = {}
+    pending = []
+    for job in jobs:
+        if not force and up_to_date(job):
+            results[job["id"]] = {"id": job["id"], "status": "skipped", "error": None, "start": time.time(),
+                                  "seconds": 0.0, "cpu_seconds": 0.0}
+        else:
+            pending.append(job)
+
+    concurrent, threads = _job_slots(pending, workers, memory_mb)
+    cache_mb = memory_mb / (2 * concurrent) if memory_mb else None
+
+    log_file = open(log, "a") if log else None
+    try:
+        for result in results.values():
+            _log(log_file, result)
+        with ProcessPoolExecutor(max_workers=concurrent) as pool:
+            futures = [pool.submit(_timed_job, job, threads, cache_mb) for job in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                results[result["id"]] = result
+                _log(log_file, result)
+    finally:
+        if log_file:
+            log_file.close()
+
+    return [results[job["id"]] for job in jobs]
+
+
+def _job_slots(jobs, workers, memory_mb=None):
+    """
+    This function chooses how many jobs run side by side and how many threads each of them gets. Jobs run side by side
+    with one thread each when there are enough of them, and share the cores otherwise. With a memory budget, half of
+    it goes to the windows in flight of the jobs (see job_memory(), which grows with the threads of a job) and half to
+    their GDAL block caches: the pair that keeps the most cores busy within it is chosen, preferring more jobs.
+
+    Outputs:
+    - concurrent: Number of jobs run at a time
+    - threads: Number of threads of every job
+
+    """
+    concurrent = max(1, min(workers, len(jobs)))
+    if not (memory_mb and jobs):
+        return concurrent, max(1, workers // concurrent)
+
+    budget = memory_mb * 2**20 / 2
+    largest = max(jobs, key=job_memory)
+    best = (1, 1)
+    for count in range(concurrent, 0, -1):
+        threads = max(1, workers // count)
+        while threads > 1 and count * job_memory(largest, threads) > budget:
+            threads -= 1
+        if count * job_memory(largest, threads) <= budget and count * threads > best[0] * best[1]:
+            best = (count, threads)
+
+    return best
+
+
+def _log(log_file, result):
+    message = f"{result['id']}: {result['status']} ({result['seconds']} s)"
+    print(message + (f" {result['error']}" if result["error"] else ""))
+    if log_file:
+        log_file.write(json.dumps(result) + "\n")
+        log_file.flush()
+
+
+def main(argv=None):
+    """
+    Command line entry point. Returns 1 if any job failed, 0 otherwise.
+
+    """
+    parser = argparse.ArgumentParser(description="Run the pansharpening and resizing jobs of a manifest")
+    parser.add_argument("manifest", help="CSV or JSON file listing the jobs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="CPU cores to be used (all by default)")
+    parser.add_argument("--memory", type=int, default=None, help="memory budget in megabytes")
+    parser.add_argument("--log", default=None, help="result log (JSON lines), next to the manifest by default")
+    parser.add_argument("--force", action="store_true", help="run jobs whose output is already up to date")
+    args = parser.parse_args(argv)
+
+    log = args.log or f"{os.path.splitext(args.manifest)[0]}_log.jsonl"
+    results = run_batch(load_manifest(args.manifest), args.workers, args.memory, log, args.force)
+
+    return 1 if any(result["status"] == "failed" for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
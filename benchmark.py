@@ -0,0 +1,475 @@
+"""
+Benchmark - Times the pansharpening, stacking, statistics, pyramid and resizing functions on synthetic rasters
+
+Script Contents:
+    - Generate synthetic georeferenced panchromatic/multispectral GeoTIFF pairs (several sizes, band counts and data
+      types)
+    - Run every method and resampling algorithm, each case in a fresh process, recording its wall and CPU time, peak
+      memory (RSS) and bytes read and written, with the time spent in each stage (see instrumentation.py)
+    - Measure the import time of the tools in a fresh interpreter (start-up of the user interface and the ArcGIS tools)
+    - Save the results as JSON and compare two runs to spot regressions
+
+Example:
+    python benchmark.py --sizes 2048 8192 --dtypes uint8 uint16 float32 --imports --output before.json
+    python benchmark.py --sizes 2048 8192 --dtypes uint8 uint16 float32 --output after.json --compare before.json
+"""
+
+#####################################################################################################################
+
+import argparse
+import fnmatch
+import importlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+
+import instrumentation
+from instrumentation import io_counters, peak_rss
+from interpolation import RESAMPLINGS, gdal_name
+from Simple_Pansharpen import PANSHARPEN_METHODS, STATISTICAL_METHODS
+
+#####################################################################################################################
+
+GDAL_RESAMPLINGS = tuple(gdal_name(resampling) for resampling in RESAMPLINGS)
+PYRAMID_RESAMPLINGS = ("nearest", "average", "cubic", "gauss", "mode", "rms")
+RESAMPLING_METHOD = "simple_brovey"  # Pansharpening method timed with every interpolation (see interpolation.py)
+_RATIO = 4  # Multispectral to panchromatic cell size ratio of the synthetic pairs
+_PAN_CELL = 0.5  # Panchromatic cell size (m)
+_RESIZE_CELLS = (1, 2, 4, 10)  # Cell sizes of the multi-resolution resize cases (panchromatic cells)
+IMPORT_MODULES = ("resolution_changing_code", "Simple_Pansharpen", "batch_processing")
+BACKENDS = ("numpy", "cv2", "rasterio", "osgeo.gdal", "osgeo_utils.gdal_pansharpen")
+
+# Run by a fresh interpreter for every import measurement, so that nothing is imported beforehand
+_IMPORT_SCRIPT = """
+import json, sys, time
+from instrumentation import io_counters, peak_rss
+before = io_counters()
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+after = io_counters()
+print(json.dumps({{
+    "seconds": seconds,
+    "peak_rss": peak_rss(),
+    "bytes_read": after["rchar"] - before["rchar"],
+    "bytes_written": after["wchar"] - before["wchar"],
+    "loaded": [name for name in {backends!r} if name in sys.modules],
+}}))
+"""
+
+
+def make_pair(directory, size, bands=4, dtype="uint16", seed=0):
+    """
+    This function writes a synthetic panchromatic/multispectral pair: smooth random fields (so that compression and
+    resampling behave as on real scenes) on a UTM grid, with tiled GeoTIFFs.
+
+    Inputs:
+    - directory: Directory of the rasters
+    - size: Width and height of the panchromatic raster (pixels)
+    - bands: Number of multispectral bands
+    - dtype: Data type of both rasters (uint8, uint16, float32...)
+    - seed: Seed of the random fields
+
+    Outputs:
+    - pan_name, ms_name: File paths of the panchromatic and multispectral rasters
+
+    """
+    rng = np.random.default_rng(seed)
+    ms_size = size // _RATIO
+    profile = {
+        "driver": "GTiff",
+        "crs": "EPSG:32615",
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+        "dtype": dtype,
+    }
+    name = f"{size}_{bands}_{dtype}"
+    pan_name = os.path.join(directory, f"pan_{name}.tif")
+    ms_name = os.path.join(directory, f"ms_{name}.tif")
+
+    with rio.open(
+        pan_name, "w", width=size, height=size, count=1,
+        transform=from_origin(500000, 5000000, _PAN_CELL, _PAN_CELL), **profile
+    ) as dst:
+        dst.write(_field(rng, size, size, dtype), 1)
+    with rio.open(
+        ms_name, "w", width=ms_size, height=ms_size, count=bands,
+        transform=from_origin(500000, 5000000, _PAN_CELL * _RATIO, _PAN_CELL * _RATIO), **profile
+    ) as dst:
+        for band in range(1, bands + 1):
+            dst.write(_field(rng, ms_size, ms_size, dtype), band)
+
+    return pan_name, ms_name
+
+
+def make_sharpened(psh_name, pan_name, bands, seed=1):
+    """
+    This function writes a synthetic pansharpened raster: bands smooth random fields on the grid (and with the layout)
+    of a panchromatic raster of make_pair(), as stack_bands() expects.
+
+    """
+    rng = np.random.default_rng(seed)
+    with rio.open(pan_name) as src:
+        profile = src.profile
+    profile["count"] = bands
+    with rio.open(psh_name, "w", **profile) as dst:
+        for band in range(1, bands + 1):
+            dst.write(_field(rng, profile["height"], profile["width"], profile["dtype"]), band)
+
+    return psh_name
+
+
+def _field(rng, rows, columns, dtype):
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        high = min(np.iinfo(dtype).max, 4095)
+    else:
+        high = 1.0
+    coarse = rng.random((rows // 16 + 2, columns // 16 + 2))
+    smooth = np.kron(coarse, np.ones((16, 16)))[:rows, :columns]
+    return ((0.8 * smooth + 0.2 * rng.random((rows, columns))) * high).astype(dtype)
+
+
+#############
+
+# Every case runs in a new (spawned) process, so that its peak memory is not hidden by the cases before it. The inputs
+# are copied, and the module of the function imported, before the clock starts.
+
+#############
+
+def _case_pansharpen(pan, ms, out, method, tile_size=None, workers=1, approx_stats=False, resampling="cubic"):
+    from Simple_Pansharpen import pansharpen
+
+    pansharpen(
+        ms, pan, out, method=method, tile_size=tile_size, workers=workers, approx_stats=approx_stats, resampling=resampling
+    )
+
+
+def _case_wrapper(pan, ms, out, resampling, workers=1):
+    from resolution_changing_code import wrapper_pansharpen
+
+    wrapper_pansharpen(pan, out, ms, resampling=resampling, workers=workers)
+
+
+def _case_stack(pan, psh, out, vrt=False):
+    from resolution_changing_code import stack_bands
+
+    stack_bands(pan, psh, out, vrt=vrt)
+
+
+def _case_stats(raster, approx=False):
+    from resolution_changing_code import calculate_stats
+
+    calculate_stats(raster, approx=approx)
+
+
+def _case_pyramids(raster, resampling):
+    from resolution_changing_code import create_pyramids
+
+    create_pyramids(raster, resampling)
+
+
+def _case_resize(pan, ms, out, resampling, cells=None):
+    from resolution_changing_code import resize
+
+    if cells is None:
+        resize(out, pan, _PAN_CELL * 2, resampling)
+    elif cells == "separate":  # One resize() call (and input pass) per cell size
+        for cell in _RESIZE_CELLS:
+            resize(f"{out[:-4]}_{cell}.tif", pan, _PAN_CELL * cell, resampling)
+    else:
+        outs = [f"{out[:-4]}_{cell}.tif" for cell in _RESIZE_CELLS]
+        resize(outs, pan, [_PAN_CELL * cell for cell in _RESIZE_CELLS], resampling)
+
+
+_CASES = {
+    "pansharpen": _case_pansharpen,
+    "wrapper_pansharpen": _case_wrapper,
+    "stack_bands": _case_stack,
+    "calculate_stats": _case_stats,
+    "create_pyramids": _case_pyramids,
+    "resize": _case_resize,
+}
+
+
+def _run_case(function, kwargs, copy=None):
+    """
+    This function runs one case in the current process and measures it.
+
+    Inputs:
+    - function: Key of _CASES
+    - kwargs: Arguments of the case function
+    - copy: (source, destination) file paths copied before the clock starts, for cases that modify their input
+
+    Outputs:
+    - Dictionary of measures
+
+    """
+    importlib.import_module("Simple_Pansharpen" if function == "pansharpen" else "resolution_changing_code")
+    if copy:
+        shutil.copy(*copy)
+    instrumentation.reset()
+    rss_before = peak_rss()
+    io_before = io_counters()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    _CASES[function](**kwargs)
+    seconds = time.perf_counter() - start
+    io_after = io_counters()
+
+    return {
+        "seconds": seconds,
+        "cpu_seconds": time.process_time() - cpu,
+        "peak_rss": peak_rss(),
+        "rss_before": rss_before,
+        "bytes_read": io_after["rchar"] - io_before["rchar"],
+        "bytes_written": io_after["wchar"] - io_before["wchar"],
+        "disk_read": io_after["read_bytes"] - io_before["read_bytes"],
+        "disk_written": io_after["write_bytes"] - io_before["write_bytes"],
+        "stages": instrumentation.report()["stages"],
+    }
+
+
+def _cases(pan, ms, psh, scratch, workers):
+    """
+    This function lists the cases of one raster pair as (name, function, kwargs, copy) tuples. The stacking cases read
+    psh, a raster on the panchromatic grid written by make_sharpened() when one of them is selected.
+
+    """
+    out = os.path.join(scratch, "out.tif")
+    work = os.path.join(scratch, "work.tif")
+    cases = []
+    for method in PANSHARPEN_METHODS:
+        cases.append((f"pansharpen/{method}", "pansharpen", dict(pan=pan, ms=ms, out=out, method=method), None))
+        cases.append((
+            f"pansharpen/{method}/tiled",
+            "pansharpen",
+            dict(pan=pan, ms=ms, out=out, method=method, tile_size=1024, workers=workers),
+            None,
+        ))
+        if method in STATISTICAL_METHODS:
+            cases.append((
+                f"pansharpen/{method}/tiled/approx",
+                "pansharpen",
+                dict(pan=pan, ms=ms, out=out, method=method, tile_size=1024, workers=workers, approx_stats=True),
+                None,
+            ))
+    # The interpolations of the band-math methods: cv2 for most, the polyphase filter for cubic_spline
+    for resampling in RESAMPLINGS:
+        kwargs = dict(pan=pan, ms=ms, out=out, method=RESAMPLING_METHOD, resampling=resampling)
+        cases.append((f"pansharpen/{RESAMPLING_METHOD}/{resampling}", "pansharpen", kwargs, None))
+        cases.append((
+            f"pansharpen/{RESAMPLING_METHOD}/{resampling}/tiled",
+            "pansharpen",
+            dict(kwargs, tile_size=1024, workers=workers),
+            None,
+        ))
+    for resampling in GDAL_RESAMPLINGS:
+        cases.append((
+            f"wrapper_pansharpen/gdal/{resampling}",
+            "wrapper_pansharpen",
+            dict(pan=pan, ms=ms, out=out, resampling=resampling, workers=workers),
+            None,
+        ))
+        cases.append((f"resize/{resampling}", "resize", dict(pan=pan, ms=ms, out=out, resampling=resampling), None))
+        for cells in ("separate", "multi"):
+            cases.append((
+                f"resize/{resampling}/{cells}",
+                "resize",
+                dict(pan=pan, ms=ms, out=out, resampling=resampling, cells=cells),
+                None,
+            ))
+    cases.append(("stack_bands", "stack_bands", dict(pan=pan, psh=psh, out=out), None))
+    cases.append(("stack_bands/vrt", "stack_bands", dict(pan=pan, psh=psh, out=out[:-4] + ".vrt", vrt=True), None))
+    cases.append(("calculate_stats", "calculate_stats", dict(raster=work), (pan, work)))
+    cases.append(("calculate_stats/approx", "calculate_stats", dict(raster=work, approx=True), (pan, work)))
+    for resampling in PYRAMID_RESAMPLINGS:
+        cases.append((
+            f"create_pyramids/{resampling}", "create_pyramids", dict(raster=work, resampling=resampling), (pan, work)
+        ))
+
+    return cases
+
+
+def measure_import(module, repeat=1):
+    """
+    This function measures the start-up cost of a module: the time, memory and bytes read by its import in a fresh
+    interpreter, and the backends (see BACKENDS) it loaded.
+
+    Inputs:
+    - module: Name of the module (one of the tools, or a backend to see what deferring it saves)
+    - repeat: Number of imports (the fastest is kept, all are reported)
+
+    Outputs:
+    - Result dictionary, with the same measures as the other cases
+
+    """
+    result = {"case": f"import/{module}", "size": 0, "bands": 0, "dtype": "-", "runs": []}
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        for _ in range(repeat):
+            script = _IMPORT_SCRIPT.format(module=module, backends=BACKENDS)
+            process = subprocess.run([sys.executable, "-c", script], cwd=directory, capture_output=True, text=True)
+            if process.returncode:
+                raise RuntimeError(process.stderr.strip().splitlines()[-1])
+            result["runs"].append(json.loads(process.stdout))
+        result.update(min(result["runs"], key=lambda run: run["seconds"]))
+    except Exception as exc:  # e.g. GDAL Python bindings missing: recorded, the others go on
+        result["error"] = f"{type(exc).__name__}: {exc}"
+
+    return result
+
+
+def run_benchmark(
+    sizes, bands=(4,), dtypes=("uint8", "uint16", "float32"), repeat=1, workers=1, only=None, imports=False
+):
+    """
+    This function runs the benchmark.
+
+    Inputs:
+    - sizes: Panchromatic sizes (pixels) of the synthetic pairs
+    - bands: Numbers of multispectral bands
+    - dtypes: Data types
+    - repeat: Number of runs of every case (the fastest is kept, all are reported)
+    - workers: Number of workers of the cases that run in parallel
+    - only: Shell-style pattern selecting the cases by name (e.g. "pansharpen/*")
+    - imports: if True, the import time of the tools and of their backends is measured as well (import/<module>
+        cases, see measure_import())
+
+    Outputs:
+    - Dictionary with the environment of the run and one result per case
+
+    """
+    results = []
+    for module in IMPORT_MODULES + BACKENDS if imports else ():
+        if not only or fnmatch.fnmatch(f"import/{module}", only):
+            results.append(measure_import(module, repeat))
+            _print_result(results[-1])
+    scratch = tempfile.mkdtemp(prefix="pansharpen_benchmark_")
+    try:
+        for size in sizes:
+            for count in bands:
+                for dtype in dtypes:
+                    pan, ms = make_pair(scratch, size, count, dtype)
+                    psh = os.path.join(scratch, f"psh_{size}_{count}_{dtype}.tif")
+                    for name, function, kwargs, copy in _cases(pan, ms, psh, scratch, workers):
+                        if only and not fnmatch.fnmatch(name, only):
+                            continue
+                        if kwargs.get("psh") == psh and not os.path.exists(psh):
+                            make_sharpened(psh, pan, count)
+                        result = {"case": name, "size": size, "bands": count, "dtype": dtype, "runs": []}
+                        try:
+                            for _ in range(repeat):
+                                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                                    result["runs"].append(pool.submit(_run_case, function, kwargs, copy).result())
+                            best = min(result["runs"], key=lambda run: run["seconds"])
+                            result.update(best)
+                            result["pixels_per_second"] = size * size / best["seconds"]
+                        except Exception as exc:  # e.g. GDAL Python bindings missing: recorded, the others go on
+                            result["error"] = f"{type(exc).__name__}: {exc}"
+                        results.append(result)
+                        _print_result(result)
+                    for path in (pan, ms, psh):
+                        if os.path.exists(path):
+                            os.remove(path)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "rasterio": rio.__version__,
+        "gdal": rio.__gdal_version__,
+        "numpy": np.__version__,
+        "workers": workers,
+        "results": results,
+    }
+
+
+def _key(result):
+    return result["case"], result["size"], result["bands"], result["dtype"]
+
+
+def _print_result(result):
+    label = f"{result['case']:<36} {result['size']:>6} {result['bands']:>2} {result['dtype']:<8}"
+    if "error" in result:
+        print(f"{label} error: {result['error']}")
+    else:
+        print(f"{label} {result['seconds']:8.3f} s {result['peak_rss'] / 2**20:8.1f} MB "
+              f"{result['bytes_read'] / 2**20:8.1f} MB read {result['bytes_written'] / 2**20:8.1f} MB written")
+        if "loaded" in result:
+            print(f"{'':<36} loaded: {', '.join(result['loaded']) or 'no backend'}")
+
+
+def compare(previous, current, tolerance=0.1):
+    """
+    This function compares two benchmark runs case by case.
+
+    Inputs:
+    - previous, current: Benchmark dictionaries (see run_benchmark())
+    - tolerance: Relative slowdown (or memory growth) reported as a regression
+
+    Outputs:
+    - regressions: List of (case key, measure, previous value, current value) tuples
+
+    """
+    before = {_key(result): result for result in previous["results"] if "error" not in result}
+    regressions = []
+    for result in current["results"]:
+        old = before.get(_key(result))
+        if old is None or "error" in result:
+            continue
+        for measure in ("seconds", "peak_rss"):
+            if result[measure] > old[measure] * (1 + tolerance):
+                regressions.append((_key(result), measure, old[measure], result[measure]))
+
+    return regressions
+
+
+def main(argv=None):
+    """
+    Command line entry point. Returns 1 if the comparison found regressions, 0 otherwise.
+
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the pansharpening tools on synthetic rasters")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2048], help="panchromatic sizes (pixels)")
+    parser.add_argument("--bands", type=int, nargs="+", default=[4], help="numbers of multispectral bands")
+    parser.add_argument("--dtypes", nargs="+", default=["uint8", "uint16", "float32"], help="data types")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of every case")
+    parser.add_argument("--workers", type=int, default=1, help="workers of the parallel cases")
+    parser.add_argument("--only", default=None, help="pattern selecting the cases (e.g. 'pansharpen/*')")
+    parser.add_argument("--imports", action="store_true", help="measure the import time of the tools as well")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file of the results")
+    parser.add_argument("--compare", default=None, help="JSON file of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    current = run_benchmark(args.sizes, args.bands, args.dtypes, args.repeat, args.workers, args.only, args.imports)
+    with open(args.output, "w") as f:
+        json.dump(current, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), current, args.tolerance)
+        for key, measure, old, new in regressions:
+            print(f"REGRESSION {'/'.join(map(str, key))} {measure}: {old:.4g} -> {new:.4g}")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+"""
+Instrumentation - Measures where the time, memory and I/O of the pansharpening tools go
+
+Script Contents:
+    - measure(): records one call of a public function (wall time, CPU time, peak memory, bytes read and written,
+      pixels per second). Records are kept in a report, passed to the hooks and logged
+    - instrumented(): decorator applying measure() to a function
+    - accumulate(): adds the time, CPU time and bytes of an inner stage (reading, resampling, band math, writing...) to
+      running totals. It is cheap enough to be used for every window and works in worker threads
+    - report(), reset(), add_hook(), remove_hook()
+
+The records are logged at DEBUG level by the "pansharpening" logger. To send them to a metrics system:
+
+    import instrumentation
+    instrumentation.add_hook(lambda record: metrics.send(record["stage"], record["seconds"]))
+"""
+
+#####################################################################################################################
+
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import resource  # Unix only
+except ImportError:
+    resource = None
+
+#####################################################################################################################
+
+logger = logging.getLogger("pansharpening")
+
+_lock = threading.Lock()
+_local = threading.local()  # Stack of the calls being measured by each thread
+_MAX_RECORDS = 10000  # The oldest records are dropped first, so that long-running processes (e.g. the UI) stay bounded
+_records = deque(maxlen=_MAX_RECORDS)
+_totals = {}
+_hooks = []
+_PROC_IO = os.path.exists("/proc/self/io")  # The I/O counters are only read where the kernel provides them (Linux)
+
+
+def io_counters(thread=False):
+    """
+    This function returns the bytes read and written so far by the current process, or by the current thread (Linux
+    only, zeros elsewhere): rchar/wchar count every read and write call (page cache included), read_bytes/write_bytes
+    the storage traffic.
+
+    """
+    counters = dict.fromkeys(("rchar", "wchar", "read_bytes", "write_bytes"), 0)
+    if not _PROC_IO:
+        return counters
+    try:
+        with open("/proc/thread-self/io" if thread else "/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                if key in counters:
+                    counters[key] = int(value)
+    except OSError:
+        pass
+
+    return counters
+
+
+def peak_rss():
+    """
+    This function returns the peak resident set size of the current process, in bytes (the peak working set on
+    Windows, 0 where neither is available).
+
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    if sys.platform == "win32":
+        return _windows_peak_working_set()
+    return 0
+
+
+def _windows_peak_working_set():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    try:
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return 0
+    except OSError:
+        return 0
+
+    return counters.PeakWorkingSetSize
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def measure(stage):
+    """
+    This context manager records a call: its wall time, CPU time (of the whole process, worker threads included),
+    peak memory, bytes read and written and, if add_pixels() is called during it, the pixels processed per second.
+
+    Inputs:
+    - stage: Name of the call (e.g. the function name)
+
+    """
+    stack = _stack()
+    record = {"stage": stage, "parent": stack[-1]["stage"] if stack else None, "pixels": 0}
+    stack.append(record)
+    io_before = io_counters()
+    rss_before = peak_rss()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    try:
+        yield record
+        record["status"] = "done"
+    except BaseException as exc:
+        record["status"] = type(exc).__name__
+        raise
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        record["cpu_seconds"] = time.process_time() - cpu
+        io_after = io_counters()
+        record["bytes_read"] = io_after["rchar"] - io_before["rchar"]
+        record["bytes_written"] = io_after["wchar"] - io_before["wchar"]
+        record["peak_rss"] = peak_rss()
+        record["peak_rss_growth"] = record["peak_rss"] - rss_before
+        record["pixels_per_second"] = record["pixels"] / record["seconds"] if record["pixels"] else None
+        stack.pop()
+        _emit(record)
+
+
+def add_pixels(pixels):
+    """
+    This function adds processed pixels to the innermost call measured by the current thread.
+
+    """
+    stack = _stack()
+    if stack:
+        stack[-1]["pixels"] += int(pixels)
+
+
+def instrumented(function):
+    """
+    This decorator measures every call of a function (see measure()).
+
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with measure(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def accumulate(stage, pixels=0):
+    """
+    This context manager adds the wall time, CPU time and bytes read and written by the current thread during an inner
+    stage to the totals of that stage.
+
+    Inputs:
+    - stage: Name of the stage (e.g. "resample")
+    - pixels: Number of pixels processed by the stage
+
+    """
+    io_before = io_counters(thread=True)
+    cpu = time.thread_time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        cpu_seconds = time.thread_time() - cpu
+        io_after = io_counters(thread=True)
+        with _lock:
+            total = _totals.setdefault(
+                stage,
+                {"calls": 0, "seconds": 0.0, "cpu_seconds": 0.0, "bytes_read": 0, "bytes_written": 0, "pixels": 0},
+            )
+            total["calls"] += 1
+            total["seconds"] += seconds
+            total["cpu_seconds"] += cpu_seconds
+            total["bytes_read"] += io_after["rchar"] - io_before["rchar"]
+            total["bytes_written"] += io_after["wchar"] - io_before["wchar"]
+            total["pixels"] += int(pixels)
+
+
+def _emit(record):
+    with _lock:
+        _records.append(record)
+        hooks = list(_hooks)
+    logger.debug(
+        "%s: %.3f s (%.3f s CPU), %.1f MB peak, %d bytes read, %d bytes written, %d pixels",
+        record["stage"],
+        record["seconds"],
+        record["cpu_seconds"],
+        record["peak_rss"] / 2**20,
+        record["bytes_read"],
+        record["bytes_written"],
+        record["pixels"],
+    )
+    for hook in hooks:
+        hook(dict(record))
+
+
+def report():
+    """
+    This function returns what has been measured since the last reset().
+
+    Outputs:
+    - Dictionary with "calls" (list of the last _MAX_RECORDS records of measure(), in the order they finished) and
+      "stages" (totals of accumulate() per stage, with their pixels per second)
+
+    """
+    with _lock:
+        stages = {}
+        for stage, total in _totals.items():
+            stages[stage] = dict(total)
+            stages[stage]["pixels_per_second"] = total["pixels"] / total["seconds"] if total["pixels"] else None
+        return {"calls": [dict(record) for record in _records], "stages": stages}
+
+
+def reset():
+    """
+    This function clears the report.
+
+    """
+    with _lock:
+        _records.clear()
+        _totals.clear()
+
+
+def add_hook(hook):
+    """
+    This function registers a function called with every record of measure() (a dictionary, see report()).
+
+    """
+    with _lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """
+    This function unregisters a hook added by add_hook().
+
+    """
+    with _lock:
+        _hooks.remove(hook)
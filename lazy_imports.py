@@ -0,0 +1,59 @@
+"""
+Lazy Imports - Defers the import of the heavy backends (numpy, cv2, rasterio, GDAL) until they are first used
+
+Script Contents:
+    - lazy_import(): returns a stand-in for a module, which imports it on the first access to one of its attributes
+
+Importing rasterio, GDAL and cv2 takes most of the start-up time of the tools, and a path that only resizes never uses
+cv2 or the band-math methods. The modules of the tools therefore import their backends with lazy_import() and refer to
+them by module (rasterio.windows.Window rather than Window), so that each backend is loaded by the first function that
+needs it and the Tk window and the ArcGIS tools open straight away. benchmark.py --imports measures the start-up time.
+"""
+
+#####################################################################################################################
+
+import importlib
+import types
+
+#####################################################################################################################
+
+
+class _LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is not imported yet. An attribute that the module does not have is imported as one of
+    its submodules, so that rasterio.warp works without importing rasterio.warp first. Every attribute is kept on the
+    stand-in after its first access, which then costs the same as on the module itself.
+
+    """
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):  # Introspection (copy, pickle, help...) does not import the module
+            raise AttributeError(attr)
+        module = importlib.import_module(self.__name__)
+        try:
+            value = getattr(module, attr)
+        except AttributeError:
+            try:
+                value = importlib.import_module(f"{self.__name__}.{attr}")
+            except ModuleNotFoundError as exc:
+                if exc.name != f"{self.__name__}.{attr}":  # The submodule exists but one of its imports is missing
+                    raise
+                raise AttributeError(f"module {self.__name__!r} has no attribute {attr!r}") from None
+        setattr(self, attr, value)
+
+        return value
+
+
+def lazy_import(name):
+    """
+    This function returns a module to be imported when one of its attributes is first used. A stand-in is returned
+    even when the module is already imported, so that its submodules (rasterio.warp) are imported on first use too.
+
+    Inputs:
+    - name: Full name of the module (e.g. "osgeo.gdal")
+
+    Outputs:
+    - Module, or a stand-in that imports it
+
+    """
+    return _LazyModule(name)
@@ -0,0 +1,220 @@
+"""
+Output Profiles - Creation options shared by every function that writes a raster (pansharpen(), wrapper_pansharpen(),
+stack_bands(), resize() and pansharpen_pipeline())
+
+Script Contents:
+    - output_profile(): describes the layout of the products (tiling, compression, BigTIFF, Cloud-Optimized GeoTIFF)
+    - Functions translating a profile into rasterio and GDAL creation options
+    - staged_output(): writes Cloud-Optimized GeoTIFFs
+    - temporary_path(): creates the temporary files of a product (next to it, or in the temporary directory)
+
+A Cloud-Optimized GeoTIFF (COG) stores its overviews before the full-resolution data, so it cannot be written window by
+window. Writers that stream their output write a tiled GeoTIFF next to the destination instead, and GDAL's COG driver
+copies it (with its overviews, when it already has them) into the final product.
+"""
+
+#####################################################################################################################
+
+import os
+import tempfile
+from contextlib import contextmanager
+
+from lazy_imports import lazy_import
+
+np = lazy_import("numpy")
+rasterio = lazy_import("rasterio")
+
+#####################################################################################################################
+
+PREDICTOR_CODECS = ("DEFLATE", "ZSTD", "LZW", "LZMA")  # Codecs that benefit from a predictor
+
+
+def output_profile(
+    codec="DEFLATE",
+    level=None,
+    predictor=None,
+    blocksize=512,
+    bigtiff="IF_SAFER",
+    cog=False,
+    overview_resampling="nearest",
+):
+    """
+    This function creates an output profile.
+
+    Inputs:
+    - codec: Compression codec (DEFLATE [default], ZSTD, LZW, LZMA, JPEG, NONE...)
+    - level: Compression level of DEFLATE and ZSTD (GDAL's default if None)
+    - predictor: Predictor (1: none, 2: horizontal differencing, 3: floating point). If None, 2 is used for integers
+        and 3 for floats when the codec benefits from it
+    - blocksize: Size of the internal tiles (512 [default])
+    - bigtiff: Creation of BigTIFF files (IF_SAFER [default]: when the file may exceed 4 GB, YES, NO)
+    - cog: if True, the products are Cloud-Optimized GeoTIFFs with internal overviews placed before the data
+    - overview_resampling: Resampling algorithm of the COG overviews
+
+    Outputs:
+    - Dictionary describing the profile
+
+    """
+    return {
+        "codec": (codec or "NONE").upper(),
+        "level": level,
+        "predictor": predictor,
+        "blocksize": blocksize,
+        "bigtiff": bigtiff,
+        "cog": cog,
+        "overview_resampling": overview_resampling,
+    }
+
+
+def resolve_profile(profile):
+    """
+    This function accepts the different ways an output profile can be given to the writers.
+
+    Inputs:
+    - profile: None (the writer keeps its historical behaviour), "gtiff" (tiled, compressed GeoTIFF), "cog"
+        (Cloud-Optimized GeoTIFF) or a dictionary of output_profile() arguments
+
+    Outputs:
+    - Dictionary describing the profile, or None
+
+    """
+    if profile is None:
+        return None
+    if isinstance(profile, str):
+        if profile.lower() == "cog":
+            return output_profile(cog=True)
+        if profile.lower() in ("gtiff", "tiled"):
+            return output_profile()
+        raise ValueError("output profile must be 'gtiff', 'cog' or a dictionary of output_profile() arguments")
+
+    return output_profile(**profile)
+
+
+def _predictor(profile, dtype):
+    if profile["predictor"] is not None:
+        return profile["predictor"]
+    if profile["codec"] not in PREDICTOR_CODECS:
+        return None
+    return 3 if np.dtype(dtype).kind == "f" else 2
+
+
+def rasterio_options(profile, dtype):
+    """
+    This function translates a profile into the creation options of a GeoTIFF written by rasterio.
+
+    Inputs:
+    - profile: Dictionary describing the profile
+    - dtype: Data type of the raster
+
+    Outputs:
+    - Dictionary to be added to the rasterio profile of the raster
+
+    """
+    options = {
+        "driver": "GTiff",
+        "tiled": True,
+        "blockxsize": profile["blocksize"],
+        "blockysize": profile["blocksize"],
+        "compress": profile["codec"].lower(),
+        "bigtiff": profile["bigtiff"],
+    }
+    if _predictor(profile, dtype):
+        options["predictor"] = _predictor(profile, dtype)
+    if profile["level"] is not None:
+        options["zstd_level" if profile["codec"] == "ZSTD" else "zlevel"] = profile["level"]
+
+    return options
+
+
+def gdal_options(profile, dtype, driver="GTiff"):
+    """
+    This function translates a profile into the creation options of GDAL's GTiff or COG drivers.
+
+    Inputs:
+    - profile: Dictionary describing the profile
+    - dtype: Data type of the raster
+    - driver: "GTiff" or "COG"
+
+    Outputs:
+    - List of KEY=VALUE creation options
+
+    """
+    predictor = _predictor(profile, dtype)
+    if driver == "COG":
+        options = [
+            "BLOCKSIZE=%d" % profile["blocksize"],
+            "COMPRESS=%s" % profile["codec"],
+            "BIGTIFF=%s" % profile["bigtiff"],
+            "OVERVIEWS=AUTO",
+            "OVERVIEW_RESAMPLING=%s" % gdal_resampling(profile["overview_resampling"]),
+        ]
+        if profile["level"] is not None:
+            options.append("LEVEL=%d" % profile["level"])
+    else:
+        options = [
+            "TILED=YES",
+            "BLOCKXSIZE=%d" % profile["blocksize"],
+            "BLOCKYSIZE=%d" % profile["blocksize"],
+            "COMPRESS=%s" % profile["codec"],
+            "BIGTIFF=%s" % profile["bigtiff"],
+        ]
+        if profile["level"] is not None:
+            options.append("%s=%d" % ("ZSTD_LEVEL" if profile["codec"] == "ZSTD" else "ZLEVEL", profile["level"]))
+    if predictor:
+        options.append("PREDICTOR=%d" % predictor)
+
+    return options
+
+
+def gdal_resampling(resampling):
+    """
+    This function converts a rasterio resampling name (e.g. cubic_spline) into GDAL's (CUBICSPLINE).
+
+    """
+    return resampling.replace("_", "").upper()
+
+
+def temporary_path(dst_filename, suffix):
+    """
+    This function creates an empty temporary file for an intermediate product of dst_filename and returns its path. The
+    file is created next to dst_filename or, when dst_filename is not in a local directory (e.g. a /vsimem/ path), in
+    the temporary directory of the system.
+
+    """
+    dst_filename = os.fspath(dst_filename)
+    directory = os.path.dirname(os.path.abspath(dst_filename))
+    if dst_filename.startswith("/vsi") or not os.path.isdir(directory):
+        directory = None
+    handle, path = tempfile.mkstemp(suffix=suffix, dir=directory)
+    os.close(handle)
+
+    return path
+
+
+@contextmanager
+def staged_output(dst_filename, profile):
+    """
+    This context manager gives the file path a writer should write to. For Cloud-Optimized GeoTIFFs, it is a temporary
+    tiled GeoTIFF (see temporary_path()), which is copied into the final COG by GDAL's COG driver when the block exits
+    and removed in any case. Otherwise it is dst_filename itself.
+
+    Inputs:
+    - dst_filename: File path of the final product
+    - profile: Dictionary describing the profile, or None
+
+    """
+    if not (profile and profile["cog"]):
+        yield dst_filename
+        return
+
+    staging = temporary_path(dst_filename, ".tif")
+    try:
+        yield staging
+        with rasterio.open(staging) as src:
+            dtype = src.dtypes[0]
+        options = dict(option.split("=", 1) for option in gdal_options(profile, dtype, "COG"))
+        rasterio.shutil.copy(staging, dst_filename, driver="COG", **options)
+    finally:
+        for path in (staging, staging + ".aux.xml", staging + ".ovr"):
+            if os.path.exists(path):
+                os.remove(path)
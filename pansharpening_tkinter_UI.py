@@ -4,6 +4,7 @@ Pansharpening User Interface - Intended to be used with resolution_changing_code
 Script Contents:
     - Import Tkinter packages and pansharpening script
     - Create functions necessary to retrieve pansharpening parameters and run resolution_changing_code.py
+    - Run the queued jobs in a background thread, reporting their progress to the tool window
     - Create Tkinter widgets for the tool window and assign their location
     - Open tool window
 
@@ -16,6 +17,8 @@ Created by Erik Sauer and Diego Osorio
 #####################################################################################################################
 
 import os
+import queue
+import threading
 import tkinter as tk
 from tkinter import *
 from tkinter import messagebox
@@ -88,8 +91,8 @@ def browseoutFiles():
 
 def pansharpen_run():
     """
-    This function is used to retrieve functions from the resolution changing code and run them according to parameters
-    input in the interface window
+    This function is used to queue a job with the parameters input in the interface window. Jobs are run one after the
+    other by a background thread (see job_worker()), so the window stays responsive and several jobs can be queued
 
     Inputs:
     - HR: High resolution filepath used in the pansharpening function
@@ -98,26 +101,84 @@ def pansharpen_run():
     - simple_mean: Thomas Wang's Simple Mean script (True/False)
     - resampling: Selected resampling technique from dropdown menu
     """
-    resolution_changing_code.wrapper_pansharpen(
-        HR_dict[1], Output_dict[1], M_dict[1], simple_mean = mean_input,resampling=(resample_technique.get())
-    )
+    # Pansharpening, stacking, statistics and pyramids are all done in a single pass over the raster
     # Check if box is checked. If 1, run pre-built function. If 0, do not run
     if stack_bands.get() == 1:
-        stacked_output = f"{Output_dict[1].split('.')[0]}_stacked.tif"
-        resolution_changing_code.stack_bands(
-            pan_name=HR_dict[1], psh_names=Output_dict[1], dst_filename=stacked_output
-        )
-        if calc_statistics.get() == 1:
-            resolution_changing_code.calculate_stats(stacked_output)
-        if gen_pyramids.get() == 1:
-            resolution_changing_code.create_pyramids(stacked_output, resample_pyramids.get())
-        os.remove(Output_dict[1])
-    
+        output = f"{Output_dict[1].split('.')[0]}_stacked.tif"
     else:
-        if calc_statistics.get() == 1:
-            resolution_changing_code.calculate_stats(Output_dict[1])
-        if gen_pyramids.get() == 1:
-            resolution_changing_code.create_pyramids(Output_dict[1], resample_pyramids.get())
+        output = Output_dict[1]
+    job = dict(
+        pan_name=HR_dict[1],
+        spectral_names=M_dict[1],
+        dst_filename=output,
+        simple_mean=mean_input.get() == "True",
+        stack=stack_bands.get() == 1,
+        statistics=calc_statistics.get() == 1,
+        pyramids=resample_pyramids.get() if gen_pyramids.get() == 1 else None,
+        resampling=resample_technique.get() if resample_technique.get() != "Select an Option" else None,
+    )
+    job_queue.put(job)
+    status_text.set(f"Queued: {os.path.basename(output)} ({job_queue.qsize()} waiting)")
+
+def job_worker():
+    """
+    This function runs in a background thread. It takes the queued jobs one at a time and runs the pansharpening
+    pipeline, posting its progress to message_queue. The Tk widgets are only updated by poll_messages(), since Tk may
+    only be used from the main thread
+    """
+    while True:
+        job = job_queue.get()
+        cancel_event.clear()
+        name = os.path.basename(job["dst_filename"])
+
+        def progress(stage, fraction):
+            message_queue.put(("progress", name, stage, fraction))
+            return not cancel_event.is_set()
+
+        try:
+            resolution_changing_code.pansharpen_pipeline(progress=progress, **job)
+            message_queue.put(("done", name, None, 1))
+        except resolution_changing_code.PipelineCancelled:
+            message_queue.put(("cancelled", name, None, 0))
+        except Exception as error:
+            message_queue.put(("error", name, str(error), 0))
+
+def poll_messages():
+    """
+    This function shows the messages posted by job_worker() in the tool window. It runs every 100 ms on the Tk main loop
+    """
+    try:
+        while True:
+            kind, name, detail, fraction = message_queue.get_nowait()
+            progress_bar["value"] = 100 * fraction
+            if kind == "progress":
+                status_text.set(f"{name}: {detail} {100 * fraction:.0f}%")
+            elif kind == "done":
+                status_text.set(f"{name}: finished")
+            elif kind == "cancelled":
+                status_text.set(f"{name}: cancelled, partial outputs deleted")
+            else:
+                status_text.set(f"{name}: failed")
+                messagebox.showerror('Python Error', f'Error: {detail}')
+    except queue.Empty:
+        pass
+    window.after(100, poll_messages)
+
+def cancel_run():
+    """
+    This function stops the running job (its partial outputs are deleted) and removes the queued ones
+    """
+    while True:
+        try:
+            job_queue.get_nowait()
+        except queue.Empty:
+            break
+    cancel_event.set()
+
+# Jobs waiting to be run, messages posted by the background thread and cancellation request of the running job
+job_queue = queue.Queue()
+message_queue = queue.Queue()
+cancel_event = threading.Event()
     
 #####################################################################################################################
 
@@ -137,7 +198,7 @@ Widget creation, using the following methods:
 """
 # Create Window, set size and title
 window = Tk()
-window.geometry("275x205")
+window.geometry("275x265")
 window.title("Pansharpening Tool")
 
 # Simple Mean checkbox
@@ -260,7 +321,22 @@ ttk.Button(
     command=pansharpen_run,
 ).grid(column=1, row=9)
 
+# Cancel Button, stops the running job and empties the queue
+ttk.Button(
+    window,
+    text="Cancel",
+    command=cancel_run,
+).grid(column=0, row=9)
+
+# Progress bar and status of the running job
+progress_bar = ttk.Progressbar(window, length=250, maximum=100)
+progress_bar.grid(column=0, row=10, columnspan=2)
+status_text = tk.StringVar()
+ttk.Label(window, textvariable=status_text).grid(column=0, row=11, columnspan=3, sticky=tk.W)
+
 #####################################################################################################################
 
-# Create UI window
+# Start the background thread and the polling of its messages, then create UI window
+threading.Thread(target=job_worker, daemon=True).start()
+window.after(100, poll_messages)
 window.mainloop()
\ No newline at end of file
@@ -0,0 +1,218 @@
+"""
+Resample Cache - On-disk cache of multispectral images resampled to the panchromatic grid
+
+Script Contents:
+    - ResampledCache: memory-mapped .npy files keyed by the identity of the multispectral file (path, size,
+      modification time, and those of the files a VRT reads), the target grid and the interpolation, with a size limit
+      and least-recently-used eviction. Images that are not files (/vsimem/ paths, URLs...) are not cached
+
+Comparing pansharpening methods (or brovey weights) on the same scene pair repeats the cubic upsampling of the whole
+multispectral image on every run. With a cache, the first run stores the upsampled bands and the following runs map
+them from disk instead (see the cache argument of pansharpen()).
+"""
+
+#####################################################################################################################
+
+import hashlib
+import json
+import os
+import tempfile
+import xml.etree.ElementTree as ElementTree
+
+from lazy_imports import lazy_import
+
+np = lazy_import("numpy")
+
+#####################################################################################################################
+
+DEFAULT_CACHE_BYTES = 4 * 2**30  # Size limit of the default cache (4 GB)
+_CACHE_VERSION = 1  # Changed when the resampling changes, so that older entries are not used
+
+
+class ResampledCache:
+    """
+    Directory of resampled multispectral images, stored as band-sequential (bands, rows, columns) .npy files. An entry
+    is filled in a .partial file of its own and only becomes visible once it is complete, so interrupted runs never
+    leave a partial image behind and concurrent runs that miss the same entry do not overwrite each other's pixels.
+    Reading an entry refreshes its modification time, which orders the least-recently-used eviction.
+
+    Inputs:
+    - directory: Directory of the cache (PANSHARPEN_CACHE_DIR or a pansharpen_cache directory in the temporary
+        directory if None)
+    - max_bytes: Size limit of the cache. The least recently used entries are deleted when it is exceeded
+
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_CACHE_BYTES):
+        if directory is None:
+            directory = os.environ.get(
+                "PANSHARPEN_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pansharpen_cache")
+            )
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, ms_name, height, width, ms_to_pan_ratio, interpolation="cubic"):
+        """
+        This method returns the key of a resampled image.
+
+        Inputs:
+        - ms_name: File path of the multispectral image
+        - height, width: Size of the resampled image (the panchromatic grid it is cropped to)
+        - ms_to_pan_ratio: Multispectral to panchromatic cell size ratio
+        - interpolation: Interpolation of the resampling
+
+        Outputs:
+        - key: Key of the entry, or None when the image cannot be identified by its files (see _file_identity()), in
+            which case it is not cached
+
+        """
+        files = _file_identity(ms_name)
+        if files is None:
+            return None
+        identity = [_CACHE_VERSION, files, height, width, repr(float(ms_to_pan_ratio)), interpolation]
+        return hashlib.sha1(json.dumps(identity).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key):
+        """
+        This method returns a read-only memory map of an entry, or None if it is not in the cache.
+
+        """
+        path = self.path(key)
+        try:
+            image = np.load(path, mmap_mode="r")
+            os.utime(path)  # Most recently used
+        except (OSError, ValueError):
+            return None
+
+        return image
+
+    def create(self, key, shape, dtype):
+        """
+        This method creates an empty entry to be filled (by several workers, if needed) through the returned file path,
+        for example with np.load(path, mmap_mode="r+"). The file name is unique to this call, and the entry only
+        becomes visible after commit().
+
+        """
+        handle, partial = tempfile.mkstemp(prefix=key + ".", suffix=".partial", dir=self.directory)
+        os.close(handle)
+        try:
+            image = np.lib.format.open_memmap(partial, mode="w+", dtype=dtype, shape=shape)
+            del image  # Flush the header
+        except BaseException:
+            os.remove(partial)
+            raise
+
+        return partial
+
+    def commit(self, key, partial):
+        """
+        This method makes an entry created by create() visible and applies the size limit. When several runs fill the
+        same entry, the last one to commit replaces the others' complete image.
+
+        """
+        os.replace(partial, self.path(key))
+        self.evict()
+
+    def discard(self, partial):
+        """
+        This method deletes an entry created by create() that was not committed.
+
+        """
+        if os.path.exists(partial):
+            os.remove(partial)
+
+    def put(self, key, image):
+        """
+        This method stores an image (bands, rows, columns).
+
+        """
+        partial = self.create(key, image.shape, image.dtype)
+        try:
+            np.load(partial, mmap_mode="r+")[...] = image
+        except BaseException:
+            self.discard(partial)
+            raise
+        self.commit(key, partial)
+
+    def evict(self):
+        """
+        This method deletes the least recently used entries until the cache fits in max_bytes.
+
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:  # Still mapped by another process (Windows): kept
+                continue
+            total -= size
+
+    def clear(self):
+        """
+        This method deletes every entry, and the .partial files left by runs that were killed before they could
+        discard them.
+
+        """
+        for name in os.listdir(self.directory):
+            if name.endswith((".npy", ".partial")):
+                os.remove(os.path.join(self.directory, name))
+
+
+def _file_identity(name, parents=()):
+    """
+    This function identifies an image by its file: path, inode, size and modification time, followed for a VRT by the
+    identity of every file it reads (an edited source changes the image without touching the VRT).
+
+    Outputs:
+    - List of the identities, or None when the image or one of its sources is not a file on disk (a /vsimem/ or
+      /vsicurl/ path, a URL, a subdataset name...) or a VRT cannot be parsed
+
+    """
+    try:
+        stat = os.stat(name)
+    except (OSError, ValueError):
+        return None  # Not a path on disk (virtual file systems are not visible to os.stat)
+    location = os.path.abspath(name)
+    identity = [location, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+    if not name.lower().endswith(".vrt"):
+        return identity
+    if location in parents:
+        return None  # A VRT reading itself
+    try:
+        root = ElementTree.parse(name).getroot()
+    except (OSError, ElementTree.ParseError):
+        return None
+    for element in root.iter("SourceFilename"):
+        source = (element.text or "").strip()
+        if element.get("relativeToVRT") == "1":
+            source = os.path.join(os.path.dirname(location), source)
+        source_identity = _file_identity(source, parents + (location,))
+        if source_identity is None:
+            return None
+        identity.append(source_identity)
+
+    return identity
+
+
+def resolve_cache(cache):
+    """
+    This function accepts the different ways a cache can be given: None or False (no cache), True (the default cache)
+    or a ResampledCache.
+
+    """
+    if cache is True:
+        return ResampledCache()
+    return cache or None
@@ -1,13 +1,79 @@
-from osgeo_utils.gdal_pansharpen import gdal_pansharpen
-import rasterio as rio
-from rasterio.enums import Resampling
-from osgeo import gdal
 from Simple_Pansharpen import *
+from Simple_Pansharpen import _dataset_name, _ordered_map, _sample_windows, _store, _tile_length, _tile_windows
+from output_profiles import (
+    gdal_options,
+    gdal_resampling,
+    rasterio_options,
+    resolve_profile,
+    staged_output,
+    temporary_path,
+)
+from instrumentation import accumulate, add_pixels, instrumented
+from interpolation import gdal_name, resampling_halo, resampling_name
+from lazy_imports import lazy_import
+import hashlib
+import json
+import math
 import os
+import warnings
+from contextlib import ExitStack, contextmanager
+from xml.sax.saxutils import escape
 
+# The backends are imported when first used (see lazy_imports.py), so that resize() only loads GDAL
+gdal = lazy_import("osgeo.gdal")
+gdal_array = lazy_import("osgeo.gdal_array")
+osgeo_utils = lazy_import("osgeo_utils")
+rio = lazy_import("rasterio")
 
 
-# If user selects Simple Mean pansharpening, Thomas Wang's method is applied. Otherwise, gdal_pansharpen() is used
+
+# Pansharpening methods: the band-math methods of Thomas Wang's script (see Simple_Pansharpen.py), which use the band
+# roles R, G, B, NIR and the weight W, the statistical methods (gram_schmidt, pca and ihs, which use every band and the
+# statistics of the whole scene) and GDAL's weighted Brovey method (gdal_pansharpen()), which uses band_nums and
+# weights. simple_mean=True is kept as a shortcut for method="simple_mean"
+METHODS = PANSHARPEN_METHODS + ("gdal",)
+
+
+def _method(method, simple_mean=False):
+    if method is None:
+        return "simple_mean" if simple_mean == True else "gdal"
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {', '.join(METHODS)}")
+    return method
+
+
+def _band_math_nodata(nodata_value):
+    # False (the default of the wrappers) leaves the nodata value to the inputs, as None does for gdal_pansharpen()
+    return None if nodata_value is False else nodata_value
+
+
+def _spectral_list(spectral_names):
+    if isinstance(spectral_names, (list, tuple)):
+        return [_dataset_name(name) for name in spectral_names]
+    return [_dataset_name(spectral_names)]
+
+
+def _spectral_dataset(spectral_names, dst_filename):
+    """
+    This function gives the band-math methods a single multispectral dataset. A list of spectral files (e.g. the
+    single-band files of a Landsat or Sentinel-2 scene, on the same grid) is stacked into a temporary VRT next to
+    dst_filename (see temporary_path()), which references the files without copying their pixels.
+
+    Outputs:
+    - ms_name: File path of the multispectral dataset
+    - temporary: File path of the temporary VRT to be deleted by the caller, or None
+
+    """
+    names = _spectral_list(spectral_names)
+    if len(names) == 1:
+        return names[0], None
+
+    temporary = temporary_path(dst_filename, ".vrt")
+    _stack_vrt(names, temporary)
+    return temporary, temporary
+
+
+@instrumented
 def wrapper_pansharpen(
     pan_name,
     dst_filename,
@@ -19,6 +85,16 @@ def wrapper_pansharpen(
     spat_adjust=None,
     bitdepth=None,
     nodata_value=False,
+    tile_size=None,
+    workers=1,
+    output_profile=None,
+    method=None,
+    R=1,
+    G=2,
+    B=3,
+    NIR=4,
+    W=0.1,
+    approx_stats=False,
 ):
     """
     This function combines the pansharpening tool from GDAL and the simple_mean pansharpening developed by Thomas Wang, 
@@ -27,70 +103,231 @@ def wrapper_pansharpen(
 
     Inputs:
     - pan_name: File path of the higher resolution image to be used for pansharpening
-    - spectral_names: File path of the coarser image to undergo pansharpening
+    - spectral_names: File path of the coarser image to undergo pansharpening, or list of file paths of single-band
+        images (e.g. the bands of a Landsat or Sentinel-2 scene), which are used in that order without being copied.
+        Like pan_name, they may be VRTs (e.g. written by resize()), /vsimem/ paths or open rasterio or GDAL datasets
     - band_nums: bands in the coarser image to undergo pansharpening when not applied to the whole dataset
     - weights: Specify a weight for the computation of the pseudo panchromatic value. 
         There must be as many -w switches as input spectral bands
-    - dst_filename: File path of pansharpened dataset to be written to file
-    - resampling: Select a resampling algorithm (nearest, bilinear, cubic [default], cubicspline, lanczos, average)
+    - dst_filename: File path of pansharpened dataset to be written to file. With the gdal method, a .vrt file name
+        writes a pansharpening VRT instead, computed on the fly when it is read (e.g. by stack_bands())
+    - resampling: Select a resampling algorithm (nearest, bilinear, cubic [default], cubicspline, lanczos, average, or
+        the labels of the user interface, see interpolation.py). Used by both methods
     - spat_adjust: Select behavior when bands have not the same extent (union [default], intersection, none, nonewithoutwarning)
+        The band-math methods align the images in map coordinates with union or intersection and keep the default
+        grid (same upper-left corner) otherwise (see pansharpen())
     - bitdepth: Specify the bit depth of the panchromatic and spectral bands (e.g. 12). 
         If not specified, the NBITS metadata item from the panchromatic band will be used if it exists.
     - nodata_value: Specify nodata value for bands. Used for the resampling and pan-sharpening computation itself. 
-        If not set, deduced from the input bands, provided they have a consistent setting.
+        If not set, deduced from the input bands, provided they have a consistent setting. The band-math methods use it
+        as the nodata value of the pixels outside the images when they are aligned with spat_adjust (see pansharpen())
     - simple_mean: if True, pansharpening is performed using the pansharpen_simple_mean() function. 
-        Otherwise, gdal_pansharpen() is selected
+        Otherwise, gdal_pansharpen() is selected. Ignored when method is given
+    - tile_size: Size of the windows streamed through memory by the simple mean method (see pansharpen())
+    - workers: Number of CPU cores to be used. The simple mean method processes windows in a pool of threads and 
+        gdal_pansharpen() uses its own worker threads
+    - output_profile: Layout of the pansharpened dataset ("gtiff", "cog" or a dictionary, see output_profiles.py).
+        If None, the default layout of each method is kept
+    - method: Pansharpening method (simple_brovey, simple_mean, esri, brovey, gram_schmidt, pca, ihs or gdal, see
+        METHODS)
+    - R, G, B, NIR: Band numbers of the red, green, blue and near-infrared bands in the spectral image(s), used by the
+        band-math methods
+    - W: Weight value used by the brovey methods
+    - approx_stats: if True, the statistical methods compute their statistics from a subsampled read of the images
+        instead of a first pass over every window (see pansharpen())
+
+    Outputs:
+    - dst_filename: File path of the pansharpened dataset, to be given to the next step of a workflow
 
     """
-    if simple_mean == True:
-        pansharpen(spectral_names, pan_name, dst_filename, method="simple_mean")
-    else:
-        gdal_pansharpen(
-            pan_name=pan_name,
-            spectral_names=[spectral_names],
-            band_nums=band_nums,
-            weights=weights,
-            dst_filename=dst_filename,
-            resampling=resampling,
-            spat_adjust=spat_adjust,
-            bitdepth=bitdepth,
-            nodata_value=nodata_value,
-        )
+    method = _method(method, simple_mean)
+    pan_name = _dataset_name(pan_name)
+    output_profile = resolve_profile(output_profile)
+    if method != "gdal":
+        if dst_filename.lower().endswith(".vrt"):
+            raise ValueError("only the gdal method can write a VRT: use a /vsimem/ path to keep the output in memory")
+        ms_name, temporary = _spectral_dataset(spectral_names, dst_filename)
+        try:
+            pansharpen(
+                ms_name,
+                pan_name,
+                dst_filename,
+                R,
+                G,
+                B,
+                NIR,
+                method=method,
+                W=W,
+                tile_size=tile_size,
+                workers=workers,
+                output_profile=output_profile,
+                spat_adjust=spat_adjust,
+                resampling=resampling,
+                approx_stats=approx_stats,
+                nodata_value=_band_math_nodata(nodata_value),
+            )
+        finally:
+            if temporary:
+                os.remove(temporary)
+        return dst_filename
+
+    target, options = dst_filename, {}
+    if dst_filename.lower().endswith(".vrt"):
+        options = {"driver_name": "VRT"}
+    elif output_profile and output_profile["cog"]:
+        # gdal_pansharpen() cannot write a COG: the pansharpened VRT is translated into one
+        target = temporary_path(dst_filename, ".vrt")
+        options = {"driver_name": "VRT"}
+    elif output_profile:
+        with rio.open(_spectral_list(spectral_names)[0]) as src:
+            options = {"driver_name": "GTiff", "creation_options": gdal_options(output_profile, src.dtypes[0])}
+    osgeo_utils.gdal_pansharpen.gdal_pansharpen(
+        pan_name=pan_name,
+        spectral_names=_spectral_list(spectral_names),
+        band_nums=band_nums,
+        weights=weights,
+        dst_filename=target,
+        resampling=gdal_name(resampling),
+        spat_adjust=spat_adjust,
+        bitdepth=bitdepth,
+        nodata_value=nodata_value,
+        num_threads=workers if workers > 1 else None,
+        **options,
+    )
+    if target != dst_filename:
+        try:
+            _translate(dst_filename, target, output_profile)
+        finally:
+            os.remove(target)
 
     return dst_filename
 
 
 
-def stack_bands(pan_name, psh_names, dst_filename):
+@instrumented
+def stack_bands(pan_name, psh_names, dst_filename, vrt=False, output_profile=None):
     """
     This function stacks the panchromatic band and the pansharpened dataset into a new raster file.
     It has been adapted from P. Wiringa's personal communication (November 23, 2022)
 
+    The rasters are copied window by window, with windows aligned to the internal blocks (tiles or strips) of each
+    source, so only one window is held in memory at a time.
+
     Inputs:
     - pan_name: File path of the panchromatic band
-    - psh_names: File path of the pansharpened dataset
+    - psh_names: File path of the pansharpened dataset (e.g. a pansharpening VRT, see wrapper_pansharpen())
+    - dst_filename: File path of the stacked raster
+    - vrt: if True (or if dst_filename ends with .vrt), a virtual stack (VRT) referencing the two rasters is written
+        instead of a copy of their pixels
+    - output_profile: Layout of the stacked raster ("gtiff", "cog" or a dictionary, see output_profiles.py). If None,
+        the layout of the panchromatic band is kept
+
+    Outputs:
     - dst_filename: File path of the stacked raster
 
     """
-    rasters = [pan_name, psh_names]
+    rasters = [_dataset_name(pan_name), _dataset_name(psh_names)]
+
+    if vrt or dst_filename.lower().endswith(".vrt"):
+        _stack_vrt(rasters, dst_filename)
+        return dst_filename
 
     # Add up the number of bands to be stacked from the two input rasters
-    sum_bands = sum([rio.open(rast).meta["count"] for rast in rasters])
+    sum_bands = 0
+    for rast in rasters:
+        with rio.open(rast) as src:
+            sum_bands += src.count
 
-    # Read the metadata of the panchromatic band and add the total number of bands to be stacked
-    src = rio.open(rasters[0])
-    meta = src.meta
-    meta["count"] = sum_bands
+    # Read the profile of the panchromatic band (so the stack keeps its tiling) and add the total number of bands
+    with rio.open(rasters[0]) as src:
+        profile = src.profile
+    profile["count"] = sum_bands
+    output_profile = resolve_profile(output_profile)
+    if output_profile:
+        profile.update(rasterio_options(output_profile, profile["dtype"]))
 
-    with rio.open(dst_filename, "w", **meta) as _out:
+    with staged_output(dst_filename, output_profile) as path, rio.open(path, "w", **profile) as _out:
         out_band_index = 0  # Counter
         for raster in rasters:
             with rio.open(raster) as _in:
-                num_bands = _in.meta["count"]
-                for src_band in range(1, num_bands + 1):
-                    out_band_index += 1
+                indexes = list(range(out_band_index + 1, out_band_index + _in.count + 1))
+                height, width = min(_in.height, _out.height), min(_in.width, _out.width)
+                block_height, block_width = _in.block_shapes[0]
+                tile_height = _tile_length(DEFAULT_TILE_SIZE, block_height, 1, height)
+                tile_width = _tile_length(DEFAULT_TILE_SIZE, block_width, 1, width)
+                for window in _tile_windows(height, width, tile_height, tile_width):
+                    with accumulate("read"):
+                        block = _in.read(window=window)
+                    if block.dtype != _out.dtypes[0]:
+                        converted = np.empty(block.shape, dtype=_out.dtypes[0])
+                        _store(block.astype(np.float32), converted)
+                        block = converted
                     # Stacking
-                    _out.write(_in.read(src_band), out_band_index)
+                    with accumulate("write", window.width * window.height):
+                        _out.write(block, indexes=indexes, window=window)
+                    add_pixels(window.width * window.height)
+                out_band_index += _in.count
+
+    return dst_filename
+
+
+_GDAL_TYPE_NAMES = {
+    "uint8": "Byte",
+    "int8": "Int8",
+    "uint16": "UInt16",
+    "int16": "Int16",
+    "uint32": "UInt32",
+    "int32": "Int32",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+
+
+def _stack_vrt(rasters, dst_filename):
+    """
+    This function writes a virtual stack (VRT) of the bands of several rasters, on the grid of the first one.
+
+    Inputs:
+    - rasters: File paths of the rasters to be stacked
+    - dst_filename: File path of the VRT
+
+    """
+    with rio.open(rasters[0]) as src:
+        width, height = src.width, src.height
+        srs = src.crs.to_wkt() if src.crs else ""
+        geotransform = ", ".join(repr(value) for value in src.transform.to_gdal())
+
+    lines = ['<VRTDataset rasterXSize="%d" rasterYSize="%d">' % (width, height)]
+    if srs:
+        lines.append("  <SRS>%s</SRS>" % escape(srs))
+    lines.append("  <GeoTransform>%s</GeoTransform>" % geotransform)
+
+    out_band_index = 0  # Counter
+    for raster in rasters:
+        with rio.open(raster) as _in:
+            columns, rows = min(_in.width, width), min(_in.height, height)
+            block_height, block_width = _in.block_shapes[0]
+            for src_band in range(1, _in.count + 1):
+                out_band_index += 1
+                dtype = _GDAL_TYPE_NAMES[_in.dtypes[src_band - 1]]
+                lines.append('  <VRTRasterBand dataType="%s" band="%d">' % (dtype, out_band_index))
+                if _in.nodatavals[src_band - 1] is not None:
+                    lines.append("    <NoDataValue>%r</NoDataValue>" % _in.nodatavals[src_band - 1])
+                lines += [
+                    "    <SimpleSource>",
+                    '      <SourceFilename relativeToVRT="0">%s</SourceFilename>' % escape(os.path.abspath(raster)),
+                    "      <SourceBand>%d</SourceBand>" % src_band,
+                    '      <SourceProperties RasterXSize="%d" RasterYSize="%d" DataType="%s" BlockXSize="%d" '
+                    'BlockYSize="%d"/>' % (_in.width, _in.height, dtype, block_width, block_height),
+                    '      <SrcRect xOff="0" yOff="0" xSize="%d" ySize="%d"/>' % (columns, rows),
+                    '      <DstRect xOff="0" yOff="0" xSize="%d" ySize="%d"/>' % (columns, rows),
+                    "    </SimpleSource>",
+                    "  </VRTRasterBand>",
+                ]
+    lines.append("</VRTDataset>")
+
+    with open(dst_filename, "w") as vrt:
+        vrt.write("\n".join(lines) + "\n")
 
 
                     
@@ -104,7 +341,8 @@ def stack_bands(pan_name, psh_names, dst_filename):
 
 #############
 
-def create_pyramids(raster, resampling):
+@instrumented
+def create_pyramids(raster, resampling, min_size=256, workers=None, compress=None, external=False):
     """
     This function generates raster overviews for easy visualization.
     It has been adapted from Rasterio Overviews: https://rasterio.readthedocs.io/en/latest/topics/overviews.html
@@ -112,35 +350,412 @@ def create_pyramids(raster, resampling):
     Inputs:
     - raster: File path of pansharpened dataset
     - resampling: resampling algorithm
+    - min_size: Overview levels are added until the largest dimension of the coarsest one is at most min_size pixels
+    - workers: Number of threads used by GDAL to compute the overviews (all the CPU cores if None)
+    - compress: Compression codec of the overviews (e.g. DEFLATE, ZSTD, JPEG). If None, GDAL's default is used
+    - external: if True, the overviews are written to an external .ovr file next to the raster, which is opened
+        read-only (so read-only inputs can get overviews too)
+
+    Outputs:
+    - factors: Decimation factors of the overviews (empty if the raster is already smaller than min_size)
 
     """
-    factors = [2, 4, 8, 16]
-    dataset = rio.open(raster, "r+")
-    dataset.build_overviews(factors, Resampling[resampling])
-    dataset.update_tags(ns="rio_overview", resampling=resampling)
-    dataset.close()
+    with rio.open(raster) as src:
+        factors = _pyramid_factors(src.width, src.height, min_size)
+    if not factors:
+        return factors
+
+    config = {"GDAL_NUM_THREADS": str(workers) if workers else "ALL_CPUS", "BIGTIFF_OVERVIEW": "IF_SAFER"}
+    if compress:
+        config["COMPRESS_OVERVIEW"] = compress.upper()
+
+    if external:
+        # Only GDAL can build overviews of a dataset opened read-only, which it writes to an .ovr file
+        with _gdal_config(config), accumulate("build_overviews"):
+            dataset = gdal.Open(raster, gdal.GA_ReadOnly)
+            dataset.BuildOverviews(gdal_resampling(resampling), factors)
+            add_pixels(dataset.RasterXSize * dataset.RasterYSize)
+            dataset = None  # Flush and close
+        return factors
+
+    with rio.Env(**config), accumulate("build_overviews"):
+        dataset = rio.open(raster, "r+")
+        dataset.build_overviews(factors, rio.enums.Resampling[resampling])
+        dataset.update_tags(ns="rio_overview", resampling=resampling)
+        add_pixels(dataset.width * dataset.height)
+        dataset.close()
+
+    return factors
+
+
+def _pyramid_factors(width, height, min_size=256):
+    """
+    This function returns the decimation factors of the pyramids of a raster: powers of 2, until the coarsest level
+    fits in min_size x min_size pixels (the default of gdaladdo).
+
+    Inputs:
+    - width, height: Size of the raster
+    - min_size: Largest dimension of the coarsest level
+
+    """
+    factors = []
+    factor = 1
+    while -(-max(width, height) // factor) > min_size:
+        factor *= 2
+        factors.append(factor)
+
+    return factors
+
+
+@contextmanager
+def _gdal_config(options):
+    """
+    This context manager sets GDAL configuration options and restores their previous values on exit.
+
+    """
+    previous = {key: gdal.GetConfigOption(key) for key in options}
+    for key, value in options.items():
+        gdal.SetConfigOption(key, value)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            gdal.SetConfigOption(key, value)
 
     
     
 #############
 
-# gdal.Translate() was found to create statistics. This tool was wrapped up into another function that receives only one parameter. 
-# As gdal.Translate() generates band statistics only for the input raster, a temporary file is necessary as gdal.Translate requires 
-# an output/destination name and this cannot be the same input name. 
+# Band statistics are computed in place: the raster is streamed window by window (windows aligned to its internal blocks)
+# and the statistics of every window are merged into running totals, so no temporary copy of the raster is written.
+# They are stored as dataset metadata, in a PAM .aux.xml file next to the raster or, if requested, inside the GeoTIFF
+# tags, as GDAL's own statistics computation would. For very large rasters, the approximate mode only reads an overview
+# level with about a million pixels (or, without overviews, small windows spread evenly over the raster).
 
 #############
-    
-def calculate_stats(raster):
+
+_APPROX_PIXELS = 1024 * 1024  # Pixels read per band by the approximate mode
+
+
+@instrumented
+def calculate_stats(raster, approx=False, histogram=False, percentiles=None, internal=False, workers=1):
+    """
+    This function computes band statistics (minimum, maximum, mean, standard deviation) and, optionally, histograms and
+    percentiles, and stores them with the raster.
+
+    Inputs:
+    - raster: File path of the raster dataset
+    - approx: if True, the statistics are computed from an overview level or a sample of the raster
+    - histogram: if True, the default histogram (256 buckets) of every band is stored too. Rasters of 8 and 16-bit
+        integers get exact histograms from the same pass; other data types need a second pass over the raster, so it
+        is off by default
+    - percentiles: List of percentiles (0-100) to be stored as STATISTICS_P<percentile> metadata items
+    - internal: if True, the statistics are written into the GeoTIFF tags instead of a PAM .aux.xml file
+    - workers: Number of windows read in parallel
+
+    """
+    with rio.open(raster) as src:
+        level, sample = _approx_source(src) if approx else (None, False)
+
+    open_options = {} if level is None else {"overview_level": level}
+    with rio.open(raster, **open_options) as src:
+        block_height, block_width = src.block_shapes[0]
+        tile_height = _tile_length(DEFAULT_TILE_SIZE, block_height, 1, src.height)
+        tile_width = _tile_length(DEFAULT_TILE_SIZE, block_width, 1, src.width)
+        if sample:
+            windows = _sample_windows(src.height, src.width, _APPROX_PIXELS, block_height, block_width)
+        else:
+            windows = list(_tile_windows(src.height, src.width, tile_height, tile_width))
+        band_stats = _BandStatistics(src.count, src.dtypes[0], src.nodata, histogram or bool(percentiles))
+
+    tasks = [(raster, window, None, level) for window in windows]
+    for _, block in _ordered_map(_read_window, tasks, workers, "thread"):
+        with accumulate("statistics", block.shape[1] * block.shape[2]):
+            band_stats.update(block)
+        add_pixels(block.shape[1] * block.shape[2])
+    if (histogram or percentiles) and band_stats.counts is None:
+        band_stats.set_histogram_ranges()
+        for _, block in _ordered_map(_read_window, tasks, workers, "thread"):
+            with accumulate("histogram", block.shape[1] * block.shape[2]):
+                band_stats.update_histogram(block)
+
+    dataset = gdal.Open(raster, gdal.GA_Update if internal else gdal.GA_ReadOnly)
+    band_stats.write(dataset, histogram, percentiles, approx)
+    dataset = None  # Flush the statistics and close
+
+
+def _approx_source(src):
+    """
+    This function chooses what the approximate statistics of a raster are computed from.
+
+    Inputs:
+    - src: Open rasterio dataset
+
+    Outputs:
+    - level: Overview level to be read (None to read the raster itself)
+    - sample: True if only a sample of the windows of the raster should be read
+
+    """
+    if src.width * src.height <= _APPROX_PIXELS:
+        return None, False
+
+    factors = src.overviews(1)
+    if not factors:
+        return None, True
+
+    # The coarsest overview level that still has about a million pixels
+    level = 0
+    for index, factor in enumerate(factors):
+        if -(-src.width // factor) * -(-src.height // factor) >= _APPROX_PIXELS:
+            level = index
+
+    return level, False
+
+
+class _BandStatistics:
     """
-    This function uses gdal.Translate to specifically create band statistics.
+    Running statistics (minimum, maximum, mean and standard deviation) of the bands of a raster, updated block by block
+    and merged with the parallel algorithm of Chan et al., which stays accurate for billions of pixels. Rasters of 8 and
+    16-bit integers also get exact histograms (one bucket per value); for other data types, histograms are binned in a
+    second pass once the range of every band is known (see set_histogram_ranges()).
 
     Inputs:
-    raster: File path of the raster dataset
+    - count: Number of bands
+    - dtype: Data type of the raster
+    - nodata: Value excluded from the statistics (None to include every pixel)
+    - histogram: if False, no histogram is accumulated
 
     """
-    name = "stats.tif"  # Temporary file
-    gdal.Translate(destName=name, srcDS=raster, stats=True)
-    os.remove(name)
+
+    def __init__(self, count, dtype, nodata=None, histogram=True):
+        self.dtype = np.dtype(dtype)
+        self.nodata = nodata
+        self.pixels = np.zeros(count, dtype=np.int64)
+        self.n = np.zeros(count, dtype=np.int64)
+        self.mean = np.zeros(count)
+        self.m2 = np.zeros(count)
+        self.minimum = np.full(count, np.inf)
+        self.maximum = np.full(count, -np.inf)
+        self.offset = None
+        self.counts = None
+        self.ranges = None
+        self.buckets = None
+        if histogram and self.dtype.kind in "ui" and self.dtype.itemsize <= 2:
+            info = np.iinfo(self.dtype)
+            self.offset = int(info.min)
+            self.counts = np.zeros((count, int(info.max) - int(info.min) + 1), dtype=np.int64)
+
+    def _valid(self, values):
+        values = values.ravel()
+        if self.nodata is not None:
+            values = values[values != self.nodata]
+        if self.dtype.kind == "f":
+            values = values[~np.isnan(values)]
+        return values
+
+    def update(self, block):
+        """
+        This method adds a block of pixels (bands, rows, columns) to the statistics.
+
+        """
+        for band, values in enumerate(block):
+            self.pixels[band] += values.size
+            values = self._valid(values)
+            if values.size == 0:
+                continue
+
+            as_float = values.astype(np.float64)
+            mean = as_float.mean()
+            as_float -= mean
+            self._merge(band, values.size, mean, np.dot(as_float, as_float), values.min(), values.max())
+            if self.counts is not None:
+                self.counts[band] += np.bincount(
+                    values.astype(np.int64) - self.offset, minlength=self.counts.shape[1]
+                )
+
+    def set_histogram_ranges(self, buckets=256):
+        """
+        This method fixes the range of the histograms from the minimum and maximum accumulated so far, with GDAL's
+        convention: from minimum - 0.5 to maximum + 0.5 for integers, from minimum to maximum for floats.
+
+        """
+        margin = 0.5 if self.dtype.kind in "ui" else 0.0
+        self.ranges = []
+        for band in range(len(self.n)):
+            low, high = self.minimum[band] - margin, self.maximum[band] + margin
+            if not self.n[band]:
+                low, high = 0.0, 1.0
+            elif high <= low:
+                low, high = low - 0.5, high + 0.5
+            self.ranges.append((float(low), float(high)))
+        self.buckets = np.zeros((len(self.n), buckets), dtype=np.int64)
+
+    def update_histogram(self, block):
+        """
+        This method adds a block of pixels (bands, rows, columns) to the histograms binned by set_histogram_ranges().
+
+        """
+        for band, values in enumerate(block):
+            values = self._valid(values)
+            if values.size:
+                self.buckets[band] += np.histogram(values, self.buckets.shape[1], self.ranges[band])[0]
+
+    def merge(self, other):
+        """
+        This method adds the statistics of another set of blocks of the same raster.
+
+        """
+        self.pixels += other.pixels
+        for band in range(len(self.n)):
+            if other.n[band]:
+                self._merge(
+                    band, other.n[band], other.mean[band], other.m2[band], other.minimum[band], other.maximum[band]
+                )
+        if self.counts is not None and other.counts is not None:
+            self.counts += other.counts
+
+    def remove(self, other):
+        """
+        This method takes the statistics of a set of blocks out (e.g. blocks about to be overwritten). The minimum and
+        maximum are found again from the exact histograms, so it is only available for 8 and 16-bit integers.
+
+        """
+        if self.counts is None or other.counts is None:
+            raise ValueError("statistics can only be removed from exact histograms (8 and 16-bit integers)")
+        self.pixels -= other.pixels
+        self.counts -= other.counts
+        for band in range(len(self.n)):
+            rest = self.n[band] - other.n[band]
+            if other.n[band] and rest:
+                mean = (self.n[band] * self.mean[band] - other.n[band] * other.mean[band]) / rest
+                delta = other.mean[band] - mean
+                m2 = self.m2[band] - other.m2[band] - delta * delta * rest * other.n[band] / self.n[band]
+                self.m2[band] = max(m2, 0.0)
+                self.mean[band] = mean
+            elif not rest:
+                self.mean[band], self.m2[band] = 0.0, 0.0
+            self.n[band] = rest
+            used = np.flatnonzero(self.counts[band])
+            self.minimum[band] = used[0] + self.offset if used.size else np.inf
+            self.maximum[band] = used[-1] + self.offset if used.size else -np.inf
+
+    def state(self):
+        """
+        This method returns the running statistics as a dictionary that can be stored in JSON, or None when they cannot
+        be updated by remove() and merge().
+
+        """
+        if self.counts is None:
+            return None
+        first = self.counts.nonzero()[1].min() if self.counts.any() else 0
+        last = self.counts.nonzero()[1].max() + 1 if self.counts.any() else 0
+        return {
+            "dtype": self.dtype.name,
+            "nodata": self.nodata,
+            "pixels": self.pixels.tolist(),
+            "n": self.n.tolist(),
+            "mean": self.mean.tolist(),
+            "m2": self.m2.tolist(),
+            "first": int(first),
+            "counts": self.counts[:, first:last].tolist(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        This method restores running statistics saved by state().
+
+        """
+        band_stats = cls(len(state["n"]), state["dtype"], state["nodata"])
+        band_stats.pixels[:] = state["pixels"]
+        band_stats.n[:] = state["n"]
+        band_stats.mean[:] = state["mean"]
+        band_stats.m2[:] = state["m2"]
+        counts = np.array(state["counts"], dtype=np.int64).reshape(len(state["n"]), -1)
+        band_stats.counts[:, state["first"] : state["first"] + counts.shape[1]] = counts
+        for band in range(len(band_stats.n)):
+            used = np.flatnonzero(band_stats.counts[band])
+            if used.size:
+                band_stats.minimum[band] = used[0] + band_stats.offset
+                band_stats.maximum[band] = used[-1] + band_stats.offset
+
+        return band_stats
+
+    def _merge(self, band, n, mean, m2, minimum, maximum):
+        total = self.n[band] + n
+        delta = mean - self.mean[band]
+        self.mean[band] += delta * n / total
+        self.m2[band] += m2 + delta * delta * self.n[band] * n / total
+        self.n[band] = total
+        self.minimum[band] = min(self.minimum[band], minimum)
+        self.maximum[band] = max(self.maximum[band], maximum)
+
+    def histogram(self, band, buckets=256):
+        """
+        This method returns the default histogram of a band: equal buckets between minimum - 0.5 and maximum + 0.5
+        rebinned from the exact histogram or, for other data types, the histogram binned by update_histogram().
+
+        Outputs:
+        - low, high: Limits of the histogram
+        - counts: List of bucket counts (None if no histogram was accumulated)
+
+        """
+        if self.counts is None:
+            if self.buckets is None:
+                return None, None, None
+            low, high = self.ranges[band]
+            return low, high, [int(count) for count in self.buckets[band]]
+
+        low, high = self.minimum[band] - 0.5, self.maximum[band] + 0.5
+        values = np.arange(self.counts.shape[1]) + self.offset
+        used = (values >= self.minimum[band]) & (values <= self.maximum[band])
+        index = ((values[used] - low) * buckets / (high - low)).astype(np.int64)
+        counts = np.bincount(np.minimum(index, buckets - 1), weights=self.counts[band][used], minlength=buckets)
+
+        return low, high, [int(count) for count in counts]
+
+    def percentile(self, band, q):
+        """
+        This method returns a percentile (0-100) of a band: exact for 8 and 16-bit integers, interpolated within the
+        histogram buckets otherwise (None if no histogram was accumulated).
+
+        """
+        if self.counts is not None:
+            cumulative = np.cumsum(self.counts[band])
+            rank = max(q / 100 * cumulative[-1], 1)
+            return float(np.searchsorted(cumulative, rank) + self.offset)
+
+        if self.buckets is None:
+            return None
+        low, high = self.ranges[band]
+        cumulative = np.cumsum(self.buckets[band])
+        edges = np.linspace(low, high, len(cumulative) + 1)
+        return float(np.interp(q / 100 * cumulative[-1], np.concatenate([[0], cumulative]), edges))
+
+    def write(self, dataset, histogram=True, percentiles=None, approx=False):
+        """
+        This method stores the statistics (and the histograms and percentiles, when requested) in an open GDAL dataset,
+        as GDAL's own statistics computation would.
+
+        """
+        for band in range(len(self.n)):
+            if self.n[band] == 0:
+                continue
+            dst_band = dataset.GetRasterBand(band + 1)
+            dst_band.SetStatistics(
+                float(self.minimum[band]),
+                float(self.maximum[band]),
+                float(self.mean[band]),
+                float(np.sqrt(self.m2[band] / self.n[band])),
+            )
+            dst_band.SetMetadataItem("STATISTICS_VALID_PERCENT", "%.4g" % (100 * self.n[band] / self.pixels[band]))
+            if approx:
+                dst_band.SetMetadataItem("STATISTICS_APPROXIMATE", "YES")
+            for q in percentiles or []:
+                dst_band.SetMetadataItem("STATISTICS_P%g" % q, "%.10g" % self.percentile(band, q))
+            low, high, counts = self.histogram(band)
+            if histogram and counts is not None:
+                dst_band.SetDefaultHistogram(low, high, counts)
 
 
     
@@ -149,24 +764,998 @@ def calculate_stats(raster):
 # In addition to the pansharpening tool, this script creates an up-and-downsampling tool where the users can change (resample) 
 # the cell size of their raster datasets without any external bands. 
 # Once again, a simplified gdal.Translate() function was chosen to resample the rasters.
+# The steps can be chained without writing intermediate GeoTIFFs: resize() and wrapper_pansharpen() (gdal method) write
+# VRTs when given a .vrt file name, which are computed on the fly by the next step, so only the final product is
+# materialised. For example:
+#     resize("ms_2m.vrt", "ms.tif", 2.0, "cubic")
+#     wrapper_pansharpen("pan.tif", "psh.vrt", "ms_2m.vrt")
+#     stack_bands("pan.tif", "psh.vrt", "stacked.tif")
+# /vsimem/ paths work as well, but they are only shared between rasterio and the GDAL bindings when both use the same
+# GDAL library (e.g. a conda environment, not the rasterio wheels).
+# Several cell sizes of the same input (e.g. 0.5, 1, 2 and 5 m deliveries) are produced by a single resize() call given
+# lists of output names and cell sizes. Each gdal.Translate() call would decode the whole input again; instead, the
+# input is read once, in strips of full rows, and every output resamples its rows of the strip with the same GDAL
+# resampling as gdal.Translate() while the strip is still in GDAL's block cache. The average and rms products of
+# floating-point rasters at an integer multiple of a finer product are reduced from that product's rows (the rounding of
+# integer rasters would make them differ by one digital number from a direct resampling, so they are not cascaded).
+# The same pass can accumulate the band statistics of every output from the rows it writes (statistics=True), instead
+# of reading the outputs again with calculate_stats().
 
 #############  
     
-def resize(output_name, ds, Res, resampling, of="GTiff"):
+@instrumented
+def resize(output_name, ds, Res, resampling, of="GTiff", output_profile=None, statistics=False):
     """
     This function resamples raster datasets without the use of an external band based only on resolution values inputed by the user.
     It benefits from gdal.Translate()
 
     Inputs:
-    - output_name: File path to the output raster resized
-    - ds: File path of input dataset
-    - Res: The new size of the cells
-    - resampling: resampling algorithm (nearest [default], bilinear, cubic, cubicspline, lanczos, average, rms, mode)
-    - of: output format (GTiff is deafault)
+    - output_name: File path to the output raster resized, or a list of file paths (one per cell size in Res)
+    - ds: File path of input dataset (or a VRT, a /vsimem/ path or an open rasterio or GDAL dataset)
+    - Res: The new size of the cells, or a list of sizes when output_name is a list
+    - resampling: resampling algorithm (nearest [default], bilinear, cubic, cubicspline, lanczos, average, rms, mode,
+        or the labels of the user interface, see _resize_resampling()), or a list of algorithms (one per cell size)
+    - of: output format (GTiff is deafault). With VRT (or an output_name ending with .vrt), a virtual raster is written
+        instead of a copy of the pixels: they are resampled on the fly when the next step (e.g. wrapper_pansharpen())
+        reads them
+    - output_profile: Layout of the resized raster ("gtiff", "cog" or a dictionary, see output_profiles.py). If given,
+        it replaces the output format (except for VRTs)
+    - statistics: if True, band statistics are computed from the resized pixels as they are written and stored with
+        the output, like calculate_stats() would, with the exact histograms of 8 and 16-bit rasters (VRTs get none)
+
+    Outputs:
+    - output_name: File path of the resized raster (or list of file paths), to be given to the next step of a workflow
+
+    """
+    # The same names are accepted for one or several outputs (e.g. cubic_spline or the labels of the user interface)
+    if isinstance(resampling, (list, tuple)):
+        resampling = [_resize_resampling(name) for name in resampling]
+    else:
+        resampling = _resize_resampling(resampling)
+    if isinstance(output_name, (list, tuple)):
+        return _resize_many(list(output_name), ds, Res, resampling, of, output_profile, statistics)
+    if not hasattr(ds, "GetDescription"):  # GDAL datasets are given to gdal.Translate() as they are
+        ds = _dataset_name(ds)
+    if output_name.lower().endswith(".vrt"):
+        of = "VRT"
+    if statistics and of != "VRT":
+        return _resize_many([output_name], ds, Res, resampling, of, output_profile, statistics)[0]
+    output_profile = resolve_profile(output_profile)
+    if output_profile and of != "VRT":
+        _translate(output_name, ds, output_profile, xRes=Res, yRes=Res, resampleAlg=gdal_resampling(resampling))
+        return output_name
+
+    with accumulate("translate"):
+        dataset = gdal.Translate(
+            output_name, ds, xRes=Res, yRes=Res, resampleAlg=gdal_resampling(resampling), format=of
+        )
+        add_pixels(dataset.RasterXSize * dataset.RasterYSize)
+        dataset = None  # Flush and close
+
+    return output_name
+
+
+# Resampling algorithms whose products at an integer multiple of a finer product's cell size can be reduced from it
+_CASCADE_REDUCERS = ("average", "rms")
+_STRIP_BYTES = 64 * 2**20  # Input pixels per strip of _resize_many(), well under GDAL's block cache (5% of the RAM)
+
+
+def _resize_many(output_names, ds, resolutions, resamplings, of="GTiff", output_profile=None, statistics=False):
+    """
+    This function resizes a raster to several cell sizes in a single pass over the input (see resize()). The rows of
+    every output are resampled from strips of the input, which gives the pixels of a whole-raster resampling except
+    for average and rms when no output row starts on a whole input row near the end of a strip (e.g. from 10 m to 3 m
+    cells, while 10 m to 4 m or 20 m is exact): their fractional weights are then computed from the strip and integer
+    outputs can differ by one digital number (floating-point outputs by rounding errors).
+
+    Inputs:
+    - output_names: List of file paths of the resized rasters. The .vrt ones are written by gdal.Translate(), as they
+        do not read any pixel
+    - ds: File path of input dataset (or a VRT, a /vsimem/ path or an open rasterio or GDAL dataset)
+    - resolutions: List of cell sizes, or one cell size for every output
+    - resamplings: List of resampling algorithms, or one algorithm for every output
+    - of: Output format (GTiff or VRT)
+    - output_profile, statistics: See resize()
+
+    Outputs:
+    - output_names: List of file paths of the resized rasters
+
+    """
+    count = len(output_names)
+    resolutions = list(resolutions) if isinstance(resolutions, (list, tuple)) else [resolutions] * count
+    resamplings = list(resamplings) if isinstance(resamplings, (list, tuple)) else [resamplings] * count
+    if len(resolutions) != count or len(resamplings) != count:
+        raise ValueError("output_name, Res and resampling must list as many items")
+    if of not in ("GTiff", "VRT"):
+        raise ValueError("several cell sizes can only be written as GeoTIFFs or VRTs")
+
+    src_name = _dataset_name(ds)
+    profile = resolve_profile(output_profile)
+    targets = []
+    for name, res, resampling in zip(output_names, resolutions, resamplings):
+        if of == "VRT" or name.lower().endswith(".vrt"):
+            resize(name, src_name, res, resampling, of="VRT")
+        else:
+            targets.append({"name": name, "res": abs(float(res)), "resampling": _resize_resampling(resampling)})
+    if not targets:
+        return output_names
+
+    with rio.open(src_name) as src, ExitStack() as stack:
+        # Grids of gdal.Translate(xRes=Res, yRes=Res): the input extent in whole cells, from its upper-left corner
+        cascade = np.dtype(src.dtypes[0]).kind == "f" and all(nodata is None for nodata in src.nodatavals)
+        targets.sort(key=lambda target: target["res"])
+        for number, target in enumerate(targets):
+            res = target["res"]
+            target["width"] = max(1, int(src.width * abs(src.transform.a) / res + 0.5))
+            target["height"] = max(1, int(src.height * abs(src.transform.e) / res + 0.5))
+            x_res, y_res = math.copysign(res, src.transform.a), math.copysign(res, src.transform.e)
+            target["transform"] = Affine(x_res, 0, src.transform.c, 0, y_res, src.transform.f)
+            target["children"], target["row"], target["pending"] = [], 0, None
+            target["statistics"] = _BandStatistics(src.count, src.dtypes[0], src.nodata) if statistics else None
+            target["parent"] = _cascade_parent(targets[:number], target) if cascade else None
+            if target["parent"]:
+                target["parent"]["children"].append(target)
+
+            dst_profile = {
+                "driver": "GTiff",
+                "width": target["width"],
+                "height": target["height"],
+                "count": src.count,
+                "dtype": src.dtypes[0],
+                "crs": src.crs,
+                "transform": target["transform"],
+                "nodata": src.nodata,
+            }
+            if profile:
+                dst_profile.update(rasterio_options(profile, src.dtypes[0]))
+            staging = stack.enter_context(staged_output(target["name"], profile))
+            target["dataset"] = stack.enter_context(rio.open(staging, "w", **dst_profile))
+            _copy_band_metadata(src, target["dataset"])
+
+        # Strips of whole input blocks, so that every block is decoded once
+        block_rows = src.block_shapes[0][0]
+        row_bytes = src.width * src.count * np.dtype(src.dtypes[0]).itemsize
+        strip_rows = max(block_rows, _STRIP_BYTES // row_bytes // block_rows * block_rows)
+        direct = [target for target in targets if target["parent"] is None]
+        for strip_end in range(strip_rows, src.height + strip_rows, strip_rows):
+            strip_end = min(strip_end, src.height)
+            for target in direct:
+                end = _strip_rows_end(target["height"], src.height, strip_end)
+                if end <= target["row"]:
+                    continue
+                scale = src.height / target["height"]
+                window = rio.windows.Window(0, target["row"] * scale, src.width, (end - target["row"]) * scale)
+                with accumulate("read"):
+                    block = src.read(
+                        window=window,
+                        out_shape=(src.count, end - target["row"], target["width"]),
+                        resampling=rio.enums.Resampling[target["resampling"]],
+                    )
+                _write_resized_rows(target, block)
+
+    # Written once the outputs are closed (and copied into COGs, whose driver does not copy histograms)
+    for target in targets:
+        if target["statistics"] is not None:
+            dataset = gdal.Open(target["name"])
+            target["statistics"].write(dataset)
+            dataset = None  # Flush the statistics and close
+
+    return output_names
+
+
+def _resize_resampling(resampling):
+    """
+    This function returns the rasterio name of a resampling algorithm of resize(): the names of resampling_name()
+    (e.g. near, cubicspline or Cubic Convolution) and the other algorithms of gdal.Translate() (rms, mode, min, max...).
+
+    """
+    if resampling is None:
+        return "nearest"
+    try:
+        return resampling_name(resampling)
+    except ValueError:
+        name = str(resampling).strip().lower()
+        if name not in rio.enums.Resampling.__members__:
+            raise ValueError(f"resampling must be one of {', '.join(rio.enums.Resampling.__members__)}") from None
+        return name
+
+
+def _copy_band_metadata(src, dst):
+    """
+    This function copies what gdal.Translate() keeps of the bands of a raster: color table, color interpretation,
+    descriptions, units, scales and offsets, and the dataset and band tags (except the statistics of the input pixels).
+
+    """
+    dst.update_tags(**src.tags())
+    dst.descriptions = src.descriptions
+    dst.units = src.units
+    dst.scales = src.scales
+    dst.offsets = src.offsets
+    for band in src.indexes:
+        dst.update_tags(band, **{key: value for key, value in src.tags(band).items() if not key.startswith("STATISTICS_")})
+        try:
+            dst.write_colormap(band, src.colormap(band))
+        except ValueError:
+            pass  # No color table
+    if rio.enums.ColorInterp.palette not in src.colorinterp:
+        dst.colorinterp = src.colorinterp
+
+
+def _cascade_parent(finer, target):
+    """
+    This function returns the coarsest of the finer products a product can be reduced from (same algorithm in
+    _CASCADE_REDUCERS, grid an integer multiple of the product's grid), or None.
+
+    """
+    if target["resampling"] not in _CASCADE_REDUCERS:
+        return None
+    for parent in reversed(finer):
+        factor = parent["width"] // target["width"]
+        if (
+            parent["resampling"] == target["resampling"]
+            and factor > 1
+            and parent["width"] == factor * target["width"]
+            and parent["height"] == factor * target["height"]
+        ):
+            return parent
+
+    return None
+
+
+def _strip_rows_end(height, src_height, strip_end):
+    """
+    This function returns the end of the output rows that can be resampled from the input rows above strip_end. The end
+    is moved back to a row starting on a whole input row when possible, so that the fractional windows of the average
+    algorithm are split exactly as in a resampling of the whole raster (see _resize_many() otherwise).
+
+    """
+    if strip_end == src_height:
+        return height
+    end = strip_end * height // src_height
+    period = height // math.gcd(height, src_height)  # Output rows between two rows starting on a whole input row
+
+    return end - end % period if end >= period else end
+
+
+def _write_resized_rows(target, block):
+    """
+    This function writes the next rows of a resized raster and reduces them into the products cascaded from it.
+
+    """
+    with accumulate("write"):
+        target["dataset"].write(block, window=rio.windows.Window(0, target["row"], target["width"], block.shape[1]))
+    if target["statistics"] is not None:
+        with accumulate("statistics", block.shape[1] * block.shape[2]):
+            target["statistics"].update(block)
+    add_pixels(block.shape[1] * block.shape[2])
+    target["row"] += block.shape[1]
+
+    for child in target["children"]:
+        factor = target["width"] // child["width"]
+        pending = block if child["pending"] is None else np.concatenate((child["pending"], block), axis=1)
+        rows = pending.shape[1] // factor * factor
+        child["pending"] = pending[:, rows:]
+        if rows:
+            _write_resized_rows(child, _reduce_block(pending[:, :rows], factor, child["resampling"]))
+
+
+def _translate(dst_filename, src_filename, profile, **kwargs):
+    """
+    This function copies a raster with gdal.Translate() into a GeoTIFF or a Cloud-Optimized GeoTIFF laid out as an
+    output profile describes.
+
+    Inputs:
+    - dst_filename: File path of the copy
+    - src_filename: File path of the raster to be copied, or an open GDAL dataset
+    - profile: Dictionary describing the output profile (see output_profiles.py)
+    - kwargs: Other gdal.Translate() options (e.g. xRes, yRes, resampleAlg)
+
+    """
+    source = src_filename if hasattr(src_filename, "GetRasterBand") else gdal.Open(src_filename)
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(source.GetRasterBand(1).DataType)
+    source = None
+    driver = "COG" if profile["cog"] else "GTiff"
+    with accumulate("translate"):
+        dataset = gdal.Translate(
+            dst_filename, src_filename, format=driver, creationOptions=gdal_options(profile, dtype, driver), **kwargs
+        )
+        add_pixels(dataset.RasterXSize * dataset.RasterYSize)
+        dataset = None  # Flush and close
+
+
+
+#############
+
+# Single-pass processing. Running wrapper_pansharpen(), stack_bands(), calculate_stats() and create_pyramids() one after
+# the other reads and rewrites the whole raster up to four times. pansharpen_pipeline() streams the pansharpened image
+# window by window straight into the final GeoTIFF instead: the panchromatic band is stacked in the same window, the
+# band statistics are accumulated from every window as it is written and, for the resampling algorithms that only
+# combine the pixels under each overview pixel, the pyramids are reduced from the same windows and written into the
+# overview levels. Other pyramid algorithms need neighbouring windows, so they are built by create_pyramids() at the end.
+# Pyramid cells cover exactly factor x factor pixels; GDAL stretches them slightly when the raster size is not a multiple
+# of the factor, so in that case the two can differ by up to half a pyramid pixel towards the right and bottom edges.
+
+#############
+
+# Pyramid algorithms that can be computed window by window, with the reduction applied to the pixels of each cell
+_TILE_REDUCERS = {
+    "average": ("mean", "nanmean"),
+    "rms": ("mean", "nanmean"),
+    "min": ("min", "nanmin"),
+    "max": ("max", "nanmax"),
+    "sum": ("sum", "nansum"),
+    "med": ("median", "nanmedian"),
+}
+
+
+def _reduce_block(block, factor, resampling, nodata=None):
+    """
+    This function computes the pyramid pixels of a block whose origin is a multiple of the decimation factor.
+
+    Inputs:
+    - block: Block of pixels (bands, rows, columns)
+    - factor: Decimation factor of the pyramid level
+    - resampling: "nearest" or one of the algorithms in _TILE_REDUCERS
+    - nodata: Value excluded from the reduction
+
+    Outputs:
+    - Pyramid block (bands, ceil(rows / factor), ceil(columns / factor)) of the same data type as block
+
+    """
+    bands, rows, columns = block.shape
+    if resampling == "nearest":
+        # Same pixel as GDAL: the upper-left pixel of each pyramid cell
+        return block[:, ::factor, ::factor].copy()
+
+    out_rows, out_columns = -(-rows // factor), -(-columns // factor)
+    exact = out_rows * factor == rows and out_columns * factor == columns
+    complete = exact
+    values = block.astype(np.float64)
+    if nodata is not None and np.any(block == nodata):
+        values[block == nodata] = np.nan
+        complete = False
+    if not exact:
+        padded = np.full((bands, out_rows * factor, out_columns * factor), np.nan)
+        padded[:, :rows, :columns] = values
+        values = padded
+    if resampling == "rms":
+        values *= values
+
+    reduce, nan_reduce = _TILE_REDUCERS[resampling]
+    values = values.reshape(bands, out_rows, factor, out_columns, factor)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # All-nodata cells are expected
+        reduced = getattr(np, reduce if complete else nan_reduce)(values, axis=(2, 4))
+    if resampling == "rms":
+        np.sqrt(reduced, out=reduced)
+    if np.issubdtype(block.dtype, np.integer):
+        np.floor(reduced + 0.5, out=reduced)  # GDAL rounds half up
+    if nodata is not None:
+        reduced[np.isnan(reduced)] = nodata
+
+    out = np.empty(reduced.shape, dtype=block.dtype)
+    _store(reduced, out)
+
+    return out
+
+
+def _read_window(raster, window, transform=None, overview_level=None):
+    """
+    This function reads a window of all the bands of a raster. The file is opened by each call so that windows can be
+    read concurrently.
+
+    Inputs:
+    - raster: File path of the raster
+    - window: Window to be read
+    - transform: Geotransform of the grid the window refers to. If given, the window is located by its bounds and the
+        pixels outside the raster are filled with 0
+    - overview_level: If given, the window is read from this overview level of the raster
+
+    Outputs:
+    - window: Window that was read
+    - block: Block of pixels (bands, rows, columns)
+
+    """
+    open_options = {} if overview_level is None else {"overview_level": overview_level}
+    with accumulate("read"), rio.open(raster, **open_options) as src:
+        if transform is None:
+            return window, src.read(window=window)
+        bounds = rio.windows.bounds(window, transform)
+        src_window = rio.windows.from_bounds(*bounds, transform=src.transform).round_offsets().round_lengths()
+        return window, src.read(window=src_window, boundless=True, fill_value=0)
+
+
+def _write_block(dataset, block, window, first_band=1):
+    """
+    This function writes a block of pixels (bands, rows, columns) into an open GDAL dataset.
+
+    """
+    for band in range(block.shape[0]):
+        dataset.GetRasterBand(first_band + band).WriteArray(block[band], int(window.col_off), int(window.row_off))
+
+
+def _write_pyramid_blocks(dataset, block, window, factors, resampling, first_band=1, nodata=None):
+    """
+    This function reduces a block of pixels and writes it into the pyramid levels of an open GDAL dataset. As in GDAL,
+    every level is computed from the previous one.
+
+    """
+    reduced, previous = block, 1
+    for level, factor in enumerate(factors):
+        reduced, previous = _reduce_block(reduced, factor // previous, resampling, nodata), factor
+        for band in range(reduced.shape[0]):
+            overview = dataset.GetRasterBand(first_band + band).GetOverview(level)
+            overview.WriteArray(reduced[band], int(window.col_off) // factor, int(window.row_off) // factor)
+
+
+@instrumented
+def pansharpen_pipeline(
+    pan_name,
+    spectral_names,
+    dst_filename,
+    simple_mean=False,
+    stack=False,
+    statistics=False,
+    pyramids=None,
+    band_nums=None,
+    weights=None,
+    resampling=None,
+    spat_adjust=None,
+    bitdepth=None,
+    nodata_value=False,
+    tile_size=DEFAULT_TILE_SIZE,
+    workers=1,
+    output_profile=None,
+    progress=None,
+    method=None,
+    R=1,
+    G=2,
+    B=3,
+    NIR=4,
+    W=0.1,
+    incremental=False,
+    approx_stats=False,
+):
+    """
+    This function runs a whole pansharpening job in one streaming pass: the pansharpened image is computed window by
+    window and written once to the final GeoTIFF, with the panchromatic band stacked, band statistics and pyramids
+    built from the same windows. The result matches the raster that wrapper_pansharpen(), stack_bands(),
+    calculate_stats() and create_pyramids() produce one after the other only within the tolerance of the streaming
+    resampling (see Simple_Pansharpen.py): the band-math methods give identical pixels for integer images at
+    power-of-two ratios, but can differ by a few digital numbers at other ratios. The statistics describe the pixels
+    written here. The pyramids can also differ towards the right and bottom edges when the raster size is not a
+    multiple of their factor (see _TILE_REDUCERS).
+
+    Inputs:
+    - pan_name, spectral_names, dst_filename, simple_mean, band_nums, weights, resampling, spat_adjust, bitdepth,
+        nodata_value, tile_size, workers, method, R, G, B, NIR, W, approx_stats: See wrapper_pansharpen()
+    - stack: if True, the panchromatic band is stacked in front of the pansharpened bands (see stack_bands())
+    - statistics: if True, band statistics are stored with the output (see calculate_stats()), with the exact
+        histograms of 8 and 16-bit rasters
+    - pyramids: resampling algorithm of the pyramids (see create_pyramids()). If None, no pyramids are built
+    - output_profile: Layout of the final raster ("gtiff", "cog" or a dictionary, see output_profiles.py). If None, a
+        tiled GeoTIFF with the compression of the pansharpened image is written. A COG is written as a tiled GeoTIFF
+        and copied by GDAL's COG driver, which reuses the pyramids built here
+    - progress: Function called as progress(stage, fraction) while the job runs, with stage one of "scene statistics"
+        (the first pass of gram_schmidt, pca and ihs), "pansharpening", "pyramids", "statistics" and "writing" and
+        fraction between 0 and 1. If it returns False, the job is stopped,
+        its partial outputs are deleted and PipelineCancelled is raised
+    - incremental: if True, a sidecar file (see update_pipeline()) records the job, a checksum of the input pixels
+        under every window and the running statistics, so that the raster can be brought up to date later by
+        recomputing only the windows whose inputs changed. COGs cannot be updated in place, so they are not supported.
+        The statistical methods keep the transform computed from the first inputs, so that the updated windows match
+        the others
+
+    Outputs:
+    - dst_filename: File path of the final raster
+
+    """
+    method = _method(method, simple_mean)
+    pan_name = _dataset_name(pan_name)
+    with rio.open(pan_name) as pan:
+        pan_profile = pan.profile
+    output_profile = resolve_profile(output_profile)
+    cog = bool(output_profile and output_profile["cog"])
+    if incremental and cog:
+        raise ValueError("incremental outputs must be GeoTIFFs: a COG cannot be updated in place")
+    tile_pyramids = pyramids == "nearest" or pyramids in _TILE_REDUCERS
+    job = dict(
+        method=method,
+        R=R,
+        G=G,
+        B=B,
+        NIR=NIR,
+        W=W,
+        band_nums=band_nums,
+        weights=weights,
+        resampling=resampling,
+        spat_adjust=spat_adjust,
+        bitdepth=bitdepth,
+        nodata_value=nodata_value,
+        tile_size=tile_size,
+        align=1,
+        stack=stack,
+        approx_stats=approx_stats,
+    )
+
+    _report(progress, "pansharpening", 0)
+    profile, tiles, temporary = _pipeline_tiles(pan_name, spectral_names, dst_filename, job, workers, progress=progress)
+
+    # The pyramids follow the output grid, which can be cropped or extended from the panchromatic one by spat_adjust.
+    # Pyramids built window by window need windows that map onto whole pixels of the coarsest level, so the windows
+    # are planned again once that level is known (the transform of a statistical method is kept in the job)
+    factors = _pyramid_factors(profile["width"], profile["height"]) if pyramids else []
+    if tile_pyramids and factors:
+        tiles.close()
+        if temporary is not None:
+            os.remove(temporary)
+        job["align"] = max(factors)
+        profile, tiles, temporary = _pipeline_tiles(pan_name, spectral_names, dst_filename, job, workers)
+
+    created = False
+    try:
+        count = profile["count"] + (1 if stack else 0)
+        dtype = pan_profile["dtype"] if stack else profile["dtype"]
+        nodata = profile.get("nodata")
+        if output_profile:
+            options = gdal_options(output_profile, dtype)
+        else:
+            options = ["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256", "BIGTIFF=IF_SAFER"]
+            if profile.get("compress"):
+                options.append("COMPRESS=%s" % profile["compress"].upper())
+        with staged_output(dst_filename, output_profile) as path:
+            created = True
+            dataset = gdal.GetDriverByName("GTiff").Create(
+                path,
+                profile["width"],
+                profile["height"],
+                count,
+                gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype)),
+                options,
+            )
+            dataset.SetGeoTransform(profile["transform"].to_gdal())
+            if profile.get("crs"):
+                dataset.SetProjection(profile["crs"].to_wkt())
+            if nodata is not None:
+                for band in range(count):
+                    dataset.GetRasterBand(band + 1).SetNoDataValue(nodata)
+            if factors and tile_pyramids:
+                dataset.BuildOverviews("NONE", factors)  # Empty pyramid levels, filled window by window below
+
+            band_stats = _BandStatistics(count, dtype, nodata) if statistics else None
+            done, total = 0, profile["width"] * profile["height"]
+            windows = []
+            for tile in tiles:
+                window, block = _output_block(tile, stack, dtype)
+                with accumulate("write", window.width * window.height):
+                    _write_block(dataset, block, window)
+                if band_stats is not None:
+                    with accumulate("statistics", window.width * window.height):
+                        band_stats.update(block)
+                if factors and tile_pyramids:
+                    with accumulate("pyramids", window.width * window.height):
+                        _write_pyramid_blocks(dataset, block, window, factors, pyramids, nodata=nodata)
+                add_pixels(window.width * window.height)
+                windows.append(window)
+                done += window.width * window.height
+                _report(progress, "pansharpening", done / total)
+
+            if band_stats is not None and not cog:
+                band_stats.write(dataset)
+            if factors and tile_pyramids:
+                dataset.SetMetadataItem("resampling", pyramids, "rio_overview")
+            dataset = None  # Flush and close
+
+            if factors and not tile_pyramids:
+                _report(progress, "pyramids", 0)
+                create_pyramids(path, pyramids, workers=workers)
+                _report(progress, "pyramids", 1)
+            if cog:
+                _report(progress, "writing", 0)
+
+        # The COG driver does not copy histograms, so the statistics are stored with the final raster
+        if band_stats is not None and cog:
+            _report(progress, "statistics", 0)
+            dataset = gdal.Open(dst_filename)
+            band_stats.write(dataset)
+            dataset = None
+            _report(progress, "statistics", 1)
+
+        if incremental:
+            inputs = [pan_name] + _spectral_list(spectral_names)
+            checksums = _input_checksums(inputs, profile, windows, resampling, workers)
+            record = dict(
+                pan_name=pan_name,
+                spectral_names=_spectral_list(spectral_names),
+                job=job,
+                statistics=statistics,
+                pyramids=pyramids,
+                factors=factors,
+                windows=[[int(value) for value in window.flatten()] for window in windows],
+                checksums=checksums,
+                band_statistics=band_stats.state() if band_stats is not None else None,
+            )
+            _write_sidecar(dst_filename, record)
+    except BaseException:
+        dataset = None  # Close the partial output before deleting it
+        if created:
+            _remove_outputs(dst_filename)
+        raise
+    finally:
+        tiles.close()  # Stops the workers still computing windows
+        if temporary is not None:
+            os.remove(temporary)
+
+    return dst_filename
+
+
+def _pipeline_tiles(pan_name, spectral_names, dst_filename, job, workers, windows=None, progress=None):
+    """
+    This function plans the pansharpened windows of pansharpen_pipeline() and update_pipeline().
+
+    Inputs:
+    - pan_name, spectral_names, dst_filename, workers: See pansharpen_pipeline()
+    - job: Dictionary of the pansharpening options of the pipeline (method, band roles, options of gdal_pansharpen(),
+        tile_size, align, stack and approx_stats). The transform of a statistical method is computed once and stored
+        in it as "coefficients" (see substitution_coefficients())
+    - windows: Windows to be computed (every window if None)
+    - progress: See pansharpen_pipeline(). The first pass of the statistical methods is reported as the
+        "scene statistics" stage, and it can be cancelled like the others
+
+    Outputs:
+    - profile: Rasterio profile of the pansharpened image
+    - tiles: Generator of (window, img_psh) tuples, or (window, img_psh, img_pan) tuples when stacking
+    - temporary: File path of a temporary VRT to be deleted once the tiles are consumed, or None
+
+    """
+    if job["method"] != "gdal":
+        ms_name, temporary = _spectral_dataset(spectral_names, dst_filename)
+        try:
+            if job["method"] in STATISTICAL_METHODS and job.get("coefficients") is None:
+                job["coefficients"] = substitution_coefficients(
+                    ms_name,
+                    pan_name,
+                    job["method"],
+                    tile_size=job["tile_size"],
+                    workers=workers,
+                    resampling=job["resampling"],
+                    approx_stats=job.get("approx_stats", False),
+                    progress=lambda fraction: _report(progress, "scene statistics", fraction),
+                    spat_adjust=job["spat_adjust"],
+                )
+            profile, tiles = pansharpen_tiles(
+                ms_name,
+                pan_name,
+                job["R"],
+                job["G"],
+                job["B"],
+                job["NIR"],
+                method=job["method"],
+                W=job["W"],
+                tile_size=job["tile_size"],
+                workers=workers,
+                align=job["align"],
+                keep_pan=job["stack"],
+                resampling=job["resampling"],
+                windows=windows,
+                coefficients=job.get("coefficients"),
+                spat_adjust=job["spat_adjust"],
+                nodata_value=_band_math_nodata(job["nodata_value"]),
+            )
+        except BaseException:
+            if temporary is not None:
+                os.remove(temporary)
+            raise
+        return profile, tiles, temporary
+
+    # gdal_pansharpen() only describes the pansharpened image in a small VRT file, which is computed on the fly when
+    # its windows are read
+    temporary = temporary_path(dst_filename, ".vrt")
+    try:
+        osgeo_utils.gdal_pansharpen.gdal_pansharpen(
+            pan_name=pan_name,
+            spectral_names=_spectral_list(spectral_names),
+            band_nums=job["band_nums"],
+            weights=job["weights"],
+            dst_filename=temporary,
+            driver_name="VRT",
+            resampling=gdal_name(job["resampling"]),
+            spat_adjust=job["spat_adjust"],
+            bitdepth=job["bitdepth"],
+            nodata_value=job["nodata_value"],
+            num_threads=workers if workers > 1 else None,
+        )
+        with rio.open(temporary) as vrt:
+            profile = vrt.profile
+    except BaseException:
+        os.remove(temporary)
+        raise
+    tiles = _gdal_pansharpen_tiles(
+        temporary, pan_name, profile, job["tile_size"], workers, job["align"], job["stack"], windows
+    )
+
+    return profile, tiles, temporary
+
+
+def _output_block(tile, stack, dtype):
+    """
+    This function assembles the block of the final raster from a pansharpened window: the panchromatic band is stacked
+    in front of it when requested, and the block is converted to the data type of the raster.
+
+    """
+    window, block = tile[0], tile[1]
+    if stack:
+        block = np.concatenate([tile[2][np.newaxis], block])
+    if block.dtype != dtype:
+        converted = np.empty(block.shape, dtype=dtype)
+        _store(block.astype(np.float32), converted)
+        block = converted
+
+    return window, block
+
+
+
+#############
+
+# Incremental processing. When a fix touches a small area of an input (e.g. a new ortho-correction of part of the
+# panchromatic band), update_pipeline() recomputes only the windows of the product whose inputs changed. The windows
+# come either from a dirty bounding box or from a comparison of checksums of the input pixels under every window, which
+# pansharpen_pipeline(incremental=True) records with the job in a JSON sidecar (dst_filename + ".tiles.json"). The
+# checksums cover the input pixels under each window plus the halo of the resampling kernel, so a change near a window
+# edge also marks its neighbour. The recomputed windows are written in place. The pyramid blocks above them are reduced
+# again when the pyramids are built window by window (see _TILE_REDUCERS); other pyramid algorithms need neighbouring
+# windows, so their pyramids are rebuilt. The statistics of 8 and 16-bit rasters are updated by taking the old pixels
+# of the windows out of the running statistics kept in the sidecar and merging the new ones in. Other data types, whose
+# histograms depend on the range of the whole raster, are computed again by calculate_stats().
+
+#############
+
+_SIDECAR_SUFFIX = ".tiles.json"
+
+
+@instrumented
+def update_pipeline(dst_filename, dirty_bounds=None, pan_name=None, spectral_names=None, workers=1, progress=None):
+    """
+    This function brings a raster written by pansharpen_pipeline(incremental=True) up to date after its inputs changed.
+
+    Inputs:
+    - dst_filename: File path of the raster
+    - dirty_bounds: Changed area (left, bottom, right, top), in the coordinate reference system of the raster. If None,
+        the changed windows are found by comparing the checksums of the inputs with those of the sidecar
+    - pan_name, spectral_names: Inputs of the job (see wrapper_pansharpen()). If None, those recorded in the sidecar
+    - workers: Number of CPU cores to be used
+    - progress: See pansharpen_pipeline(), with the stages "checksums", "scene statistics" (only for the sidecars of
+        statistical methods that have no stored transform), "pansharpening", "pyramids" and "statistics".
+        The raster is left partially updated when the job is cancelled, and the next update completes it
+
+    Outputs:
+    - windows: List of the windows that were recomputed
 
     """
+    record = _read_sidecar(dst_filename)
+    job = record["job"]
+    pan_name = record["pan_name"] if pan_name is None else _dataset_name(pan_name)
+    spectral_names = record["spectral_names"] if spectral_names is None else _spectral_list(spectral_names)
+    windows = [rio.windows.Window(*window) for window in record["windows"]]
+    with rio.open(dst_filename) as dst:
+        profile = dst.profile
+
+    _report(progress, "checksums", 0)
+    inputs = [pan_name] + spectral_names
+    checksums = list(record["checksums"])
+    if dirty_bounds is None:
+        current = _input_checksums(inputs, profile, windows, job["resampling"], workers)
+        dirty = [index for index, checksum in enumerate(current) if checksum != checksums[index]]
+    else:
+        dirty = [
+            index
+            for index, window in enumerate(windows)
+            if _overlaps(rio.windows.bounds(window, profile["transform"]), dirty_bounds)
+        ]
+        recomputed = _input_checksums(inputs, profile, [windows[index] for index in dirty], job["resampling"], workers)
+        current = dict(zip(dirty, recomputed))
+    _report(progress, "checksums", 1)
+    if not dirty:
+        return []
+
+    band_stats = None
+    if record["band_statistics"] is not None:
+        band_stats = _BandStatistics.from_state(record["band_statistics"])
+        old_stats = _BandStatistics(profile["count"], profile["dtype"], profile["nodata"])
+        new_stats = _BandStatistics(profile["count"], profile["dtype"], profile["nodata"])
 
-    gdal.Translate(
-        output_name, ds, xRes=Res, yRes=Res, resampleAlg=resampling, format=of
+    factors, pyramids = record["factors"], record["pyramids"]
+    tile_pyramids = bool(factors) and (pyramids == "nearest" or pyramids in _TILE_REDUCERS)
+    dirty_windows = [windows[index] for index in dirty]
+    psh_profile, tiles, temporary = _pipeline_tiles(
+        pan_name, spectral_names, dst_filename, job, workers, dirty_windows, progress
     )
+    try:
+        if (psh_profile["width"], psh_profile["height"]) != (profile["width"], profile["height"]):
+            raise ValueError("the inputs no longer cover the grid of the raster: run pansharpen_pipeline() again")
+        record["band_statistics"] = None  # Until the update is complete, the running statistics are out of date
+        _write_sidecar(dst_filename, record)
+        dataset = gdal.Open(dst_filename, gdal.GA_Update)
+        for done, tile in enumerate(tiles, 1):
+            window, block = _output_block(tile, job["stack"], profile["dtype"])
+            if band_stats is not None:
+                with accumulate("statistics", window.width * window.height):
+                    old_stats.update(_read_block(dataset, window))
+                    new_stats.update(block)
+            with accumulate("write", window.width * window.height):
+                _write_block(dataset, block, window)
+            if tile_pyramids:
+                with accumulate("pyramids", window.width * window.height):
+                    _write_pyramid_blocks(dataset, block, window, factors, pyramids, nodata=profile["nodata"])
+            add_pixels(window.width * window.height)
+            _report(progress, "pansharpening", done / len(dirty_windows))
+        if band_stats is not None:
+            band_stats.remove(old_stats)
+            band_stats.merge(new_stats)
+            band_stats.write(dataset)
+    finally:
+        dataset = None  # Flush and close
+        tiles.close()  # Stops the workers still computing windows
+        if temporary is not None:
+            os.remove(temporary)
+
+    if factors and not tile_pyramids:
+        _report(progress, "pyramids", 0)
+        create_pyramids(dst_filename, pyramids, workers=workers)
+        _report(progress, "pyramids", 1)
+    if record["statistics"] and band_stats is None:
+        _report(progress, "statistics", 0)
+        calculate_stats(dst_filename, workers=workers)
+        _report(progress, "statistics", 1)
+
+    for index in dirty:
+        checksums[index] = current[index]
+    record.update(
+        pan_name=pan_name,
+        spectral_names=spectral_names,
+        checksums=checksums,
+        band_statistics=band_stats.state() if band_stats is not None else None,
+    )
+    _write_sidecar(dst_filename, record)
+
+    return dirty_windows
+
+
+def _overlaps(bounds, other):
+    left, bottom, right, top = bounds
+    return left < other[2] and other[0] < right and bottom < other[3] and other[1] < top
+
+
+def _read_block(dataset, window):
+    """
+    This function reads a block of pixels (bands, rows, columns) from an open GDAL dataset.
+
+    """
+    block = dataset.ReadAsArray(int(window.col_off), int(window.row_off), int(window.width), int(window.height))
+    return block.reshape((dataset.RasterCount,) + block.shape[-2:])
+
+
+def _input_checksums(inputs, profile, windows, resampling, workers=1):
+    """
+    This function computes a checksum of the input pixels under every window of the final raster.
+
+    Inputs:
+    - inputs: File paths of the input rasters
+    - profile: Rasterio profile of the final raster
+    - windows: Windows of the final raster
+    - resampling: Resampling algorithm of the multispectral bands, whose kernel sets the margin read around the windows
+    - workers: Number of windows read in parallel
 
+    Outputs:
+    - List of hexadecimal checksums, in the order of the windows
+
+    """
+    halo = resampling_halo(resampling)
+    tasks = ((inputs, rio.windows.bounds(window, profile["transform"]), profile["crs"], halo) for window in windows)
+    with accumulate("checksums"):
+        return list(_ordered_map(_window_checksum, tasks, workers, "thread"))
+
+
+def _window_checksum(inputs, bounds, crs, halo):
+    digest = hashlib.blake2b(digest_size=16)
+    for raster in inputs:
+        with rio.open(raster) as src:
+            src_bounds = bounds
+            if crs and src.crs and src.crs != crs:
+                src_bounds = rio.warp.transform_bounds(crs, src.crs, *bounds)
+            window = rio.windows.from_bounds(*src_bounds, transform=src.transform)
+            col_off = max(math.floor(round(window.col_off, 6)) - halo, 0)
+            row_off = max(math.floor(round(window.row_off, 6)) - halo, 0)
+            col_end = min(math.ceil(round(window.col_off + window.width, 6)) + halo, src.width)
+            row_end = min(math.ceil(round(window.row_off + window.height, 6)) + halo, src.height)
+            if col_end > col_off and row_end > row_off:
+                window = rio.windows.Window(col_off, row_off, col_end - col_off, row_end - row_off)
+                digest.update(src.read(window=window).tobytes())
+
+    return digest.hexdigest()
+
+
+def _read_sidecar(dst_filename):
+    try:
+        with open(dst_filename + _SIDECAR_SUFFIX) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise ValueError(f"{dst_filename} was not written by pansharpen_pipeline(incremental=True)") from None
+
+
+def _write_sidecar(dst_filename, record):
+    partial = dst_filename + _SIDECAR_SUFFIX + ".partial"
+    with open(partial, "w") as f:
+        json.dump(record, f)
+    os.replace(partial, dst_filename + _SIDECAR_SUFFIX)
+
+
+class PipelineCancelled(Exception):
+    """
+    Raised by pansharpen_pipeline() when its progress function asks it to stop.
+
+    """
+
+
+def _report(progress, stage, fraction):
+    """
+    This function reports the progress of a stage and raises PipelineCancelled if the progress function returns False.
+
+    """
+    if progress is not None and progress(stage, fraction) is False:
+        raise PipelineCancelled(f"cancelled during {stage}")
+
+
+def _remove_outputs(raster):
+    """
+    This function deletes a raster and its sidecar files (statistics, external pyramids and incremental record).
+
+    """
+    for path in (raster, raster + ".aux.xml", raster + ".ovr", raster + _SIDECAR_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _gdal_pansharpen_tiles(vrt_name, pan_name, profile, tile_size, workers, align, keep_pan, windows=None):
+    """
+    This function reads the windows of a pansharpened VRT (see pansharpen_pipeline()) in a pool of threads.
+
+    Inputs:
+    - vrt_name: File path of the VRT written by gdal_pansharpen()
+    - pan_name: File path of the panchromatic band
+    - profile: Rasterio profile of the VRT
+    - tile_size, workers: See wrapper_pansharpen()
+    - align: Window origins and sizes are made multiples of this number of pixels
+    - keep_pan: If True, the panchromatic pixels under each window are yielded as well
+    - windows: Windows to be read (every window of the grid if None)
+
+    Outputs:
+    - Generator of (window, img_psh) tuples, or (window, img_psh, img_pan) tuples when keep_pan is True
+
+    """
+    if windows is None:
+        tile_height = _tile_length(tile_size, 1, align, profile["height"])
+        tile_width = _tile_length(tile_size, 1, align, profile["width"])
+        windows = list(_tile_windows(profile["height"], profile["width"], tile_height, tile_width))
+
+    psh_tiles = _ordered_map(_read_window, ((vrt_name, window) for window in windows), workers, "thread")
+    if not keep_pan:
+        return psh_tiles
+
+    pan_tiles = _ordered_map(
+        _read_window, ((pan_name, window, profile["transform"]) for window in windows), workers, "thread"
+    )
+    return _zip_tiles(psh_tiles, pan_tiles)
+
+
+def _zip_tiles(psh_tiles, pan_tiles):
+    """
+    This generator pairs the pansharpened and panchromatic windows, and stops both pools of threads when it is closed.
+
+    """
+    try:
+        for (window, block), (_, pan_block) in zip(psh_tiles, pan_tiles):
+            yield window, block, pan_block[0]
+    finally:
+        psh_tiles.close()
+        pan_tiles.close()
@@ -0,0 +1,62 @@
+"""
+Tests of the georeferenced alignment of Simple_Pansharpen.py (spat_adjust)
+"""
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from Simple_Pansharpen import pansharpen
+
+
+def _write_pair(folder, ms_nodata=None):
+    """
+    This function writes random uint16 images whose footprints overlap partly: the multispectral image starts 32
+    panchromatic pixels to the right of the panchromatic one.
+
+    """
+    rng = np.random.default_rng(0)
+    profile = dict(driver="GTiff", dtype="uint16", crs="EPSG:32615")
+    ms_name, pan_name = str(folder / "ms.tif"), str(folder / "pan.tif")
+    transform = from_origin(500016, 5000000, 2, 2)
+    with rasterio.open(
+        ms_name, "w", height=40, width=40, count=4, transform=transform, nodata=ms_nodata, **profile
+    ) as dst:
+        dst.write(rng.integers(1000, 4000, (4, 40, 40), dtype="uint16"))
+    transform = from_origin(500000, 5000000, 0.5, 0.5)
+    with rasterio.open(pan_name, "w", height=160, width=160, count=1, transform=transform, **profile) as dst:
+        dst.write(rng.integers(100, 1000, (160, 160), dtype="uint16"), 1)
+
+    return ms_name, pan_name
+
+
+def test_intersection_declares_no_invented_nodata(tmp_path):
+    # esri clamps many random pixels to 0, which must stay valid pixels
+    ms_name, pan_name = _write_pair(tmp_path)
+    psh = pansharpen(ms_name, pan_name, str(tmp_path / "psh.tif"), method="esri", spat_adjust="intersection")
+    with rasterio.open(psh) as src:
+        assert src.nodata is None
+        assert (src.width, src.height) == (128, 160)
+        assert np.any(src.read() == 0)
+
+
+def test_union_needs_a_nodata_value(tmp_path):
+    ms_name, pan_name = _write_pair(tmp_path)
+    with pytest.raises(ValueError, match="nodata_value"):
+        pansharpen(ms_name, pan_name, str(tmp_path / "psh.tif"), method="brovey", spat_adjust="union")
+
+
+@pytest.mark.parametrize("ms_nodata, nodata_value", [(None, 65535), (65535, None)])
+def test_union_marks_the_pixels_outside_the_images(tmp_path, ms_nodata, nodata_value):
+    ms_name, pan_name = _write_pair(tmp_path, ms_nodata)
+    psh = pansharpen(
+        ms_name, pan_name, str(tmp_path / "psh.tif"), method="brovey", spat_adjust="union", nodata_value=nodata_value
+    )
+    with rasterio.open(psh) as src:
+        assert src.nodata == 65535
+        assert (src.width, src.height) == (192, 160)
+        img = src.read()
+    assert np.all(img[:, :, :32] == 65535)  # Left of the multispectral image
+    assert np.all(img[:, :, 160:] == 65535)  # Right of the panchromatic image
+    assert not np.any(img[:, :, 32:160] == 65535)
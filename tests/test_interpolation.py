@@ -0,0 +1,42 @@
+"""
+Tests of interpolation.py: a window resampled on its own gives the pixels of the whole band (see the streaming mode of
+Simple_Pansharpen.py)
+"""
+
+import numpy as np
+import pytest
+
+from interpolation import RESAMPLINGS, resampling_halo, resize_band
+
+# Windows (row, column, rows, columns) of the source band, away from its edges and at its upper-left corner
+WINDOWS = [(7, 13, 20, 30), (10, 21, 31, 29), (0, 0, 33, 45)]
+
+
+def _resized(band, ratio, resampling):
+    dst = np.empty((band.shape[0] * ratio, band.shape[1] * ratio), dtype=band.dtype)
+    resize_band(band, ratio, resampling, dst)
+    return dst
+
+
+def _assert_windows_match(band, ratio, resampling):
+    # The halo read around the windows of the streaming mode is cropped from the resampled window
+    whole = _resized(band, ratio, resampling)
+    inner = slice(resampling_halo(resampling) * ratio, -resampling_halo(resampling) * ratio)
+    for row, col, rows, cols in WINDOWS:
+        window = _resized(band[row : row + rows, col : col + cols], ratio, resampling)
+        expected = whole[row * ratio : (row + rows) * ratio, col * ratio : (col + cols) * ratio]
+        np.testing.assert_array_equal(window[inner, inner], expected[inner, inner])
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "uint16", "float32"])
+@pytest.mark.parametrize("resampling", RESAMPLINGS)
+@pytest.mark.parametrize("ratio", [2, 4])
+def test_window_matches_whole_band(ratio, resampling, dtype):
+    high = 250 if dtype == "uint8" else 4000
+    _assert_windows_match((np.random.default_rng(0).random((60, 80)) * high).astype(dtype), ratio, resampling)
+
+
+@pytest.mark.parametrize("ratio", [3, 5])
+def test_cubic_spline_window_matches_whole_band(ratio):
+    # The polyphase filter is used at every integer ratio, not only at the power-of-two ones
+    _assert_windows_match(np.random.default_rng(1).random((60, 80)).astype("float32") * 4000, ratio, "cubic_spline")
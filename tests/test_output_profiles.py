@@ -0,0 +1,30 @@
+"""
+Tests of the output profiles shared by the writers (output_profiles.py)
+"""
+
+import os
+
+import rasterio
+
+from output_profiles import temporary_path
+from Simple_Pansharpen import pansharpen
+from test_tiling import _write_pair
+
+
+def test_temporary_files_of_virtual_paths_go_to_the_temporary_directory(tmp_path):
+    local = temporary_path(str(tmp_path / "out.tif"), ".vrt")
+    virtual = temporary_path("/vsimem/out.tif", ".vrt")
+    try:
+        assert os.path.dirname(local) == str(tmp_path)
+        assert os.path.isfile(virtual)
+    finally:
+        os.remove(local)
+        os.remove(virtual)
+
+
+def test_cog_written_to_a_virtual_path(tmp_path):
+    ms_name, pan_name = _write_pair(tmp_path, 4, "uint16")
+    psh = pansharpen(ms_name, pan_name, "/vsimem/psh.tif", method="esri", tile_size=48, output_profile="cog")
+    with rasterio.open(psh) as src:
+        assert src.profile["tiled"]
+        assert src.shape == (101, 157)
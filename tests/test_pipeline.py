@@ -0,0 +1,49 @@
+"""
+Tests of the single-pass pipeline of resolution_changing_code.py
+"""
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+pytest.importorskip("osgeo.gdal")
+
+from resolution_changing_code import _pyramid_factors, pansharpen_pipeline
+
+
+def _write_pair(folder, pan_size, ms_size, ratio=4):
+    """
+    This function writes a panchromatic image and a multispectral image that covers only part of it, so that the
+    pansharpened grid is smaller than the panchromatic one.
+
+    """
+    rng = np.random.default_rng(0)
+    profile = dict(driver="GTiff", dtype="uint16", crs="EPSG:32615", tiled=True, blockxsize=64, blockysize=64)
+    ms_name, pan_name = str(folder / "ms.tif"), str(folder / "pan.tif")
+    transform = from_origin(500000, 5000000, 0.5 * ratio, 0.5 * ratio)
+    with rasterio.open(ms_name, "w", height=ms_size, width=ms_size, count=4, transform=transform, **profile) as dst:
+        dst.write(rng.integers(100, 4000, (4, ms_size, ms_size), dtype="uint16"))
+    transform = from_origin(500000, 5000000, 0.5, 0.5)
+    with rasterio.open(pan_name, "w", height=pan_size, width=pan_size, count=1, transform=transform, **profile) as dst:
+        dst.write(rng.integers(100, 4000, (pan_size, pan_size), dtype="uint16"), 1)
+
+    return ms_name, pan_name
+
+
+@pytest.mark.parametrize("pyramids", ["average", "cubic"])
+@pytest.mark.parametrize("spat_adjust", [None, "intersection"])
+def test_pyramids_follow_the_output_grid(tmp_path, pyramids, spat_adjust):
+    # The panchromatic image would have one more pyramid level than the 512 pixels of the pansharpened grid
+    ms_name, pan_name = _write_pair(tmp_path, pan_size=520, ms_size=128)
+    assert len(_pyramid_factors(520, 520)) > len(_pyramid_factors(512, 512))
+    dst_name = str(tmp_path / "psh.tif")
+    pansharpen_pipeline(pan_name, ms_name, dst_name, method="brovey", pyramids=pyramids, spat_adjust=spat_adjust)
+
+    with rasterio.open(dst_name) as src:
+        assert (src.width, src.height) == (512, 512)
+        assert src.overviews(1) == _pyramid_factors(512, 512)
+        levels = len(src.overviews(1))
+    for level in range(levels):
+        with rasterio.open(dst_name, overview_level=level) as overview:
+            assert np.all(overview.read() > 0), "pyramid level %d is not filled" % level
@@ -0,0 +1,32 @@
+"""
+Tests of the on-disk cache of resampled multispectral images (resample_cache.py)
+"""
+
+import os
+
+import numpy as np
+
+from resample_cache import ResampledCache
+
+
+def test_runs_filling_the_same_entry_keep_their_own_pixels(tmp_path):
+    cache = ResampledCache(str(tmp_path))
+    first = cache.create("key", (2, 4, 4), "uint16")
+    second = cache.create("key", (2, 4, 4), "uint16")
+    assert first != second
+    np.load(first, mmap_mode="r+")[...] = 1
+    np.load(second, mmap_mode="r+")[...] = 2
+
+    cache.commit("key", first)
+    assert np.all(cache.get("key") == 1)
+    cache.commit("key", second)
+    assert np.all(cache.get("key") == 2)
+    assert os.listdir(str(tmp_path)) == ["key.npy"]
+
+
+def test_clear_removes_partial_entries(tmp_path):
+    cache = ResampledCache(str(tmp_path))
+    cache.put("done", np.ones((1, 2, 2), dtype="uint8"))
+    cache.create("killed", (1, 2, 2), "uint8")
+    cache.clear()
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,73 @@
+"""
+Tests of the streaming modes of Simple_Pansharpen.py: tiled, parallel and scratch_dir outputs against the in-memory
+path, for every method, data type and resampling algorithm
+"""
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from interpolation import RESAMPLINGS
+from Simple_Pansharpen import PANSHARPEN_METHODS, pansharpen
+
+DTYPES = ["uint8", "uint16", "float32"]
+MODES = {
+    "tiled": dict(tile_size=48),
+    "parallel": dict(tile_size=64, workers=3),
+    "scratch": dict(scratch_dir=True),
+}
+
+
+def _write_pair(folder, ratio, dtype, height=101, width=157):
+    """
+    This function writes a multispectral image and a panchromatic image sharing its structure, so that the statistical
+    methods are well conditioned, with blocks smaller than the windows.
+
+    """
+    rng = np.random.default_rng(0)
+    high = 255 if dtype == "uint8" else 4000
+    ms_height, ms_width = int(np.ceil(height / ratio)), int(np.ceil(width / ratio))
+    scene = rng.random((ms_height, ms_width))
+    ms = np.stack([high * (0.3 + 0.5 * scene + 0.2 * rng.random(scene.shape)) for _ in range(4)])
+    rows, cols = (np.arange(height) / ratio).astype(int), (np.arange(width) / ratio).astype(int)
+    pan = high * (0.3 + 0.5 * scene[rows][:, cols] + 0.2 * rng.random((height, width)))
+    profile = dict(driver="GTiff", dtype=dtype, crs="EPSG:32615", tiled=True, blockxsize=16, blockysize=16)
+    ms_name, pan_name = str(folder / "ms.tif"), str(folder / "pan.tif")
+    transform = from_origin(500000, 5000000, 0.5 * ratio, 0.5 * ratio)
+    with rasterio.open(ms_name, "w", height=ms_height, width=ms_width, count=4, transform=transform, **profile) as dst:
+        dst.write(ms.astype(dtype))
+    transform = from_origin(500000, 5000000, 0.5, 0.5)
+    with rasterio.open(pan_name, "w", height=height, width=width, count=1, transform=transform, **profile) as dst:
+        dst.write(pan.astype(dtype), 1)
+
+    return ms_name, pan_name
+
+
+def _assert_matches(streamed, whole, ratio, dtype):
+    # Tolerances of the streaming mode (see the comment in Simple_Pansharpen.py)
+    if dtype == "float32":
+        np.testing.assert_allclose(streamed, whole, rtol=1e-6 if ratio == 4 else 1e-5, atol=1e-3)
+    elif ratio == 4:
+        np.testing.assert_array_equal(streamed, whole)
+    else:
+        np.testing.assert_allclose(streamed.astype(float), whole.astype(float), rtol=1e-3, atol=2)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("method", PANSHARPEN_METHODS)
+@pytest.mark.parametrize("ratio", [4, 3, 2.5])
+def test_streaming_matches_whole(tmp_path, ratio, method, dtype):
+    ms_name, pan_name = _write_pair(tmp_path, ratio, dtype)
+    for resampling in RESAMPLINGS:
+        whole = pansharpen(ms_name, pan_name, str(tmp_path / "whole.tif"), method=method, resampling=resampling)
+        whole = np.transpose(whole, (2, 0, 1))
+        for mode, options in MODES.items():
+            if options.get("scratch_dir"):
+                options = dict(scratch_dir=str(tmp_path))
+            name = str(tmp_path / f"{mode}.tif")
+            pansharpen(ms_name, pan_name, name, method=method, resampling=resampling, **options)
+            with rasterio.open(name) as src:
+                streamed = src.read()
+            assert streamed.dtype == whole.dtype, (mode, resampling)
+            _assert_matches(streamed, whole, ratio, dtype)